@@ -4,17 +4,41 @@ import os
 import sys
 import subprocess
 import shutil
-import faiss
+import importlib
+import argparse
 import numpy as np
-import ollama
-import PyPDF2
+import io
 import json
+import mmap
+import hashlib
+import sqlite3
+import array
+import re
+import time
+import zlib
 import webbrowser
 import threading
+import collections
+import itertools
+import bisect
+import multiprocessing
+import uuid
+import concurrent.futures
+import contextlib
+import traceback
+import gzip
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from flask import Flask, request, jsonify, Response
 from werkzeug.utils import secure_filename
 
+try:
+    import brotli
+except ImportError:
+    # Optional: without it static assets are only offered gzip-compressed.
+    brotli = None
+
 
 # Helper for CREATE_NO_WINDOW on Windows
 if sys.platform == "win32":
@@ -22,6 +46,22 @@ if sys.platform == "win32":
 else:
     CREATE_NO_WINDOW = 0
 
+class LazyModule:
+    """Stands in for a module that is only imported on first attribute access."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# These take most of the import time, so the server can bind before they are loaded.
+faiss = LazyModule("faiss")
+ollama = LazyModule("ollama")
+PyPDF2 = LazyModule("PyPDF2")
+
 
 
 MODEL_OPTIONS = {
@@ -36,18 +76,169 @@ MODEL_OPTIONS = {
 }
 DEFAULT_MODEL = "llama3.2:3b"
 
+# Embedding pipeline tuning: chunks sent per embedding request, and how many
+# requests may be in flight against the embedder at once. An ingested file queues at
+# most EMBED_PENDING_BATCHES requests before its chunker waits, and stored chunks are
+# re-read and embedded EMBED_TEXT_BLOCK texts at a time.
+EMBED_BATCH_SIZE = 32
+EMBED_WORKERS = 4
+EMBED_PENDING_BATCHES = 2 * EMBED_WORKERS
+EMBED_TEXT_BLOCK = 4096
+
 # Fix: Make the UPLOAD_FOLDER path absolute and based on the script's location
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-vector_store = None
-text_chunks = []
-source_filenames = []
-current_model = DEFAULT_MODEL
+# Each notebook is a separate corpus (FAISS index, chunk store and manifest) persisted in
+# its own directory here, so restarts don't require re-embedding every document.
+# Only the most recently used notebooks are kept in memory; the rest reload on demand.
+NOTEBOOKS_DIR = os.path.join(UPLOAD_FOLDER, "notebooks")
+DEFAULT_NOTEBOOK = "default"
+MAX_LOADED_NOTEBOOKS = 4
+NOTEBOOK_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Chunk texts are sliced from memory-mapped document files; this many stay mapped per notebook.
+MAX_MAPPED_DOCUMENTS = 256
+# Where the single corpus lived before notebooks; it becomes the default notebook.
+LEGACY_CORPUS_DIR = os.path.join(UPLOAD_FOLDER, "corpus")
+
+# Model availability is checked with a single Ollama query once the server is up, and
+# missing models are pulled in the background. When every model was found ready, that is
+# remembered in MODEL_STATUS_PATH and relaunches within MODEL_CHECK_TTL seconds skip the check.
+# A failed check or pull is retried after MODEL_RETRY_DELAY seconds, doubling up to
+# MODEL_RETRY_MAX_DELAY, or straight away when a request needs a model that failed.
+MODEL_STATUS_PATH = os.path.join(UPLOAD_FOLDER, "models.json")
+MODEL_CHECK_TTL = 10 * 60
+MODEL_RETRY_DELAY = 5
+MODEL_RETRY_MAX_DELAY = 5 * 60
+
+# Chunk embeddings are cached by (embed model, chunk text) so re-uploads only embed new text.
+# The least recently used entries are evicted once the stored vectors exceed the size limit.
+EMBED_CACHE_PATH = os.path.join(UPLOAD_FOLDER, "embed_cache.sqlite3")
+EMBED_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Vector index type: "flat" (exact), "hnsw", "ivf" (IVF-Flat), "ivfpq", or "auto" to
+# pick by chunk count: the first mode in INDEX_AUTO_LIMITS whose limit exceeds the
+# count, else "ivfpq". NPROBE (IVF lists scanned) and EF_SEARCH (HNSW candidate list
+# size) trade search speed for recall; `python benchmark.py ann` measures the trade-off.
+INDEX_MODE = "auto"
+INDEX_AUTO_LIMITS = (("flat", 20_000), ("hnsw", 200_000), ("ivf", 1_000_000))
+INDEX_NPROBE = 16
+INDEX_EF_SEARCH = 64
+INDEX_HNSW_M = 32
+# Indexes are built, and stored vectors copied, VECTOR_BLOCK_ROWS rows at a time, so a
+# rebuild reads the memory-mapped vectors in blocks instead of loading them all. Index types
+# that need training are trained on a sample of INDEX_TRAIN_SAMPLE vectors, or 64 per list
+# for IVF indexes with more lists than that covers.
+VECTOR_BLOCK_ROWS = 65536
+INDEX_TRAIN_SAMPLE = 65536
+
+# How indexed vectors are encoded: "float32", "float16" (half the memory) or "sq8" (8-bit
+# scalar quantization, a quarter), and compared: "l2" distance or "cosine" (inner product of
+# L2-normalized vectors). Saved indexes are re-encoded on load when these change; `python
+# benchmark.py encodings` reports the memory saved and the recall lost. "ivfpq" indexes are
+# compressed already and ignore VECTOR_ENCODING.
+VECTOR_ENCODING = "float32"
+VECTOR_METRIC = "l2"
+
+# Text extraction: PDFs with at least PDF_PARALLEL_MIN_PAGES pages are extracted on a
+# process pool (when there is more than one CPU), PDF_PAGES_PER_TASK pages per task.
+# Text files are read in blocks.
+PDF_PARALLEL_MIN_PAGES = 48
+PDF_PAGES_PER_TASK = 16
+PDF_WORKERS = max(1, min(4, os.cpu_count() or 1))
+TEXT_READ_BLOCK = 1 << 20
+
+# /chat caches query embeddings and top-k results (LRU, with expiry) keyed by embed model
+# and normalized query. Cached results are dropped automatically when the corpus changes.
+QUERY_CACHE_SIZE = 512
+QUERY_CACHE_TTL = 30 * 60
+
+# Hybrid retrieval: dense (vector) and BM25 keyword results, HYBRID_CANDIDATES from each,
+# are merged with reciprocal rank fusion (constant RRF_K). If embedding the query takes
+# longer than QUERY_EMBED_TIMEOUT seconds (e.g. the embedder is busy ingesting), /chat
+# answers from keyword matches alone.
+HYBRID_SEARCH = True
+HYBRID_CANDIDATES = 20
+RRF_K = 60
+QUERY_EMBED_TIMEOUT = 3.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Retrieved chunks are post-processed before they go into the prompt. RETRIEVAL_CANDIDATES
+# hits are fetched; a hit mostly inside a better-ranked chunk of the same document (more
+# than DEDUPE_CONTAINMENT of its length) or nearly identical to one (vector cosine of at
+# least DEDUPE_SIMILARITY) is dropped; maximal marginal relevance reorders the rest for
+# diversity, with MMR_LAMBDA weighing relevance against redundancy (None skips it); the
+# RERANKER named in RERANKERS (None for none) may rescore the top RERANK_CANDIDATES; and
+# chunks are packed in that order into CONTEXT_TOKEN_BUDGET tokens. With CONTEXT_PIPELINE
+# off, the top CONTEXT_TOP_K hits are used as they are.
+CONTEXT_PIPELINE = True
+CONTEXT_TOP_K = 4
+RETRIEVAL_CANDIDATES = 20
+DEDUPE_CONTAINMENT = 0.5
+DEDUPE_SIMILARITY = 0.95
+MMR_LAMBDA = 0.7
+RERANKER = None
+RERANK_CANDIDATES = 10
+CONTEXT_TOKEN_BUDGET = 1500
+
+# Chats are conversations. A session keeps its last HISTORY_RECENT_TURNS exchanges verbatim and
+# folds older ones into a rolling summary in the background. Summary and turns together get at
+# most HISTORY_TOKEN_BUDGET tokens, so with CONTEXT_TOKEN_BUDGET the prompt stays the same size
+# however long the conversation runs. With QUERY_REWRITE, follow-up questions are rewritten
+# into standalone queries for retrieval. Idle sessions expire after SESSION_TTL seconds.
+HISTORY_RECENT_TURNS = 4
+HISTORY_TOKEN_BUDGET = 800
+SUMMARY_MAX_WORDS = 150
+QUERY_REWRITE = True
+MAX_SESSIONS = 100
+SESSION_TTL = 6 * 3600
+
+# Prompts run from most to least stable content: fixed instructions, the notebook's sources,
+# the conversation summary and turns, then retrieved context with the question. Consecutive
+# requests then share a long prefix that Ollama can reuse from its prompt cache. Models are
+# kept loaded for OLLAMA_KEEP_ALIVE between requests and warmed when a model is selected.
+OLLAMA_KEEP_ALIVE = "30m"
+
+# At most MAX_ACTIVE_GENERATIONS chat model calls (answers, with their query rewrites, and
+# session summaries) run at once; further requests wait in a first-come-first-served queue
+# and are told their position every QUEUE_EVENT_INTERVAL seconds.
+MAX_ACTIVE_GENERATIONS = 1
+QUEUE_EVENT_INTERVAL = 1.0
 
-def build_html():
-    """Generates the main HTML content for the web interface."""
+# Streamed tokens are coalesced into one SSE event per STREAM_FLUSH_INTERVAL seconds or
+# STREAM_FLUSH_CHARS characters, whichever comes first. The first token is sent at once.
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHARS = 256
+
+# Timing spans (extraction, chunking, embedding batches, searches, prompt assembly, time to
+# first token) are recorded in histograms with METRIC_BUCKETS bounds, in seconds, and served
+# at /metrics. Set SLOW_REQUEST_PROFILE_SECONDS to sample each chat request's stack every
+# PROFILE_SAMPLE_INTERVAL seconds and log the hottest stacks of requests slower than that.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+SLOW_REQUEST_PROFILE_SECONDS = None
+PROFILE_SAMPLE_INTERVAL = 0.01
+
+# Chunking: whole sentences are packed into chunks of up to CHUNK_MAX_TOKENS (estimated
+# at CHARS_PER_TOKEN characters per token), ending early at a paragraph break once a chunk
+# is CHUNK_PARAGRAPH_FILL full, and otherwise repeating up to CHUNK_OVERLAP_TOKENS of
+# trailing sentences in the next chunk.
+CHUNK_MAX_TOKENS = 350
+CHUNK_OVERLAP_TOKENS = 40
+CHUNK_PARAGRAPH_FILL = 0.6
+CHARS_PER_TOKEN = 4
+
+# Uploads are ingested by background jobs. JOB_EVENT_INTERVAL throttles the progress stream.
+INGEST_WORKERS = 2
+# Files of one upload are extracted, chunked and embedded concurrently by up to this many threads.
+INGEST_FILE_WORKERS = 4
+MAX_TRACKED_JOBS = 50
+JOB_EVENT_INTERVAL = 0.25
+
+def build_html(asset_urls):
+    """Generates the main HTML content for the web interface, linking assets by their `asset_urls`."""
     model_options_html = ''.join([
         f'<option value="{key}" {"selected" if key==DEFAULT_MODEL else ""}>{MODEL_OPTIONS[key]["label"]}</option>'
         for key in MODEL_OPTIONS
@@ -59,11 +250,8 @@ def build_html():
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>LocalNote</title>
-    <link rel="stylesheet" href="/static/style.css">
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Roboto:wght@400;500;700&display=swap" rel="stylesheet">
-    <script src="https://cdn.jsdelivr.net/npm/marked/marked.min.js"></script>
+    <link rel="stylesheet" href="{asset_urls['style.css']}">
+    <script src="{asset_urls['markdown.js']}"></script>
 </head>
 <body>
     <div class="app-container">
@@ -73,6 +261,10 @@ def build_html():
                 <span>LocalNote</span>
             </div>
             <div class="header-controls">
+                <div class="model-select-wrapper">
+                    <label for="notebook-select" id="notebook-label">Notebook</label>
+                    <select id="notebook-select"></select>
+                </div>
                 <div class="model-select-wrapper">
                     <label for="model-select" id="model-label">Model</label>
                     <select id="model-select">{model_options_html}</select>
@@ -106,6 +298,7 @@ def build_html():
                     <h1 id="welcome-title">LocalNote</h1>
                     <p id="welcome-subtitle">Upload documents to get started.</p>
                 </div>
+                <div id="model-status" class="status-message" style="display:none;"></div>
                 <div id="chat-status" class="status-message" style="display:none;"></div>
                 <div id="chat-history"></div>
                 <div class="chat-input-area">
@@ -128,7 +321,7 @@ def build_html():
             </aside>
         </main>
     </div>
-    <script src="/static/script.js"></script>
+    <script src="{asset_urls['script.js']}"></script>
 </body>
 </html>
 """
@@ -149,16 +342,16 @@ html[data-theme="light"] {
     --user-message-bg: #e8f0fe; --ai-message-bg: #f1f3f4;
 }
 * { box-sizing: border-box; margin: 0; padding: 0; }
-body { font-family: 'Roboto', sans-serif; background-color: var(--bg-main); color: var(--text-primary); overflow: hidden; transition: background-color 0.2s, color 0.2s; }
+body { font-family: Roboto, system-ui, -apple-system, 'Segoe UI', sans-serif; background-color: var(--bg-main); color: var(--text-primary); overflow: hidden; transition: background-color 0.2s, color 0.2s; }
 .app-container { display: flex; flex-direction: column; height: 100vh; }
 .app-header { display: flex; justify-content: space-between; align-items: center; padding: 12px 24px; border-bottom: 1px solid var(--border-color); }
 .logo { display: flex; align-items: center; gap: 8px; font-size: 1.2rem; font-weight: 500; color: var(--logo-header-color); }
 .header-controls { display: flex; align-items: center; gap: 16px; }
 .model-select-wrapper { display: flex; align-items: center; background-color: var(--model-selector-bg); border: 1px solid var(--border-color); border-radius: 8px; padding: 4px 12px; }
-#model-label { font-size: 0.9rem; font-weight: 500; margin-right: 8px; color: var(--text-secondary); }
-#model-select { background: none; border: none; color: var(--text-primary); font-size: 1rem; padding: 5px; font-weight: 500; border-radius: 6px; outline: none; appearance: none; cursor: pointer; }
-#model-select:focus { box-shadow: 0 0 0 2px var(--accent-blue); }
-#model-select option { background: var(--bg-input); color: var(--text-primary); }
+#model-label, #notebook-label { font-size: 0.9rem; font-weight: 500; margin-right: 8px; color: var(--text-secondary); }
+#model-select, #notebook-select { background: none; border: none; color: var(--text-primary); font-size: 1rem; padding: 5px; font-weight: 500; border-radius: 6px; outline: none; appearance: none; cursor: pointer; }
+#model-select:focus, #notebook-select:focus { box-shadow: 0 0 0 2px var(--accent-blue); }
+#model-select option, #notebook-select option { background: var(--bg-input); color: var(--text-primary); }
 .shutdown-btn { background: #d93025; color: #fff; padding: 8px 16px; border: none; border-radius: 8px; font-weight: 500; cursor: pointer; transition: background 0.2s; }
 .shutdown-btn:hover { background: #a50e0e; }
 .settings-container { position: relative; }
@@ -174,6 +367,9 @@ body { font-family: 'Roboto', sans-serif; background-color: var(--bg-main); colo
 #add-source-btn:hover { opacity: 0.9; }
 .source-item { background-color: var(--bg-input); padding: 12px; border-radius: 6px; font-size: 0.95rem; display: flex; align-items: center; gap: 10px; margin-bottom: 4px; color: var(--text-secondary); overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
 .source-item .source-icon { font-size:1.1rem; color: var(--accent-blue); flex-shrink: 0;}
+.source-item .source-name { flex-grow: 1; overflow: hidden; text-overflow: ellipsis; }
+.source-remove { background: none; border: none; color: var(--text-secondary); font-size: 1.1rem; cursor: pointer; flex-shrink: 0; }
+.source-remove:hover { color: #d93025; }
 .chat-panel { flex-grow: 1; display: flex; flex-direction: column; padding: 16px 24px; max-width: 900px; margin: 0 auto; width: 100%; }
 #chat-welcome { flex-grow: 1; display: flex; flex-direction: column; justify-content: center; align-items: center; text-align: center; }
 .welcome-logo { margin-bottom: 24px; }
@@ -184,7 +380,7 @@ body { font-family: 'Roboto', sans-serif; background-color: var(--bg-main); colo
 .logo-page.blue { background-color: #4285f4; transform: rotate(15deg); top: 0; left: 20px; }
 #welcome-title { font-size: 2.5rem; font-weight: 500; margin-bottom: 8px; }
 #welcome-subtitle { color: var(--text-secondary); font-size: 1.1rem; }
-#chat-status.status-message { width: fit-content; max-width: 90%; margin: 14px auto 4px auto; text-align: center; background: var(--bg-input); color: var(--text-secondary); border-radius: 8px; padding: 9px 18px; font-size: 0.9rem; display: block; border: 1px solid var(--border-color); }
+#chat-status.status-message, #model-status.status-message { width: fit-content; max-width: 90%; margin: 14px auto 4px auto; text-align: center; background: var(--bg-input); color: var(--text-secondary); border-radius: 8px; padding: 9px 18px; font-size: 0.9rem; display: block; border: 1px solid var(--border-color); }
 #chat-history { flex-grow: 1; overflow-y: auto; padding: 0 12px; }
 .chat-message { margin-bottom: 24px; max-width: 100%; display: flex; gap: 12px; align-items: flex-start; }
 .chat-message .avatar { width: 32px; height: 32px; border-radius: 50%; display: flex; justify-content: center; align-items: center; flex-shrink: 0; background-color: var(--bg-input); color: var(--text-secondary); }
@@ -195,6 +391,11 @@ body { font-family: 'Roboto', sans-serif; background-color: var(--bg-main); colo
 .message-content ul, .message-content ol { padding-left: 2em; margin-bottom: 1em;}
 .message-content pre { background-color: rgba(0,0,0,0.18); padding: 12px; border-radius: 8px; margin: 1em 0; overflow-x: auto; }
 .message-content code { background-color: rgba(0,0,0,0.18); padding: 2px 6px; border-radius: 3px; font-family: monospace; }
+.message-content pre code { background: none; padding: 0; }
+.message-content blockquote { border-left: 3px solid var(--border-color); padding-left: 12px; margin: 1em 0; color: var(--text-secondary); }
+.message-content table { border-collapse: collapse; margin: 1em 0; }
+.message-content th, .message-content td { border: 1px solid var(--border-color); padding: 6px 10px; }
+.message-content hr { border: none; border-top: 1px solid var(--border-color); margin: 1em 0; }
 .user-message .message-content { background-color: var(--user-message-bg); }
 .ai-message .message-content { background-color: var(--ai-message-bg); min-height: 2.5em; }
 .thinking-cursor { display: inline-block; width: 10px; height: 1.2em; background-color: var(--text-primary); animation: blink 1s infinite; vertical-align: text-bottom; margin-left: 4px; }
@@ -227,7 +428,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatHistory = document.getElementById('chat-history');
     const chatWelcome = document.getElementById('chat-welcome');
     const chatStatus = document.getElementById('chat-status');
+    const modelStatus = document.getElementById('model-status');
     const modelSelect = document.getElementById('model-select');
+    const notebookSelect = document.getElementById('notebook-select');
     const shutdownBtn = document.getElementById('shutdown-btn');
     const settingsBtn = document.getElementById('settings-btn');
     const settingsDropdown = document.getElementById('settings-dropdown');
@@ -237,9 +440,20 @@ document.addEventListener('DOMContentLoaded', () => {
     const userIcon = `<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" fill="currentColor"><path d="M12 12c2.21 0 4-1.79 4-4s-1.79-4-4-4-4 1.79-4 4 1.79 4 4 4zm0 2c-2.67 0-8 1.34-8 4v2h16v-2c0-2.66-5.33-4-8-4z"></path></svg>`;
     const aiIcon = `<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" fill="currentColor"><path d="M12 2C6.48 2 2 6.48 2 12s4.48 10 10 10 10-4.48 10-10S17.52 2 12 2zM9.5 16.5c-.83 0-1.5-.67-1.5-1.5s.67-1.5 1.5-1.5 1.5.67 1.5 1.5-.67 1.5-1.5 1.5zm5 0c-.83 0-1.5-.67-1.5-1.5s.67-1.5 1.5-1.5 1.5.67 1.5 1.5-.67 1.5-1.5 1.5zm2.5-4.5h-10v-2h10v2z"></path></svg>`;
 
+    let currentSources = [];
+    let currentNotebook = localStorage.getItem('notebook') || 'default';
+    // The server keeps the conversation; a new notebook starts a new one.
+    let sessionId = null;
+
     addSourceBtn.addEventListener('click', () => fileUploadInput.click());
+    sourcesList.addEventListener('click', (e) => {
+        const button = e.target.closest('.source-remove');
+        if (button) removeSource(button.dataset.filename);
+    });
     fileUploadInput.addEventListener('change', handleFileUpload);
     chatForm.addEventListener('submit', handleChatSubmit);
+    notebookSelect.addEventListener('change', handleNotebookChange);
+    modelSelect.addEventListener('change', handleModelChange);
 
     shutdownBtn.addEventListener('click', async () => {
         if (confirm("Are you sure you want to shut down the LocalNote application?")) {
@@ -258,33 +472,198 @@ document.addEventListener('DOMContentLoaded', () => {
     themeLight.addEventListener('click', (e) => { e.preventDefault(); document.documentElement.setAttribute('data-theme', 'light'); });
     themeDark.addEventListener('click', (e) => { e.preventDefault(); document.documentElement.setAttribute('data-theme', 'dark'); });
 
+    loadNotebooks().then(restoreSources);
+    watchModelStatus();
+
+    function withNotebook(url) {
+        return `${url}${url.includes('?') ? '&' : '?'}notebook=${encodeURIComponent(currentNotebook)}`;
+    }
+
+    async function loadNotebooks() {
+        let names = ['default'];
+        try {
+            const response = await fetch('/notebooks');
+            if (response.ok) names = (await response.json()).notebooks;
+        } catch (error) { /* Fall back to the default notebook. */ }
+        if (!names.includes(currentNotebook)) names.push(currentNotebook);
+        notebookSelect.innerHTML = names.map(name => `<option value="${name}">${name}</option>`).join('')
+            + '<option value="__new__">+ New notebook</option>';
+        notebookSelect.value = currentNotebook;
+    }
+
+    async function handleNotebookChange() {
+        if (notebookSelect.value === '__new__') {
+            const name = (prompt("Name for the new notebook (letters, digits, '-' or '_'):") || '').trim();
+            if (!/^[A-Za-z0-9_-]{1,64}$/.test(name)) {
+                if (name) alert('Invalid notebook name.');
+                notebookSelect.value = currentNotebook;
+                return;
+            }
+            currentNotebook = name;
+            await loadNotebooks();
+        } else {
+            currentNotebook = notebookSelect.value;
+        }
+        localStorage.setItem('notebook', currentNotebook);
+        sessionId = null;
+        chatHistory.innerHTML = '';
+        chatWelcome.style.display = '';
+        hideStatus();
+        updateSourcesList([], false);
+        setChatInputState(true, "Upload a document to begin...");
+        restoreSources();
+    }
+
+    async function handleModelChange() {
+        try {
+            const response = await fetch(`/notebooks/${encodeURIComponent(currentNotebook)}/model`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ model: modelSelect.value })
+            });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.error || 'Failed to switch model.');
+            if (result.status === 'building') watchEmbeddingBuild(result.embed_model);
+        } catch (error) {
+            alert(`Error switching model: ${error.message}`);
+        }
+    }
+
+    async function watchEmbeddingBuild(embedModel) {
+        // Chat keeps working against the previous embeddings meanwhile; just report progress.
+        const notebook = currentNotebook;
+        showStatus(`Indexing sources for ${embedModel}...`);
+        while (notebook === currentNotebook) {
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            const response = await fetch(withNotebook('/sources'));
+            const result = await response.json();
+            if (!response.ok || !result.building.includes(embedModel)) break;
+        }
+        if (chatStatus.textContent.startsWith('Indexing sources')) hideStatus();
+    }
+
+    async function watchModelStatus() {
+        // Models may still be checked or downloaded after the page loads; show progress until they are ready.
+        // Failed checks are retried on the server, so errors are polled too, just less often.
+        while (true) {
+            let status = null;
+            let delay = 1000;
+            try {
+                const response = await fetch('/models/status');
+                if (response.ok) status = await response.json();
+            } catch (error) { /* Server not reachable, try again shortly. */ }
+            if (status && status.ready) {
+                modelStatus.style.display = 'none';
+                return;
+            }
+            if (status) {
+                const lines = Object.entries(status.models).filter(([, state]) => state.status !== 'ready').map(([name, state]) => {
+                    if (state.status === 'pulling') {
+                        const percent = state.total ? ` ${Math.floor(100 * state.completed / state.total)}%` : '';
+                        return `Downloading ${name}...${percent}`;
+                    }
+                    if (state.status === 'error') return `${name}: ${state.error}`;
+                    return `Checking ${name}...`;
+                });
+                modelStatus.textContent = lines.join(' \u00b7 ');
+                modelStatus.style.display = 'block';
+                if (Object.values(status.models).every(state => state.status === 'ready' || state.status === 'error')) delay = 5000;
+            }
+            await new Promise(resolve => setTimeout(resolve, delay));
+        }
+    }
+
+    async function restoreSources() {
+        try {
+            const response = await fetch(withNotebook('/sources'));
+            const result = await response.json();
+            if (response.ok && result.filenames.length) {
+                updateSourcesList(result.filenames, false);
+                if ([...modelSelect.options].some(o => o.value === result.model)) modelSelect.value = result.model;
+                setChatInputState(false, `Ask a question about ${result.filenames.join(', ')}...`);
+                chatWelcome.style.display = 'none';
+            }
+        } catch (error) { /* No saved corpus yet, keep the welcome screen. */ }
+    }
+
     async function handleFileUpload(event) {
         const files = Array.from(event.target.files);
         if (!files.length) return;
 
-        updateSourcesList(files.map(f => f.name), true);
-        setChatInputState(true, "Processing documents...");
-        showStatus("Embedding documents... This may take a moment.");
+        const notebook = currentNotebook;
+        const previousSources = currentSources;
+        updateSourcesList(previousSources, false);
+        appendSourceItems(files.map(f => f.name), true);
+        // Questions can still be asked against the current sources while new ones are ingested.
+        if (!previousSources.length) setChatInputState(true, "Processing documents...");
+        showStatus("Uploading documents...");
         chatWelcome.style.display = 'none';
 
         const formData = new FormData();
         files.forEach(file => formData.append('files', file));
         formData.append('model', modelSelect.value);
+        formData.append('notebook', notebook);
 
         try {
             const response = await fetch('/upload', { method: 'POST', body: formData });
             const result = await response.json();
-            if (response.ok) {
-                updateSourcesList(result.filenames, false);
-                setChatInputState(false, `Ask a question about ${result.filenames.join(', ')}...`);
-                chatHistory.innerHTML = ''; 
-                hideStatus();
-            } else { throw new Error(result.error || 'Failed to upload files.'); }
+            if (!response.ok) throw new Error(describeProblems(result.results || []) || result.error || 'Failed to upload files.');
+            const job = result.job_id ? await watchIngestJob(result.events_url) : result;
+            // The user may have switched notebooks while this one was ingesting.
+            if (notebook !== currentNotebook) return;
+            updateSourcesList(job.filenames, false);
+            setChatInputState(!job.filenames.length, job.filenames.length ? `Ask a question about ${job.filenames.join(', ')}...` : "Upload a document to begin...");
+            if (!previousSources.length) chatHistory.innerHTML = '';
+            hideStatus();
+            const problems = describeProblems([...result.results.filter(r => r.status !== 'queued'), ...(job.results || [])]);
+            if (problems) alert(`Some files were not added:\\n${problems}`);
         } catch (error) {
+            if (notebook !== currentNotebook) return;
             alert(`Error processing files: ${error.message}`);
-            sourcesList.innerHTML = '';
-            setChatInputState(true, "Upload failed. Please try again.");
+            updateSourcesList(previousSources, false);
+            setChatInputState(!previousSources.length, previousSources.length ? "Ask another question..." : "Upload failed. Please try again.");
             hideStatus();
+        } finally {
+            fileUploadInput.value = '';
+        }
+    }
+
+    function watchIngestJob(eventsUrl) {
+        return new Promise((resolve, reject) => {
+            const events = new EventSource(eventsUrl);
+            events.onmessage = (event) => {
+                const job = JSON.parse(event.data);
+                if (job.status === 'done') { events.close(); resolve(job); }
+                else if (job.status === 'error') { events.close(); reject(new Error(describeProblems(job.results) || job.error)); }
+                else showStatus(describeJob(job));
+            };
+            events.onerror = () => { events.close(); reject(new Error('Lost connection to the server.')); };
+        });
+    }
+
+    function describeProblems(results) {
+        return results.filter(r => r.status !== 'indexed' && r.status !== 'queued').map(r =>
+            r.status === 'duplicate' ? `${r.name}: same content as ${r.duplicate_of}` : `${r.name}: ${r.error}`).join('\\n');
+    }
+
+    function describeJob(job) {
+        if (job.status === 'queued') return "Waiting for earlier uploads to finish...";
+        let text = `Extracted ${job.pages_extracted}/${job.pages_total} pages, embedded ${job.chunks_embedded}/${job.chunks_total} chunks`;
+        if (job.current_file) text += ` (${job.current_file})`;
+        if (job.eta_seconds !== null) text += ` - about ${Math.ceil(job.eta_seconds)}s left`;
+        return text;
+    }
+
+    async function removeSource(filename) {
+        if (!confirm(`Remove ${filename} from your sources?`)) return;
+        try {
+            const response = await fetch(withNotebook(`/sources/${encodeURIComponent(filename)}`), { method: 'DELETE' });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.error || 'Failed to remove source.');
+            updateSourcesList(result.filenames, false);
+            if (!result.filenames.length) setChatInputState(true, "Upload a document to begin...");
+        } catch (error) {
+            alert(`Error removing source: ${error.message}`);
         }
     }
 
@@ -300,50 +679,60 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const aiMessageElement = appendMessage('', 'ai');
         const contentElement = aiMessageElement.querySelector('.message-content');
+        const renderer = createIncrementalRenderer(contentElement);
         
         try {
             showStatus("Searching sources...");
             const response = await fetch('/chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ query, model: modelSelect.value })
+                body: JSON.stringify({ query, model: modelSelect.value, notebook: currentNotebook, session_id: sessionId })
             });
 
-            if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
+            if (!response.ok) {
+                let message = `Server error: ${response.statusText}`;
+                try { message = (await response.json()).error || message; } catch (error) { /* Not a JSON error body. */ }
+                throw new Error(message);
+            }
             
             showStatus("Generating response...");
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
-            let fullResponse = "";
+            let buffer = "";
 
             while (true) {
                 const { value, done } = await reader.read();
                 if (done) break;
-                
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\\n');
-
-                for (const line of lines) {
-                    if (line.startsWith('data: ')) {
-                        try {
-                            const jsonStr = line.substring(6);
-                            if (jsonStr) {
-                                const data = JSON.parse(jsonStr);
-                                if (data.token) {
-                                    fullResponse += data.token;
-                                    contentElement.innerHTML = marked.parse(fullResponse + '<span class="thinking-cursor"></span>');
-                                    chatHistory.scrollTop = chatHistory.scrollHeight;
-                                } else if (data.error) {
-                                    throw new Error(data.error);
-                                }
-                            }
-                        } catch(e) { /* Incomplete JSON chunk, ignore */ }
+                // Events end with a blank line; a partial event stays buffered until the rest arrives.
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\\n\\n');
+                buffer = events.pop();
+
+                for (const event of events) {
+                    const payload = sseData(event);
+                    if (payload === null) continue;
+                    const data = JSON.parse(payload);
+                    if (data.session_id !== undefined) {
+                        sessionId = data.session_id;
+                    } else if (data.queue_position !== undefined) {
+                        showStatus(data.queue_position > 0
+                            ? `Waiting for the model... ${data.queue_position} request(s) ahead of you.`
+                            : "Waiting for the model...");
+                    } else if (data.token) {
+                        if (chatStatus.textContent !== "Generating response...") showStatus("Generating response...");
+                        renderer.append(data.token);
+                    } else if (data.error) {
+                        throw new Error(data.error);
                     }
                 }
             }
-            contentElement.innerHTML = marked.parse(fullResponse);
+            renderer.finish();
         } catch (error) {
-            contentElement.innerHTML = `<p style="color:#d93025; padding:12px 0;">Error: ${error.message}</p>`;
+            renderer.cancel();
+            const errorParagraph = document.createElement('p');
+            errorParagraph.style.cssText = 'color:#d93025; padding:12px 0;';
+            errorParagraph.textContent = `Error: ${error.message}`;
+            contentElement.replaceChildren(errorParagraph);
         } finally {
             setChatInputState(false, "Ask another question...");
             chatInput.focus();
@@ -352,13 +741,91 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function sseData(event) {
+        // The joined data lines of one SSE event, or null for comments and keep-alives.
+        const data = event.split('\\n').map(line => line.replace(/\\r$/, ''))
+            .filter(line => line.startsWith('data:'))
+            .map(line => line.slice(line.startsWith('data: ') ? 6 : 5));
+        return data.length ? data.join('\\n') : null;
+    }
+
+    function createIncrementalRenderer(element) {
+        // Markdown before the last blank line outside a code fence can no longer change, so it
+        // is rendered once; only the trailing block is re-rendered, at most once per frame.
+        const settled = document.createElement('div');
+        const tail = document.createElement('div');
+        const cursor = document.createElement('span');
+        cursor.className = 'thinking-cursor';
+        element.replaceChildren(settled, tail, cursor);
+        let text = "", settledLength = 0, frame = null;
+
+        function settleBoundary() {
+            let inFence = false, boundary = settledLength, position = settledLength;
+            for (const line of text.slice(settledLength).split('\\n').slice(0, -1)) {
+                position += line.length + 1;
+                if (line.trimStart().startsWith('```')) inFence = !inFence;
+                else if (!inFence && !line.trim()) boundary = position;
+            }
+            return boundary;
+        }
+
+        function render() {
+            frame = null;
+            const boundary = settleBoundary();
+            if (boundary > settledLength) {
+                settled.insertAdjacentHTML('beforeend', markdown.render(text.slice(settledLength, boundary)));
+                settledLength = boundary;
+            }
+            tail.innerHTML = markdown.render(text.slice(settledLength));
+            chatHistory.scrollTop = chatHistory.scrollHeight;
+        }
+
+        return {
+            append(token) {
+                text += token;
+                if (frame === null) frame = requestAnimationFrame(render);
+            },
+            finish() {
+                // One full render at the end, so block boundaries leave no trace in the answer.
+                this.cancel();
+                element.innerHTML = markdown.render(text);
+            },
+            cancel() {
+                if (frame !== null) cancelAnimationFrame(frame);
+                frame = null;
+            },
+        };
+    }
+
     function updateSourcesList(filenames, isLoading) {
-        sourcesList.innerHTML = filenames.map(filename =>
-            `<div class="source-item" title="${filename}">
-                <span class="source-icon">📄</span> 
-                <span class="source-name">${filename} ${isLoading ? '(processing...)' : ''}</span>
-            </div>`
-        ).join('');
+        if (!isLoading) currentSources = filenames;
+        sourcesList.innerHTML = '';
+        appendSourceItems(filenames, isLoading);
+    }
+
+    function appendSourceItems(filenames, isLoading) {
+        // Built as elements rather than markup, so a source name is only ever shown as text.
+        filenames.forEach(filename => {
+            const item = document.createElement('div');
+            item.className = 'source-item';
+            item.title = filename;
+            const icon = document.createElement('span');
+            icon.className = 'source-icon';
+            icon.textContent = '📄';
+            const name = document.createElement('span');
+            name.className = 'source-name';
+            name.textContent = isLoading ? `${filename} (processing...)` : filename;
+            item.append(icon, ' ', name);
+            if (!isLoading) {
+                const remove = document.createElement('button');
+                remove.className = 'source-remove';
+                remove.dataset.filename = filename;
+                remove.title = 'Remove source';
+                remove.textContent = '\u00d7';
+                item.append(remove);
+            }
+            sourcesList.append(item);
+        });
     }
 
     function appendMessage(text, sender) {
@@ -380,7 +847,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (text === '') {
                 messageContent.innerHTML = '<span class="thinking-cursor"></span>';
             } else {
-                messageContent.innerHTML = marked.parse(text);
+                messageContent.innerHTML = markdown.render(text);
             }
         }
         
@@ -402,34 +869,287 @@ document.addEventListener('DOMContentLoaded', () => {
 });
 """
 
-def ensure_ollama_model(model_name):
+def build_markdown_js():
+    """Generates the Markdown renderer the client uses for chat answers."""
+    return r"""
+// A small Markdown renderer for chat answers, served locally so the UI works offline.
+// It covers what models write: headings, paragraphs, emphasis, code, lists, block quotes,
+// tables, rules and links. All text is HTML-escaped, and links only allow web and mail URLs.
+(function () {
+    const LIST_ITEM = /^( *)([-*+]|\d{1,9}[.)])\s+(.*)$/;
+    const FENCE = /^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)/;
+    const HEADING = /^ {0,3}(#{1,6})\s+(.*?)\s*#*\s*$/;
+    const RULE = /^ {0,3}([-*_])(\s*\1){2,}\s*$/;
+    const QUOTE = /^ {0,3}>/;
+    const TABLE_DELIMITER = /^ *\|? *:?-+:? *(\| *:?-+:? *)*\|? *$/;
+
+    function escapeHtml(text) {
+        return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    }
+
+    function safeUrl(url) {
+        return /^(https?:|mailto:)/i.test(url) || !/^[a-z][\w+.-]*:/i.test(url);
+    }
+
+    function renderInline(text) {
+        // Code spans are set aside first so nothing inside them is treated as markup.
+        const codes = [];
+        text = text.replace(/(`+)([\s\S]*?[^`])\1(?!`)/g, (_, ticks, code) => {
+            codes.push(`<code>${escapeHtml(code.trim())}</code>`);
+            return `\u0000${codes.length - 1}\u0000`;
+        });
+        text = escapeHtml(text)
+            .replace(/!?\[([^\]]*)\]\(([^)\s]+)(?:\s+&quot;[^&]*&quot;)?\)/g, (match, label, url) =>
+                safeUrl(url) ? `<a href="${url}" target="_blank" rel="noopener noreferrer">${label}</a>` : label)
+            .replace(/(\*\*|__)(?=\S)([\s\S]*?\S)\1/g, '<strong>$2</strong>')
+            .replace(/\*(?=\S)([^*]*?\S)\*/g, '<em>$1</em>')
+            .replace(/(^|[^\w])_(?=\S)([^_]*?\S)_(?!\w)/g, '$1<em>$2</em>')
+            .replace(/~~(?=\S)([\s\S]*?\S)~~/g, '<del>$1</del>')
+            .replace(/ {2,}\n/g, '<br>\n');
+        return text.replace(/\u0000(\d+)\u0000/g, (_, i) => codes[i]);
+    }
+
+    function indentOf(line) {
+        return line.length - line.trimStart().length;
+    }
+
+    function isTableStart(lines, i) {
+        return i + 1 < lines.length && lines[i].includes('|') && lines[i + 1].includes('-') && TABLE_DELIMITER.test(lines[i + 1]);
+    }
+
+    function startsBlock(lines, i) {
+        const line = lines[i];
+        return FENCE.test(line) || HEADING.test(line) || RULE.test(line) || QUOTE.test(line) ||
+            LIST_ITEM.test(line) || isTableStart(lines, i);
+    }
+
+    function splitRow(line) {
+        return line.trim().replace(/^\|/, '').replace(/\|$/, '').split('|').map(cell => cell.trim());
+    }
+
+    function renderTable(lines, i, out) {
+        const header = splitRow(lines[i]);
+        const aligns = splitRow(lines[i + 1]).map(cell =>
+            cell.startsWith(':') && cell.endsWith(':') ? 'center' : cell.endsWith(':') ? 'right' : cell.startsWith(':') ? 'left' : '');
+        const cell = (tag, text, column) =>
+            `<${tag}${aligns[column] ? ` style="text-align:${aligns[column]}"` : ''}>${renderInline(text || '')}</${tag}>`;
+        const rows = [];
+        for (i += 2; i < lines.length && lines[i].trim() && lines[i].includes('|'); i++) {
+            const cells = splitRow(lines[i]);
+            rows.push(`<tr>${header.map((_, column) => cell('td', cells[column], column)).join('')}</tr>`);
+        }
+        out.push(`<table><thead><tr>${header.map((text, column) => cell('th', text, column)).join('')}</tr></thead>` +
+            `<tbody>${rows.join('')}</tbody></table>`);
+        return i;
+    }
+
+    function renderList(lines, i, out) {
+        const first = lines[i].match(LIST_ITEM);
+        const indent = first[1].length;
+        const ordered = /\d/.test(first[2]);
+        const items = [];
+        let loose = false;
+        while (i < lines.length) {
+            if (!lines[i].trim()) {
+                // Blank lines between items keep the list going (and make it loose).
+                let next = i;
+                while (next < lines.length && !lines[next].trim()) next++;
+                const sibling = next < lines.length && lines[next].match(LIST_ITEM);
+                if (!sibling || sibling[1].length !== indent || /\d/.test(sibling[2]) !== ordered) break;
+                loose = true;
+                i = next;
+            }
+            const item = lines[i].match(LIST_ITEM);
+            if (!item || item[1].length !== indent || /\d/.test(item[2]) !== ordered) break;
+            const contentIndent = item[0].length - item[3].length;
+            const body = [item[3]];
+            for (i++; i < lines.length; i++) {
+                const line = lines[i];
+                if (!line.trim()) {
+                    let next = i;
+                    while (next < lines.length && !lines[next].trim()) next++;
+                    if (next >= lines.length || indentOf(lines[next]) < contentIndent) break;
+                    body.push('');
+                    loose = true;
+                } else if (indentOf(line) > indent) {
+                    body.push(line.slice(Math.min(indentOf(line), contentIndent)));
+                } else if (startsBlock(lines, i)) {
+                    break;
+                } else {
+                    body.push(line);
+                }
+            }
+            items.push(body);
+        }
+        const tag = ordered ? 'ol' : 'ul';
+        const start = ordered && parseInt(first[2], 10) !== 1 ? ` start="${parseInt(first[2], 10)}"` : '';
+        out.push(`<${tag}${start}>${items.map(body => {
+            const html = renderBlocks(body);
+            return `<li>${loose ? html : html.replace(/^<p>([\s\S]*?)<\/p>/, '$1')}</li>`;
+        }).join('')}</${tag}>`);
+        return i;
+    }
+
+    function renderBlocks(lines) {
+        const out = [];
+        let i = 0;
+        while (i < lines.length) {
+            const line = lines[i];
+            let match;
+            if (!line.trim()) {
+                i++;
+            } else if ((match = line.match(FENCE))) {
+                const body = [];
+                for (i++; i < lines.length && !lines[i].trimStart().startsWith(match[1]); i++) body.push(lines[i]);
+                i++;
+                const language = match[2] ? ` class="language-${escapeHtml(match[2])}"` : '';
+                out.push(`<pre><code${language}>${escapeHtml(body.join('\n'))}</code></pre>`);
+            } else if ((match = line.match(HEADING))) {
+                out.push(`<h${match[1].length}>${renderInline(match[2])}</h${match[1].length}>`);
+                i++;
+            } else if (RULE.test(line)) {
+                out.push('<hr>');
+                i++;
+            } else if (QUOTE.test(line)) {
+                const body = [];
+                while (i < lines.length && QUOTE.test(lines[i])) body.push(lines[i++].replace(/^ {0,3}> ?/, ''));
+                out.push(`<blockquote>${renderBlocks(body)}</blockquote>`);
+            } else if (LIST_ITEM.test(line)) {
+                i = renderList(lines, i, out);
+            } else if (isTableStart(lines, i)) {
+                i = renderTable(lines, i, out);
+            } else {
+                const body = [];
+                do {
+                    body.push(lines[i++].trimStart());
+                } while (i < lines.length && lines[i].trim() && !startsBlock(lines, i));
+                out.push(`<p>${renderInline(body.join('\n'))}</p>`);
+            }
+        }
+        return out.join('');
+    }
+
+    window.markdown = {
+        render(text) {
+            return renderBlocks(text.replace(/\r\n?/g, '\n').split('\n'));
+        },
+    };
+})();
+"""
+
+class ModelManager:
     """
-    Checks if an Ollama model is available locally. If not, it pulls the model.
+    Tracks whether each required Ollama model is available, pulling missing ones in the
+    background. A model's state is "checking", "ready", "pulling" (with completed and total
+    bytes) or "error". Models not being tracked, e.g. before start(), are assumed usable.
+    The check runs again, with backoff, until every model is ready.
     """
-    try:
-        process = subprocess.run(["ollama", "list"], capture_output=True, text=True)
-        if process.returncode != 0:
-            print(f"Error: The 'ollama list' command failed. Is the Ollama server running?")
-            print(f"Stderr: {process.stderr.strip()}")
-            sys.exit(1)
-        
-        if model_name not in process.stdout:
-            print(f"Model '{model_name}' not found locally. Pulling model, please wait...")
-            pull_process = subprocess.Popen(["ollama", "pull", model_name], stdout=sys.stdout, stderr=sys.stderr)
-            pull_process.wait()
-            if pull_process.returncode != 0:
-                print(f"Error: Failed to pull model '{model_name}'.")
-                sys.exit(1)
-            print(f"Model '{model_name}' pulled successfully.")
-        else:
-            print(f"Model '{model_name}' is available.")
+    def __init__(self, names, status_path, ttl):
+        self.names = names
+        self.status_path = status_path
+        self.ttl = ttl
+        self.states = {}
+        self.lock = threading.Lock()
+        # Set to cut a retry's backoff short.
+        self.retry_now = threading.Event()
 
-    except FileNotFoundError:
-        print("Error: 'ollama' command not found. Please ensure Ollama is installed and in your PATH.")
-        sys.exit(1)
-    except Exception as e:
-        print(f"An unexpected error occurred while checking for Ollama models: {e}")
-        sys.exit(1)
+    def _set(self, name, **state):
+        with self.lock:
+            self.states[name] = state
+
+    def snapshot(self):
+        with self.lock:
+            states = {name: dict(state) for name, state in self.states.items()}
+        return {"models": states, "ready": all(state["status"] == "ready" for state in states.values())}
+
+    def unavailable_reason(self, name):
+        """None if `name` can be used now, otherwise a message saying why not."""
+        with self.lock:
+            state = self.states.get(name)
+        if state is None or state["status"] == "ready":
+            return None
+        if state["status"] == "pulling":
+            percent = f" ({100 * state['completed'] / state['total']:.0f}%)" if state.get('total') else ""
+            return f"Model '{name}' is still downloading{percent}. Please try again shortly."
+        if state["status"] == "checking":
+            return f"Still checking whether model '{name}' is installed. Please try again shortly."
+        self.retry_now.set()
+        return f"Model '{name}' is unavailable: {state.get('error')} Checking again in the background."
+
+    def start(self):
+        """Marks models ready from a fresh cached check, or checks and pulls them on a background thread."""
+        try:
+            with open(self.status_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if time.time() - cached['checked_at'] < self.ttl and set(self.names) <= set(cached['ready']):
+                for name in self.names:
+                    self._set(name, status="ready")
+                print("--- All models were ready at the last check; skipping it. ---")
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        for name in self.names:
+            self._set(name, status="checking")
+        threading.Thread(target=self._check_until_ready, daemon=True, name="model-check").start()
+
+    def _check_until_ready(self):
+        delay = MODEL_RETRY_DELAY
+        while not self._check():
+            print(f"Checking the models again in {delay}s, or sooner if one is needed.")
+            self.retry_now.wait(delay)
+            self.retry_now.clear()
+            delay = min(2 * delay, MODEL_RETRY_MAX_DELAY)
+
+    def _check(self):
+        """Checks the models once, pulling missing ones. Returns whether they all ended up ready."""
+        try:
+            available = {model['name'] for model in ollama.list()['models']}
+        except Exception as e:
+            print(f"Error: could not list Ollama models. Is the Ollama server running? ({e})")
+            for name in self.names:
+                self._set(name, status="error", error="Could not reach Ollama. Is the Ollama server running?")
+            return False
+        missing = [name for name in self.names if name not in available]
+        for name in self.names:
+            if name in missing:
+                self._set(name, status="pulling", completed=0, total=0)
+            else:
+                print(f"Model '{name}' is available.")
+                self._set(name, status="ready")
+        # Pull one at a time, so the first model needed isn't slowed down by the others.
+        for name in missing:
+            self._pull(name)
+        if not self.snapshot()["ready"]:
+            return False
+        try:
+            _atomic_write(self.status_path, self._write_status)
+        except OSError as e:
+            print(f"Could not save model status: {e}")
+        print("--- All models are ready. ---")
+        return True
+
+    def _write_status(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"ready": self.names, "checked_at": time.time()}, f)
+
+    def _pull(self, name):
+        print(f"Model '{name}' not found locally. Pulling it in the background...")
+        self._set(name, status="pulling", completed=0, total=0)
+        try:
+            for progress in ollama.pull(name, stream=True):
+                if progress.get('total'):
+                    self._set(name, status="pulling", completed=progress.get('completed', 0), total=progress['total'])
+        except Exception as e:
+            print(f"Error: Failed to pull model '{name}': {e}")
+            self._set(name, status="error", error=f"Download failed: {e}")
+            return
+        print(f"Model '{name}' pulled successfully.")
+        self._set(name, status="ready")
+
+model_manager = ModelManager(list(dict.fromkeys(name for chat_model, options in MODEL_OPTIONS.items()
+                                                for name in (chat_model, options['embed']))),
+                             MODEL_STATUS_PATH, MODEL_CHECK_TTL)
 
 
 app = Flask(__name__)
@@ -442,25 +1162,213 @@ def handle_exception(e):
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-def get_text_from_file(file_path):
+class MetricsRegistry:
+    """
+    In-process counters, gauges and histograms keyed by name and labels, rendered in the
+    Prometheus text format. Timing spans go into the `localnote_span_seconds` histogram,
+    labelled with the span name.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                bounds = buckets or self.buckets
+                histogram = self.histograms[key] = {"bounds": bounds, "counts": [0] * (len(bounds) + 1), "sum": 0.0}
+            histogram["counts"][bisect.bisect_left(histogram["bounds"], value)] += 1
+            histogram["sum"] += value
+
+    def gauge(self, name, read):
+        """Registers a gauge whose value is read from `read()` whenever metrics are rendered."""
+        self.gauges[name] = read
+
+    @contextlib.contextmanager
+    def span(self, name, timings=None):
+        """Times the block into the span histogram, and into `timings[name]` in milliseconds if given."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - started, timings)
+
+    def record_span(self, name, seconds, timings=None):
+        self.observe("localnote_span_seconds", seconds, span=name)
+        if timings is not None:
+            timings[name] = round(1000 * seconds, 2)
+
+    def render(self):
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(h, counts=list(h["counts"]))) for key, h in self.histograms.items())
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{labels_text(labels)} {value}")
+        for name, read in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name} {read()}")
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram["bounds"]) + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{labels_text(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{labels_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRIC_BUCKETS)
+
+def timed_iter(iterable, totals, key):
+    """Yields from `iterable`, adding the seconds spent producing each item to `totals[key]`."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            totals[key] += time.perf_counter() - started
+            return
+        totals[key] += time.perf_counter() - started
+        yield item
+
+class SlowRequestProfiler:
+    """
+    Samples the calling thread's stack every `interval` seconds until stop(). If the request
+    took at least `threshold` seconds by then, its most frequent stacks are logged; otherwise
+    the samples are discarded.
+    """
+    def __init__(self, name, threshold, interval):
+        self.name = name
+        self.threshold = threshold
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self._sample, daemon=True, name="profiler")
+        self.sampler.start()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[tuple(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{line})"
+                                   for frame, line in itertools.islice(traceback.walk_stack(frame), 6))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.samples.values())
+        if elapsed < self.threshold or not total:
+            return
+        print(f"Slow request {self.name}: {elapsed:.2f}s, {total} stack samples. Hottest stacks (innermost first):")
+        for stack, count in self.samples.most_common(5):
+            print(f"  {100 * count / total:5.1f}%  " + " <- ".join(stack))
+
+def _page_text(page):
+    # End every non-empty page with a newline so words don't run together across pages.
+    text = page.extract_text() or ""
+    return text if not text or text.endswith("\n") else text + "\n"
+
+def _extract_pdf_pages(file_path, start, end):
+    """Extracts the text of pages [start, end) of a PDF. Runs in a worker process for large files."""
+    with open(file_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [_page_text(reader.pages[i]) for i in range(start, end)]
+
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+def _get_pdf_executor():
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            # "spawn" on every platform: forking a process that already runs server and embedding threads is unsafe.
+            _pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_executor
+
+def _iter_pdf_pages_parallel(file_path, page_count):
+    global _pdf_executor
+    executor = _get_pdf_executor()
+    ranges = ((start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    # Only a couple of page ranges per worker are in flight, so memory doesn't grow with the page count.
+    pending = collections.deque(executor.submit(_extract_pdf_pages, file_path, start, end)
+                                for start, end in itertools.islice(ranges, PDF_WORKERS * 2))
+    next_page = 0
+    while pending:
+        try:
+            pages = pending.popleft().result()
+        except BrokenProcessPool:
+            print("PDF worker pool stopped unexpectedly; extracting the rest of the file in-process.")
+            with _pdf_executor_lock:
+                _pdf_executor = None
+            yield from _extract_pdf_pages(file_path, next_page, page_count)
+            return
+        next_range = next(ranges, None)
+        if next_range is not None:
+            pending.append(executor.submit(_extract_pdf_pages, file_path, *next_range))
+        next_page += len(pages)
+        yield from pages
+
+def iter_pages_from_file(file_path):
+    """
+    Yields a document's text piece by piece: one item per PDF page, or blocks of a .txt file.
+    Every PDF page is extracted exactly once, and PDFs of PDF_PARALLEL_MIN_PAGES or more
+    pages are spread across a process pool when there are CPUs to spare.
+    """
     if file_path.endswith('.pdf'):
         try:
             with open(file_path, 'rb') as f:
                 reader = PyPDF2.PdfReader(f)
-                return "".join(page.extract_text() for page in reader.pages if page.extract_text())
+                page_count = len(reader.pages)
+                if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS < 2:
+                    for page in reader.pages:
+                        yield _page_text(page)
+                    return
+            yield from _iter_pdf_pages_parallel(file_path, page_count)
         except Exception as e:
             print(f"Error reading PDF {file_path}: {e}")
-            return ""
     elif file_path.endswith('.txt'):
         try:
             with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read()
+                while True:
+                    block = f.read(TEXT_READ_BLOCK)
+                    if not block:
+                        break
+                    yield block
         except Exception as e:
             print(f"Error reading TXT {file_path}: {e}")
-            return ""
-    return ""
 
-def get_text_chunks(text, chunk_size=1500, chunk_overlap=250):
+def get_text_from_file(file_path):
+    return "".join(iter_pages_from_file(file_path))
+
+def get_window_chunks(text, chunk_size=1500, chunk_overlap=250):
+    """The original fixed-size character window splitter, kept as a baseline for `benchmark.py chunking`."""
     if not text: return []
     chunks = []
     start = 0
@@ -470,169 +1378,2818 @@ def get_text_chunks(text, chunk_size=1500, chunk_overlap=250):
         start += chunk_size - chunk_overlap
     return chunks
 
-def create_vector_store(all_chunks, embed_model):
-    if not all_chunks:
-        print("No text chunks to process for vector store.")
-        return None
-    try:
-        print(f"Generating embeddings for {len(all_chunks)} chunks using {embed_model}...")
-        embeddings = [ollama.embeddings(model=embed_model, prompt=chunk)['embedding'] for chunk in all_chunks]
-        dimension = len(embeddings[0])
-        index = faiss.IndexFlatL2(dimension)
-        index.add(np.array(embeddings, dtype=np.float32))
-        print("Vector store created successfully.")
-        return index
-    except Exception as e:
-        print(f"Error creating vector store: {e}")
-        return None
+# A chunk of document text. `start`/`end` are character offsets into the whole document
+# (its pieces joined), `page` is the 1-based PDF page the chunk starts on, or None.
+Chunk = collections.namedtuple('Chunk', 'text page start end')
+# A chunk without its text: the page it starts on (0 if none) and its character span in its document.
+CHUNK_SPAN_DTYPE = np.dtype([('page', np.int32), ('start', np.int64), ('end', np.int64)])
 
-@app.route('/')
-def index():
-    return Response(build_html(), mimetype='text/html')
+# Paragraph breaks, or sentence-ending punctuation (plus closing quotes/brackets) followed by whitespace.
+_BOUNDARY_RE = re.compile(r'\n[ \t]*\n\s*|(?<=[.!?])["\'\)\]]*\s+')
 
-@app.route('/static/style.css')
-def style():
-    return Response(build_css(), mimetype='text/css')
+def approx_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
 
-@app.route('/static/script.js')
-def script():
-    return Response(build_js(), mimetype='application/javascript')
+def _split_oversized(text, start, max_chars):
+    """Splits a unit longer than max_chars at word boundaries (or hard, if it has no spaces)."""
+    # Walk an offset rather than re-slicing the remainder, which is quadratic for long runs.
+    position = 0
+    while len(text) - position > max_chars:
+        limit = position + max_chars
+        cut = max(text.rfind(' ', position, limit), text.rfind('\n', position, limit)) + 1 or limit
+        yield start + position, text[position:cut], False
+        position = cut
+    yield start + position, text[position:], None
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    global vector_store, text_chunks, source_filenames, current_model
-    
-    if 'files' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400
-    
-    files = request.files.getlist('files')
-    model = request.form.get('model', DEFAULT_MODEL)
-    embed_model = MODEL_OPTIONS.get(model, MODEL_OPTIONS[DEFAULT_MODEL])['embed']
+def _iter_units(pieces, max_chars):
+    """
+    Yields (start, text, paragraph_end) for consecutive sentence/paragraph units that together
+    cover the document exactly. A boundary at the very end of the buffered text is held back
+    until more text arrives, since it may continue into the next piece.
+    """
+    buffer = ""
+    base = 0
+    for piece in pieces:
+        buffer += piece
+        cut = 0
+        for match in _BOUNDARY_RE.finditer(buffer):
+            if match.end() == len(buffer):
+                break
+            paragraph_end = match.group().count('\n') >= 2
+            for start, text, flag in _split_oversized(buffer[cut:match.end()], base + cut, max_chars):
+                yield start, text, paragraph_end if flag is None else flag
+            cut = match.end()
+        # Run-on text without boundaries mustn't accumulate; emit it in word-aligned pieces.
+        while len(buffer) - cut > 2 * max_chars:
+            start, text, _ = next(_split_oversized(buffer[cut:cut + max_chars + 1], base + cut, max_chars))
+            yield start, text, False
+            cut += len(text)
+        buffer = buffer[cut:]
+        base += cut
+    if buffer:
+        for start, text, flag in _split_oversized(buffer, base, max_chars):
+            yield start, text, True if flag is None else flag
 
-    all_chunks = []
-    processed_filenames = []
-    for file in files:
-        if not file or not file.filename:
-            continue
-        if not (file.filename.endswith('.pdf') or file.filename.endswith('.txt')):
-            print(f"Skipping unsupported file type: {file.filename}")
-            continue
+def iter_chunks(pieces, max_tokens=None, overlap_tokens=None, page_numbers=False):
+    """
+    Splits streamed document text into chunks on paragraph and sentence boundaries.
 
-        filename = secure_filename(file.filename)
-        if not filename:
-            print(f"Skipping file with an invalid or insecure name: {file.filename}")
-            continue
-            
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        try:
-            file.save(filepath)
-            print(f"Processing file: {filename}")
-            raw_text = get_text_from_file(filepath)
-            if not raw_text:
-                print(f"Warning: No text could be extracted from {filename}.")
-                processed_filenames.append(filename)
-                continue
-                
-            file_chunks = get_text_chunks(raw_text)
-            all_chunks.extend(file_chunks)
-            processed_filenames.append(filename)
-        except Exception as e:
-            print(f"Error processing file {file.filename}: {e}")
-            continue
+    Whole sentences are packed until the next one would exceed `max_tokens` (estimated as
+    CHARS_PER_TOKEN characters per token). A chunk that is mostly full ends early at a
+    paragraph break. Otherwise the next chunk repeats up to `overlap_tokens` of trailing
+    sentences for context. Only oversized sentences are split, at word boundaries. Runs in
+    one pass, holding at most about a chunk's worth of text. With `page_numbers`, each
+    piece is taken to be a page and chunks record the page they start on.
+    """
+    max_chars = (max_tokens or CHUNK_MAX_TOKENS) * CHARS_PER_TOKEN
+    overlap_chars = (CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens) * CHARS_PER_TOKEN
+    page_offsets = []
 
-    if not processed_filenames:
-        return jsonify({"error": "No valid files were processed. Please upload supported file types (.pdf, .txt)."}), 400
-    if not all_chunks:
-        return jsonify({"error": "Could not extract any text content from the processed files. They may be empty or corrupted."}), 400
-
-    text_chunks.clear()
-    text_chunks.extend(all_chunks)
-    source_filenames = processed_filenames
-    current_model = model
-    vector_store = create_vector_store(all_chunks, embed_model)
-    if vector_store is None:
-        return jsonify({"error": "Failed to create vector store from documents."}), 500
-        
-    return jsonify({"message": "Files processed successfully", "filenames": processed_filenames})
+    def tracked(pieces):
+        offset = 0
+        for piece in pieces:
+            page_offsets.append(offset)
+            offset += len(piece)
+            yield piece
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
-    query = data.get('query')
-    model = data.get('model', current_model)
-    embed_model = MODEL_OPTIONS.get(model, MODEL_OPTIONS[DEFAULT_MODEL])['embed']
+    def make_chunk(units):
+        text = "".join(unit[1] for unit in units)
+        stripped = text.strip()
+        if not stripped:
+            return None
+        start = units[0][0] + len(text) - len(text.lstrip())
+        end = start + len(stripped)
+        page = bisect.bisect_right(page_offsets, start) if page_numbers else None
+        return Chunk(stripped, page, start, end)
 
-    if not query:
-        return jsonify({"error": "Missing query"}), 400
-    if vector_store is None:
-        return jsonify({"error": "No document has been loaded. Please upload a file first."}), 400
-    
-    def generate_response():
-        print("\n--- Entering chat generator ---")
-        try:
-            query_embedding = np.array([ollama.embeddings(model=embed_model, prompt=query)['embedding']], dtype=np.float32)
-            k = 4
-            distances, indices = vector_store.search(query_embedding, k)
-            context = "\n\n---\n\n".join([text_chunks[i] for i in indices[0]])
-            
-            print(f"Context length: {len(context)}")
-            source_str = ', '.join(source_filenames) if source_filenames else "your sources"
-            
-            system_prompt = f"""You are a helpful and precise AI assistant called LocalNote. 
-            Your task is to answer questions based *only* on the provided document context.
-            The context is from the following document(s): {source_str}.
-            - Format your answers clearly using Markdown.
-            - Be concise and directly answer the user's question.
-            - If the answer is not found within the provided context, you MUST state: 'I could not find an answer in the provided document(s).'
-            - Do not use any external knowledge or make up information.
-            """
-            full_prompt = f"CONTEXT FROM DOCUMENTS:\n\n{context}\n\nUSER QUESTION: {query}"
+    current = []
+    current_chars = 0
+    fresh = False
+    for unit in _iter_units(tracked(pieces), max_chars):
+        if current and current_chars + len(unit[1]) > max_chars:
+            if fresh:
+                chunk = make_chunk(current)
+                if chunk:
+                    yield chunk
+            # Carry trailing sentences over as overlap, as long as they leave room for this unit.
+            carried = []
+            carried_chars = 0
+            for previous in reversed(current):
+                if carried_chars + len(previous[1]) > min(overlap_chars, max_chars - len(unit[1])):
+                    break
+                carried.insert(0, previous)
+                carried_chars += len(previous[1])
+            current, current_chars, fresh = carried, carried_chars, False
+        current.append(unit)
+        current_chars += len(unit[1])
+        fresh = True
+        if unit[2] and current_chars >= max_chars * CHUNK_PARAGRAPH_FILL:
+            chunk = make_chunk(current)
+            if chunk:
+                yield chunk
+            current, current_chars, fresh = [], 0, False
+    if fresh:
+        chunk = make_chunk(current)
+        if chunk:
+            yield chunk
 
-            stream = ollama.chat(
-                model=model,
-                messages=[
-                    {'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': full_prompt}
-                ],
-                stream=True,
-            )
+def get_text_chunks(text, max_tokens=None, overlap_tokens=None):
+    if not text: return []
+    return [chunk.text for chunk in iter_chunks([text], max_tokens, overlap_tokens)]
 
-            print("Ollama stream started. Waiting for chunks...")
-            for i, chunk in enumerate(stream):
-                if i == 0:
-                    print("First chunk received from Ollama.")
-                if 'content' in chunk['message']:
-                    token = chunk['message']['content']
-                    # FIX: Use single newline for proper SSE formatting.
-                    yield f"data: {json.dumps({'token': token})}\n\n"
+def ollama_embed_batch(embed_model, texts):
+    """Embeds a batch of texts with Ollama, using the batch endpoint when the client provides one."""
+    if hasattr(ollama, 'embed'):
+        return ollama.embed(model=embed_model, input=texts, keep_alive=OLLAMA_KEEP_ALIVE)['embeddings']
+    return [ollama.embeddings(model=embed_model, prompt=text, keep_alive=OLLAMA_KEEP_ALIVE)['embedding'] for text in texts]
 
-        except Exception as e:
-            print(f"Error during chat generation: {e}")
-            error_message = json.dumps({'error': 'An error occurred on the server while generating the response.'})
-            # FIX: Use single newline for proper SSE formatting.
-            yield f"data: {error_message}\n\n"
+def make_stub_embedder(dimension=768, latency=0.0):
+    """
+    Returns a deterministic embed backend that needs no Ollama server, for benchmarks and offline runs.
+    Words are hashed into `dimension` signed buckets, so texts sharing vocabulary land close together.
+    `latency` seconds are slept per batch to imitate a real embedder.
+    """
+    def embed_batch(embed_model, texts):
+        if latency:
+            time.sleep(latency)
+        vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(word.encode('utf-8'))
+                vectors[row, h % dimension] += -1.0 if h & 0x80000000 else 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+    return embed_batch
 
-    return Response(generate_response(), mimetype='text/event-stream')
+# The backend is a callable (embed_model, texts) -> sequence of vectors. Swap it with
+# set_embed_backend(make_stub_embedder()) to run the pipeline without a live server.
+embed_backend = ollama_embed_batch
+embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
 
-@app.route('/shutdown', methods=['POST'])
-def shutdown():
-    print("Shutdown request received. Terminating server.")
-    os._exit(0) 
+def set_embed_backend(backend):
+    global embed_backend
+    embed_backend = backend
 
-if __name__ == '__main__':
-    if getattr(sys, 'frozen', False):
-        os.chdir(sys._MEIPASS)
-        
-    print("--- LocalNote Startup Check ---")
-    for model_key in MODEL_OPTIONS:
-        ensure_ollama_model(model_key)
-        ensure_ollama_model(MODEL_OPTIONS[model_key]['embed'])
-    print("--- All models are ready. ---")
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache in a local SQLite database.
+
+    Entries are keyed by a SHA-256 of the embed model name and the chunk text, store the
+    vector as raw float32 bytes, and carry a last-used timestamp for LRU eviction. The row
+    count and vector bytes are counted once when the database is opened and then kept up to
+    date on insert and evict, so writes never scan the table.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rows = 0
+        self.bytes = 0
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self.rows, self.bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def key(embed_model, text):
+        return hashlib.sha256(embed_model.encode('utf-8') + b"\0" + text.encode('utf-8')).digest()
+
+    def get_many(self, embed_model, texts):
+        """Returns {position in texts: vector} for every text that is cached."""
+        keys = [self.key(embed_model, text) for text in texts]
+        found = {}
+        with self.lock:
+            conn = self._connection()
+            for start in range(0, len(keys), 500):
+                batch = list(set(keys[start:start + 500]))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+                conn.commit()
+            hits = {i: np.frombuffer(found[k], dtype=np.float32) for i, k in enumerate(keys) if k in found}
+            self.hits += len(hits)
+            self.misses += len(texts) - len(hits)
+        return hits
+
+    def put_many(self, embed_model, texts, vectors):
+        now = time.time()
+        rows = {self.key(embed_model, text): np.ascontiguousarray(vector, dtype=np.float32).tobytes()
+                for text, vector in zip(texts, vectors)}
+        with self.lock:
+            conn = self._connection()
+            # A key's vector never changes, so existing entries only need their timestamp refreshed.
+            keys = list(rows)
+            existing = set()
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                existing.update(key for key, in conn.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch))
+            new_rows = [(key, vector, now) for key, vector in rows.items() if key not in existing]
+            conn.executemany("INSERT INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", new_rows)
+            conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in existing])
+            self.rows += len(new_rows)
+            self.bytes += sum(len(vector) for _, vector, _ in new_rows)
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        if self.bytes <= self.max_bytes or not self.rows:
+            return
+        excess_rows = -(-(self.bytes - self.max_bytes) * self.rows // self.bytes)
+        oldest = conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT ?", (excess_rows,)).fetchall()
+        conn.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key, _ in oldest])
+        self.rows -= len(oldest)
+        self.bytes -= sum(size for _, size in oldest)
+        print(f"Embedding cache over {self.max_bytes} bytes; evicted {len(oldest)} least recently used entries.")
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_BYTES)
+
+def _embed_uncached(texts, embed_model, batch_size):
+    """Embeds `texts` in batches on the shared pool, written straight into a preallocated float32 matrix."""
+    backend = embed_backend
+    starts = range(0, len(texts), batch_size)
+
+    def embed_batch(batch):
+        with metrics.span("embed_batch"):
+            return np.asarray(backend(embed_model, batch), dtype=np.float32)
+
+    # The first batch runs inline so we learn the dimension before allocating.
+    first = embed_batch(texts[:batch_size])
+    matrix = np.empty((len(texts), first.shape[1]), dtype=np.float32)
+    matrix[:len(first)] = first
+
+    def embed_into(start):
+        batch = texts[start:start + batch_size]
+        matrix[start:start + len(batch)] = embed_batch(batch)
+
+    futures = [embed_executor.submit(embed_into, start) for start in starts[1:]]
+    for future in futures:
+        future.result()
+    return matrix
+
+def embed_texts(texts, embed_model, batch_size=EMBED_BATCH_SIZE, cache=None, stats=None):
+    """
+    Embeds `texts` and returns a float32 matrix with one row per text, in input order.
+    With a `cache`, only cache misses reach the embedder (each distinct text once) and new
+    vectors are stored back. Hit and miss counts are added to the `stats` dict if given.
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    cached = cache.get_many(embed_model, texts) if cache is not None else {}
+
+    missing_rows = {}
+    for i, text in enumerate(texts):
+        if i not in cached:
+            missing_rows.setdefault(text, []).append(i)
+    missing = list(missing_rows)
+    fresh = _embed_uncached(missing, embed_model, batch_size) if missing else None
+
+    dimension = fresh.shape[1] if fresh is not None else len(next(iter(cached.values())))
+    matrix = np.empty((len(texts), dimension), dtype=np.float32)
+    for i, vector in cached.items():
+        matrix[i] = vector
+    for row, text in enumerate(missing):
+        matrix[missing_rows[text]] = fresh[row]
+
+    if cache is not None and missing:
+        try:
+            cache.put_many(embed_model, missing, fresh)
+        except sqlite3.Error as e:
+            print(f"Warning: could not update embedding cache: {e}")
+    if stats is not None:
+        stats['hits'] = stats.get('hits', 0) + len(cached)
+        stats['misses'] = stats.get('misses', 0) + len(texts) - len(cached)
+    return matrix
+
+def choose_index_mode(chunk_count):
+    """Picks the ANN index mode for a corpus of `chunk_count` chunks (see INDEX_AUTO_LIMITS)."""
+    if INDEX_MODE != "auto":
+        return INDEX_MODE
+    for mode, limit in INDEX_AUTO_LIMITS:
+        if chunk_count < limit:
+            return mode
+    return "ivfpq"
+
+def _ivf_list_count(n):
+    # Roughly 4*sqrt(n) lists, but keep at least ~39 training points per centroid as faiss expects.
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+def _pq_subquantizers(dimension):
+    # Largest divisor of the dimension up to dimension/8, i.e. at least 32x compression at 8 bits per code.
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+
+# FAISS scalar quantizer codes for the reduced-precision encodings.
+_SQ_CODES = {"float16": "SQfp16", "sq8": "SQ8"}
+
+def prepare_vectors(vectors, metric):
+    """Vectors as FAISS takes them for `metric`: contiguous float32, L2-normalized for "cosine"."""
+    if metric == "cosine":
+        vectors = np.array(vectors, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        return vectors
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+def effective_index_mode(vector_count, mode=None):
+    """
+    The mode build_index actually uses for `vector_count` vectors: `mode` (by default the
+    one chosen for that count), or a simpler one when there is too little data to train it.
+    """
+    mode = mode or choose_index_mode(vector_count)
+    if mode == "ivfpq" and vector_count < 256 * 39:
+        mode = "ivf"
+    if mode == "ivf" and vector_count < 39 * 4:
+        mode = "flat"
+    return mode
+
+def _training_rows(n, mode):
+    """The rows of an n-vector corpus to train a `mode` index on: all of them, or a sorted random sample."""
+    size = INDEX_TRAIN_SAMPLE
+    if mode in ("ivf", "ivfpq"):
+        size = max(size, 64 * _ivf_list_count(n))
+    if n <= size:
+        return slice(None)
+    return np.sort(np.random.default_rng(0).choice(n, size, replace=False))
+
+def build_index(vectors, ids, mode=None, encoding=None, metric=None, rows=None):
+    """
+    Builds a FAISS index over `vectors` stored under `ids`, training it when the mode needs it.
+    `mode` is "flat", "ivf", "hnsw" or "ivfpq"; None picks one from the vector count.
+    `encoding` and `metric` default to VECTOR_ENCODING and VECTOR_METRIC. With `rows`, only
+    those rows of `vectors` are indexed. `vectors` may be memory-mapped: it is read
+    VECTOR_BLOCK_ROWS rows at a time, and training uses a sample (see INDEX_TRAIN_SAMPLE).
+    Returns (index, mode actually used). Modes that need more training data than is available
+    fall back to a simpler one.
+    """
+    encoding = encoding or VECTOR_ENCODING
+    metric = metric or VECTOR_METRIC
+    if encoding != "float32" and encoding not in _SQ_CODES:
+        raise ValueError(f"Unknown vector encoding '{encoding}'.")
+    if metric not in ("l2", "cosine"):
+        raise ValueError(f"Unknown vector metric '{metric}'.")
+    codes = _SQ_CODES.get(encoding)
+    ids = np.asarray(ids, dtype=np.int64)
+    n, dimension = len(ids), vectors.shape[1]
+    mode = effective_index_mode(n, mode)
+
+    if mode == "flat":
+        description = f"IDMap2,{codes or 'Flat'}"
+    elif mode == "hnsw":
+        description = f"IDMap2,HNSW{INDEX_HNSW_M}" + (f"_{codes}" if codes else "")
+    elif mode == "ivf":
+        description = f"IDMap2,IVF{_ivf_list_count(n)},{codes or 'Flat'}"
+    elif mode == "ivfpq":
+        description = f"IDMap2,IVF{_ivf_list_count(n)},PQ{_pq_subquantizers(dimension)}"
+    else:
+        raise ValueError(f"Unknown index mode '{mode}'.")
+
+    index = faiss.index_factory(dimension, description, faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2)
+
+    def read(select):
+        return prepare_vectors(vectors[select] if rows is None else vectors[rows[select]], metric)
+
+    if not index.is_trained:
+        index.train(read(_training_rows(n, mode)))
+    for start in range(0, n, VECTOR_BLOCK_ROWS):
+        index.add_with_ids(read(slice(start, start + VECTOR_BLOCK_ROWS)), ids[start:start + VECTOR_BLOCK_ROWS])
+    apply_search_params(index)
+    return index, mode
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    """Sets the IVF `nprobe` / HNSW `efSearch` recall-vs-speed knobs on an index, where they apply."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe or INDEX_NPROBE, ivf.nlist)
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if hasattr(inner, 'hnsw'):
+        inner.hnsw.efSearch = ef_search or INDEX_EF_SEARCH
+
+def embed_chunk_stream(chunks, embed_model, vectors_path, batch_size=EMBED_BATCH_SIZE, progress=None):
+    """
+    Embeds Chunk records from an iterator as they are produced: each full batch goes to the
+    embedding pool straight away, so extracting and chunking later pages overlaps with
+    embedding earlier ones. Once EMBED_PENDING_BATCHES batches are in flight the chunker
+    waits for the oldest. Finished batches are appended to `vectors_path` as raw float32
+    rows and only the chunks' spans are kept, so memory doesn't grow with the document.
+    Returns (CHUNK_SPAN_DTYPE array of the chunks, vector dimension or None if there were none).
+    `progress`, if given, is called with the size of each batch as it finishes.
+    """
+    pending = collections.deque()
+    spans = [np.zeros(0, dtype=CHUNK_SPAN_DTYPE)]
+    batch_stats = []
+    dimension = None
+    count = 0
+    started = time.perf_counter()
+    with open(vectors_path, 'wb') as out:
+        def write_oldest():
+            nonlocal dimension
+            future, batch_spans = pending.popleft()
+            matrix = future.result()
+            dimension = matrix.shape[1]
+            out.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+            spans.append(batch_spans)
+
+        def submit(batch):
+            stats = {}
+            batch_stats.append(stats)
+            # One batch per call, so embed_texts runs it inline instead of re-submitting to the pool.
+            future = embed_executor.submit(embed_texts, [chunk.text for chunk in batch], embed_model, len(batch), embedding_cache, stats)
+            if progress is not None:
+                def report(f, n=len(batch)):
+                    if f.exception() is None:
+                        progress(n)
+                future.add_done_callback(report)
+            batch_spans = np.array([(chunk.page or 0, chunk.start, chunk.end) for chunk in batch], dtype=CHUNK_SPAN_DTYPE)
+            pending.append((future, batch_spans))
+            while len(pending) > EMBED_PENDING_BATCHES:
+                write_oldest()
+
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                submit(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            submit(batch)
+            count += len(batch)
+        while pending:
+            write_oldest()
+
+    if count:
+        elapsed = time.perf_counter() - started
+        hits = sum(stats.get('hits', 0) for stats in batch_stats)
+        print(f"Extracted and embedded {count} chunks in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.1f} chunks/s); "
+              f"cache hits: {hits}, misses: {count - hits}.")
+    return np.concatenate(spans), dimension
+
+def create_vector_store(all_chunks, embed_model, ids=None, mode=None):
+    """
+    Embeds `all_chunks` and returns a FAISS index over them. Vectors are stored under
+    per-chunk IDs (0..n-1 unless `ids` is given) so chunks can later be removed individually.
+    """
+    if not all_chunks:
+        print("No text chunks to process for vector store.")
+        return None
+    try:
+        embeddings = embed_chunks(all_chunks, embed_model)
+        ids = np.arange(len(all_chunks), dtype=np.int64) if ids is None else ids
+        index, mode = build_index(embeddings, ids, mode)
+        print(f"Vector store created successfully ({mode} index).")
+        return index
+    except Exception as e:
+        print(f"Error creating vector store: {e}")
+        return None
+
+def embed_chunks(chunks, embed_model, count=None):
+    """
+    Embeds document chunk texts through the embedding cache, logging throughput and cache hits.
+    `chunks` may be any iterable of texts if its length is given as `count`; it is consumed
+    EMBED_TEXT_BLOCK texts at a time, so only the vectors grow with the number of chunks.
+    """
+    count = len(chunks) if count is None else count
+    print(f"Generating embeddings for {count} chunks using {embed_model}...")
+    started = time.perf_counter()
+    stats = {}
+    embeddings = None
+    row = 0
+    texts = iter(chunks)
+    while True:
+        block = list(itertools.islice(texts, EMBED_TEXT_BLOCK))
+        if not block:
+            break
+        vectors = embed_texts(block, embed_model, cache=embedding_cache, stats=stats)
+        if embeddings is None:
+            embeddings = np.empty((count, vectors.shape[1]), dtype=np.float32)
+        embeddings[row:row + len(block)] = vectors
+        row += len(block)
+    if embeddings is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    elapsed = time.perf_counter() - started
+    print(f"Embedded {count} chunks in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.1f} chunks/s); "
+          f"cache hits: {stats['hits']}, misses: {stats['misses']}.")
+    return embeddings
+
+def _atomic_write(path, write):
+    """Writes a file via a temporary sibling and renames it into place, so readers never see a partial file."""
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+# Words, plus compound identifiers such as part numbers ("xj-9000"), versions ("v1.5") and paths.
+_KEYWORD_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+
+def keyword_tokens(text):
+    """Case-folded search terms; compound identifiers are indexed whole and by their parts."""
+    tokens = []
+    for match in _KEYWORD_RE.finditer(text.casefold()):
+        token = match.group()
+        tokens.append(token)
+        parts = re.findall(r"\w+", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+class KeywordIndex:
+    """
+    Inverted index over chunk texts with BM25 scoring.
+
+    Each term maps to two typed arrays: chunk IDs (int64) and term frequencies (int32).
+    Document lengths are held in an array indexed by chunk ID. A removed chunk just gets
+    length 0 and is filtered out at query time. Its postings are purged by compact() once
+    dead postings reach a quarter of the total.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.doc_lengths = array.array('I')
+        self.live_docs = 0
+        self.total_length = 0
+        self.posting_count = 0
+        self.dead_postings = 0
+
+    def add(self, ids, texts):
+        for chunk_id, text in zip(ids, texts):
+            counts = collections.Counter(keyword_tokens(text))
+            if len(self.doc_lengths) <= chunk_id:
+                self.doc_lengths.extend(itertools.repeat(0, chunk_id + 1 - len(self.doc_lengths)))
+            length = sum(counts.values())
+            self.doc_lengths[chunk_id] = length
+            self.total_length += length
+            self.live_docs += 1
+            for term, tf in counts.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array.array('q'), array.array('i'))
+                posting[0].append(chunk_id)
+                posting[1].append(tf)
+            self.posting_count += len(counts)
+
+    def remove(self, ids, texts):
+        for chunk_id, text in zip(ids, texts):
+            if chunk_id < len(self.doc_lengths) and self.doc_lengths[chunk_id]:
+                self.total_length -= self.doc_lengths[chunk_id]
+                self.doc_lengths[chunk_id] = 0
+                self.live_docs -= 1
+                self.dead_postings += len(set(keyword_tokens(text)))
+        if self.dead_postings * 4 > self.posting_count:
+            self.compact()
+
+    def compact(self):
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        for term in list(self.postings):
+            ids, tfs = self.postings[term]
+            id_view = np.frombuffer(ids, dtype=np.int64)
+            alive = lengths[id_view] > 0
+            if alive.all():
+                continue
+            if not alive.any():
+                del self.postings[term]
+                continue
+            self.postings[term] = (array.array('q', id_view[alive].tobytes()), array.array('i', np.frombuffer(tfs, dtype=np.int32)[alive].tobytes()))
+        self.posting_count -= self.dead_postings
+        self.dead_postings = 0
+
+    def search(self, query, k):
+        """Returns up to k (chunk id, BM25 score) pairs, best first."""
+        if not self.live_docs:
+            return []
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        average_length = self.total_length / self.live_docs
+        found_ids = []
+        found_scores = []
+        for term in set(keyword_tokens(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids = np.frombuffer(posting[0], dtype=np.int64)
+            tfs = np.frombuffer(posting[1], dtype=np.int32).astype(np.float32)
+            doc_lengths = lengths[ids]
+            df = np.count_nonzero(doc_lengths)
+            if not df:
+                continue
+            idf = np.log(1 + (self.live_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)
+            scores = idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+            scores[doc_lengths == 0] = 0
+            found_ids.append(ids)
+            found_scores.append(scores)
+        if not found_ids:
+            return []
+        ids, inverse = np.unique(np.concatenate(found_ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(found_scores))
+        top = np.argsort(-totals)[:k]
+        return [(int(ids[i]), float(totals[i])) for i in top if totals[i] > 0]
+
+    def save(self, path):
+        self.compact()
+        terms = list(self.postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(self.postings[t][0]) for t in terms], out=offsets[1:])
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                terms=np.frombuffer("\n".join(terms).encode('utf-8'), dtype=np.uint8),
+                offsets=offsets,
+                ids=np.concatenate([np.frombuffer(self.postings[t][0], dtype=np.int64) for t in terms]) if terms else np.zeros(0, np.int64),
+                tfs=np.concatenate([np.frombuffer(self.postings[t][1], dtype=np.int32) for t in terms]) if terms else np.zeros(0, np.int32),
+                doc_lengths=np.frombuffer(self.doc_lengths, dtype=np.uint32),
+            )
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            terms = data['terms'].tobytes().decode('utf-8').split("\n") if len(data['terms']) else []
+            offsets, ids, tfs = data['offsets'], data['ids'], data['tfs']
+            for i, term in enumerate(terms):
+                index.postings[term] = (array.array('q', ids[offsets[i]:offsets[i + 1]].tobytes()),
+                                        array.array('i', tfs[offsets[i]:offsets[i + 1]].tobytes()))
+            index.doc_lengths = array.array('I', data['doc_lengths'].tobytes())
+        lengths = np.frombuffer(index.doc_lengths, dtype=np.uint32)
+        index.live_docs = int(np.count_nonzero(lengths))
+        index.total_length = int(lengths.sum())
+        index.posting_count = len(ids)
+        return index
+
+# A stored chunk: its document, the 1-based PDF page it starts on (0 if none) and its
+# byte range in the document's UTF-8 text file.
+CHUNK_RECORD_DTYPE = np.dtype([('doc', np.int32), ('page', np.int32), ('start', np.int64), ('end', np.int64)])
+
+def _utf8_offsets(path, char_offsets):
+    """Converts character offsets into a UTF-8 text file to byte offsets, reading the file once in blocks."""
+    offsets = np.asarray(char_offsets, dtype=np.int64)
+    byte_offsets = np.empty_like(offsets)
+    block, block_start, cursor, position = "", 0, 0, 0
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in np.argsort(offsets, kind='stable').tolist():
+            target = int(offsets[row])
+            while target > block_start + len(block):
+                position += len(block[cursor - block_start:].encode('utf-8'))
+                block_start += len(block)
+                cursor = block_start
+                block = f.read(TEXT_READ_BLOCK)
+                if not block:
+                    raise ValueError(f"Offset {target} is past the end of {path}.")
+            position += len(block[cursor - block_start:target - block_start].encode('utf-8'))
+            cursor = target
+            byte_offsets[row] = position
+    return byte_offsets
+
+def _write_document(path, texts):
+    """Writes texts as one UTF-8 document, separated by blank lines. Returns their byte ranges as an (n, 2) array."""
+    ranges = np.zeros((len(texts), 2), dtype=np.int64)
+    position = 0
+    with open(path, 'wb') as f:
+        for row, text in enumerate(texts):
+            if row:
+                position += f.write(b"\n\n")
+            ranges[row, 0] = position
+            position += f.write(text.encode('utf-8'))
+            ranges[row, 1] = position
+    return ranges
+
+class EmbeddingSpace:
+    """
+    A corpus's chunk vectors as embedded by one model, and the FAISS index over them.
+
+    Tagged with the embed model and vector dimension, so a query embedded by a different
+    model is rejected instead of silently searched in the wrong space. The vectors are kept
+    in `directory` so the index can be rebuilt in a different mode as the corpus grows, or
+    when the index type can't remove IDs in place, without calling the embedder. They live in
+    an append-only file that is memory-mapped, never loaded: row i holds the vector of chunk
+    `row_ids[i]`, added chunks are appended, and removed chunks' rows stay behind until they
+    outnumber the live ones and a rebuild copies the live rows to a new file. Rows are
+    float16 unless the encoding is float32.
+    """
+    def __init__(self, embed_model, dimension, directory, encoding=None, metric=None):
+        self.embed_model = embed_model
+        self.dimension = dimension
+        self.directory = directory
+        self.encoding = encoding or VECTOR_ENCODING
+        self.metric = metric or VECTOR_METRIC
+        self.index = None
+        self.index_mode = None
+        self.trained_on = 0
+        # The vectors file is `vectors_name`.bin; its row IDs are saved in `vectors_name`.ids.npy.
+        self.vectors_name = None
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self.vectors = None
+
+    @classmethod
+    def build(cls, embed_model, vectors, ids, directory):
+        space = cls(embed_model, vectors.shape[1], directory)
+        space.store_vectors(vectors, ids)
+        space.rebuild(ids)
+        return space
+
+    @property
+    def stored_dtype(self):
+        return np.float32 if self.encoding == "float32" else np.float16
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.directory, self.vectors_name + ".bin")
+
+    @property
+    def row_ids_path(self):
+        return os.path.join(self.directory, self.vectors_name + ".ids.npy")
+
+    @property
+    def row_bytes(self):
+        return self.dimension * np.dtype(self.stored_dtype).itemsize
+
+    def map_vectors(self):
+        """Memory-maps the vectors file's rows (only `row_ids` of them; anything after is unused)."""
+        if not len(self.row_ids):
+            self.vectors = np.zeros((0, self.dimension), dtype=self.stored_dtype)
+            return
+        self.vectors = np.memmap(self.vectors_path, dtype=self.stored_dtype, mode='r', shape=(len(self.row_ids), self.dimension))
+
+    def store_vectors(self, vectors, ids, rows=None):
+        """Starts a new vectors file holding `vectors` (or rows `rows` of them) for chunks `ids`."""
+        os.makedirs(self.directory, exist_ok=True)
+        used = [int(m.group(1)) for m in map(re.compile(r'vectors-(\d+)\.').match, os.listdir(self.directory)) if m]
+        self.vectors_name = f"vectors-{max(used, default=-1) + 1}"
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self._append(vectors, ids, rows)
+
+    def _append(self, vectors, ids, rows=None):
+        # Written after the rows in use, over anything a failed update left there, so a space
+        # sharing this file (see rebuilt) never sees its rows change.
+        with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'wb') as f:
+            f.seek(len(self.row_ids) * self.row_bytes)
+            for start in range(0, len(ids), VECTOR_BLOCK_ROWS):
+                select = slice(start, start + VECTOR_BLOCK_ROWS)
+                block = vectors[select] if rows is None else vectors[rows[select]]
+                f.write(np.ascontiguousarray(block, dtype=self.stored_dtype).tobytes())
+        self.row_ids = np.concatenate([self.row_ids, np.asarray(ids, dtype=np.int64)])
+        self.map_vectors()
+
+    def rows_of(self, ids):
+        """The vectors file rows of chunks `ids`, which must be in this space."""
+        return np.searchsorted(self.row_ids, ids)
+
+    def vectors_for(self, ids):
+        """The stored vectors of chunks `ids` as float32."""
+        return np.asarray(self.vectors[self.rows_of(ids)], dtype=np.float32)
+
+    def rebuild(self, ids):
+        started = time.perf_counter()
+        self.index, self.index_mode = build_index(self.vectors, ids, encoding=self.encoding, metric=self.metric, rows=self.rows_of(ids))
+        self.trained_on = len(ids)
+        print(f"Rebuilt {self.index_mode} index over {len(ids)} chunks ({self.embed_model}, {self.encoding}, {self.metric}) "
+              f"in {time.perf_counter() - started:.2f}s.")
+
+    def reencode(self, encoding, metric, ids):
+        """Rebuilds the index with a different vector encoding or metric."""
+        stored_dtype = self.stored_dtype
+        self.encoding = encoding
+        self.metric = metric
+        if self.stored_dtype != stored_dtype:
+            self.store_vectors(self.vectors, ids, self.rows_of(ids))
+        self.rebuild(ids)
+
+    def _needs_rebuild(self, count, removing):
+        # Switch modes as the corpus crosses a size threshold (compared with the mode that was
+        # actually built, so a forced mode that fell back for lack of data doesn't rebuild on
+        # every add), retrain IVF centroids and SQ8 value ranges once the corpus has doubled
+        # since they were trained, and rebuild HNSW graphs, which don't support deletion.
+        if effective_index_mode(count) != self.index_mode:
+            return True
+        if removing and self.index_mode == "hnsw":
+            return True
+        trained = self.index_mode in ("ivf", "ivfpq") or self.encoding == "sq8"
+        return trained and count > 2 * self.trained_on
+
+    def rebuilt(self, keep, vectors, all_ids):
+        """
+        Returns a new space holding the rows in the `keep` mask plus `vectors` (None if there
+        are none to add) if that change needs a full rebuild, or None if apply() can make it in
+        place. `all_ids` are the corpus's chunk IDs after the change. This space is left as it
+        is, so searches can go on using it while the rebuild runs. A rebuild is also how the
+        vectors file sheds removed chunks' rows, once they would outnumber the live ones.
+        """
+        if vectors is not None and vectors.shape[1] != self.dimension:
+            raise ValueError(f"{self.embed_model} vectors have dimension {self.dimension}, got {vectors.shape[1]}.")
+        removed = len(keep) - int(np.count_nonzero(keep))
+        compact = len(self.row_ids) - self.index.ntotal + removed > len(all_ids)
+        if not compact and not self._needs_rebuild(len(all_ids), removed > 0):
+            return None
+        space = EmbeddingSpace(self.embed_model, self.dimension, self.directory, self.encoding, self.metric)
+        kept_ids = all_ids[:len(all_ids) - (len(vectors) if vectors is not None else 0)]
+        if compact:
+            space.store_vectors(self.vectors, kept_ids, self.rows_of(kept_ids))
+        else:
+            # Share this space's file; appending after its rows leaves them as they are.
+            space.vectors_name = self.vectors_name
+            space.row_ids = self.row_ids
+            space.vectors = self.vectors
+        if vectors is not None:
+            space._append(vectors, all_ids[len(kept_ids):])
+        space.rebuild(all_ids)
+        return space
+
+    def apply(self, keep, removed_ids, vectors, new_ids):
+        """Drops the rows not in the `keep` mask and adds `vectors` (if any) for `new_ids`, in place."""
+        if not keep.all():
+            self.index.remove_ids(removed_ids)
+        if vectors is not None:
+            self._append(vectors, new_ids)
+            self.index.add_with_ids(prepare_vectors(vectors, self.metric), new_ids)
+
+class Corpus:
+    """
+    The indexed documents: chunk store, sources and one or more embedding spaces, persisted under `directory`.
+
+    Every chunk has a stable integer ID, which is also its ID in each FAISS index, and each
+    source owns a contiguous ID range. Adding a document embeds only that document and
+    removing one drops its IDs from the indexes, so neither re-embeds the rest of the corpus.
+    Each embed model the notebook has been used with gets its own EmbeddingSpace covering
+    every chunk; `embed_model` names the active one, and retrieval embeds queries with that
+    model. Selecting a model whose space doesn't exist yet builds it in the background.
+
+    Chunk texts aren't held as strings. Each source's extracted text is stored once as a
+    UTF-8 file in `docs/`, and a chunk is a (doc, page, start, end) record in
+    `chunk_records` whose byte range is sliced out of the memory-mapped file when needed,
+    so overlapping chunks share their text and memory use is a few bytes per chunk plus
+    whatever the OS keeps cached.
+
+    On disk each space is an `index.faiss` written with faiss.write_index plus its vectors
+    file (see EmbeddingSpace), under `spaces/<embed model>/`. The chunk IDs
+    and records are `.npy` files next to a BM25 keyword index in `keywords.npz` and a
+    `manifest.json` describing the rest. The manifest is written last and files it no
+    longer references are removed after it, so an interrupted save leaves the previous
+    corpus loadable. Loading is lazy: nothing is read until the corpus is first used.
+    """
+    MANIFEST_VERSION = 8
+
+    def __init__(self, directory):
+        self.directory = directory
+        # `lock` guards the in-memory state and is only held briefly; `write_lock` serializes
+        # writers for the whole of an update, so searches never wait on embedding.
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        # Bumped on every change, so cached retrieval results can tell they are stale.
+        self.version = 0
+        # Embed model -> future of a space being built in the background.
+        self.building = {}
+        # Requests currently reading the corpus (see in_use); it isn't unloaded while any are.
+        self.users = 0
+        # Doc ID -> mmap of its text file, least recently used first.
+        self.mapped = collections.OrderedDict()
+        self._reset()
+
+    def _reset(self):
+        self._unmap_documents()
+        self.loaded = False
+        self.spaces = {}
+        self.chunk_ids = np.zeros(0, dtype=np.int64)
+        self.chunk_records = np.zeros(0, dtype=CHUNK_RECORD_DTYPE)
+        self.keywords = KeywordIndex()
+        self.sources = []
+        self.next_id = 0
+        self.next_doc_id = 0
+        self.model = DEFAULT_MODEL
+        self.embed_model = MODEL_OPTIONS[DEFAULT_MODEL]['embed']
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _document_path(self, doc_id):
+        return self._path(os.path.join("docs", f"{doc_id}.txt"))
+
+    def _space_directory(self, embed_model):
+        return self._path(os.path.join("spaces", re.sub(r'[^A-Za-z0-9_.-]', '_', embed_model)))
+
+    @property
+    def source_names(self):
+        return [source['name'] for source in self.sources]
+
+    def source_for_hash(self, sha256):
+        """The name of the indexed source whose file content has this SHA-256, or None."""
+        self.ensure_loaded()
+        for source in self.sources:
+            if source.get('sha256') == sha256:
+                return source['name']
+        return None
+
+    @property
+    def index(self):
+        """The active space's FAISS index, or None while nothing is indexed."""
+        space = self.spaces.get(self.embed_model)
+        return space.index if space is not None else None
+
+    def _document(self, doc_id):
+        mapped = self.mapped.get(doc_id)
+        if mapped is not None:
+            self.mapped.move_to_end(doc_id)
+            return mapped
+        with open(self._document_path(doc_id), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mapped[doc_id] = mapped
+        while len(self.mapped) > MAX_MAPPED_DOCUMENTS:
+            self.mapped.popitem(last=False)[1].close()
+        return mapped
+
+    def _unmap_documents(self, doc_ids=None):
+        for doc_id in list(self.mapped) if doc_ids is None else doc_ids:
+            mapped = self.mapped.pop(doc_id, None)
+            if mapped is not None:
+                mapped.close()
+
+    def chunk_texts(self, ids):
+        """Returns the texts of chunks `ids`, sliced out of their memory-mapped documents."""
+        with self.lock:
+            records = self.chunk_records[np.searchsorted(self.chunk_ids, ids)]
+            return [self._document(int(doc))[start:end].decode('utf-8')
+                    for doc, start, end in zip(records['doc'].tolist(), records['start'].tolist(), records['end'].tolist())]
+
+    def _stored_texts(self, records):
+        """
+        Yields the texts of chunk `records` read from their document files one at a time.
+        Unlike chunk_texts it doesn't touch the shared document maps, so writers can use it
+        without holding `lock`.
+        """
+        f, open_doc = None, None
+        try:
+            for doc, start, end in zip(records['doc'].tolist(), records['start'].tolist(), records['end'].tolist()):
+                if doc != open_doc:
+                    if f is not None:
+                        f.close()
+                    f, open_doc = open(self._document_path(doc), 'rb'), doc
+                f.seek(start)
+                yield f.read(end - start).decode('utf-8')
+        finally:
+            if f is not None:
+                f.close()
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                try:
+                    self._load()
+                except Exception as e:
+                    print(f"Error loading saved corpus from {self.directory}: {e}")
+                self.loaded = True
+        return self
+
+    @contextlib.contextmanager
+    def in_use(self):
+        """Loads the corpus and keeps it from being unloaded until the block exits."""
+        with self.lock:
+            self.users += 1
+        try:
+            yield self.ensure_loaded()
+        finally:
+            with self.lock:
+                self.users -= 1
+
+    def unload(self):
+        """
+        Drops the in-memory state; everything is saved, so the next use reloads it from disk.
+        Returns False, leaving the corpus loaded, while a write is in progress or a request
+        is using it.
+        """
+        if not self.write_lock.acquire(blocking=False):
+            return False
+        try:
+            with self.lock:
+                if self.users:
+                    return False
+                self._reset()
+            return True
+        finally:
+            self.write_lock.release()
+
+    def _load(self):
+        manifest_path = self._path("manifest.json")
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        version = manifest.get('version')
+        if version == 5:
+            # Version 5 kept its single space's files at the top level.
+            manifest['spaces'] = {manifest['embed_model']: {
+                "path": "", "dimension": manifest['dimension'],
+                "index_mode": manifest['index_mode'], "trained_on": manifest['trained_on']}}
+        elif version not in (6, 7, self.MANIFEST_VERSION):
+            print(f"Ignoring saved corpus with unsupported manifest version {version}.")
+            return
+
+        started = time.perf_counter()
+        ids = np.load(self._path("chunks.ids.npy"))
+        keywords = KeywordIndex.load(self._path("keywords.npz"))
+        if version in (7, self.MANIFEST_VERSION):
+            records = np.load(self._path("chunks.records.npy"))
+        else:
+            records = self._migrate_chunk_store(manifest['sources'], ids)
+            manifest['next_doc_id'] = len(manifest['sources'])
+
+        spaces = {}
+        reencoded = False
+        for embed_model, entry in manifest['spaces'].items():
+            # Spaces saved before encodings were configurable are float32 L2.
+            space = EmbeddingSpace(embed_model, entry['dimension'], self._space_directory(embed_model),
+                                   entry.get('encoding', "float32"), entry.get('metric', "l2"))
+            space_dir = self._path(entry['path'])
+            space.index = faiss.read_index(os.path.join(space_dir, "index.faiss"))
+            space.index_mode = entry['index_mode']
+            space.trained_on = entry['trained_on']
+            consistent = space.index.ntotal == len(ids) == len(records) and space.index.d == space.dimension
+            if version == self.MANIFEST_VERSION:
+                space.vectors_name = entry['vectors']
+                # Rows are only ever appended to a vectors file, so later saves' row IDs start with these.
+                space.row_ids = np.load(space.row_ids_path)[:entry['rows']]
+                stored_rows = os.path.getsize(space.vectors_path) // space.row_bytes if os.path.exists(space.vectors_path) else 0
+                consistent = consistent and len(space.row_ids) == entry['rows'] >= len(ids) and stored_rows >= entry['rows']
+            else:
+                # Earlier versions saved a .npy copy of the vectors, row-aligned with the chunk IDs.
+                old_vectors = np.load(os.path.join(space_dir, "vectors.npy"), mmap_mode='r')
+                stored_rows = len(old_vectors)
+                consistent = consistent and stored_rows == len(ids)
+            if not consistent:
+                print(f"Saved {embed_model} index is inconsistent ({space.index.ntotal} indexed, "
+                      f"{stored_rows} vectors, {len(ids)} chunks); ignoring it.")
+                continue
+            if version == self.MANIFEST_VERSION:
+                space.map_vectors()
+            else:
+                space.store_vectors(old_vectors, ids)
+            if (space.encoding, space.metric) != (VECTOR_ENCODING, VECTOR_METRIC):
+                print(f"Re-encoding the {embed_model} index from {space.encoding}/{space.metric} "
+                      f"to {VECTOR_ENCODING}/{VECTOR_METRIC}.")
+                space.reencode(VECTOR_ENCODING, VECTOR_METRIC, ids)
+                reencoded = True
+            apply_search_params(space.index)
+            spaces[embed_model] = space
+        if manifest['embed_model'] not in spaces:
+            print(f"Saved corpus has no usable {manifest['embed_model']} index; ignoring it.")
+            return
+
+        self.spaces = spaces
+        self.chunk_ids = ids
+        self.chunk_records = records
+        self.keywords = keywords
+        self.sources = manifest['sources']
+        self.next_id = manifest['next_id']
+        self.next_doc_id = manifest['next_doc_id']
+        self.model = manifest.get('model', DEFAULT_MODEL)
+        self.embed_model = manifest['embed_model']
+        modes = ", ".join(f"{space.index_mode} ({name})" for name, space in spaces.items())
+        print(f"Loaded saved corpus: {len(ids)} chunks from {len(self.sources)} source(s), "
+              f"{modes} index, in {time.perf_counter() - started:.2f}s.")
+        if version != self.MANIFEST_VERSION or reencoded:
+            self._save_quietly()
+
+    def _migrate_chunk_store(self, sources, ids):
+        """
+        Converts the chunk store of a version 5 or 6 save, where chunk texts were concatenated
+        in `chunks.bin`. The original documents weren't kept, so each source's document is
+        rebuilt from its chunk texts.
+        """
+        offsets = np.load(self._path("chunks.offsets.npy"))
+        spans = np.load(self._path("chunks.spans.npy"))
+        records = np.zeros(len(ids), dtype=CHUNK_RECORD_DTYPE)
+        records['page'] = spans['page']
+        os.makedirs(self._path("docs"), exist_ok=True)
+        with open(self._path("chunks.bin"), 'rb') as f:
+            blob = f.read()
+        for doc_id, source in enumerate(sources):
+            source['doc_id'] = doc_id
+            rows = np.flatnonzero((ids >= source['first_id']) & (ids < source['first_id'] + source['count']))
+            if not len(rows):
+                continue
+            texts = [blob[offsets[row]:offsets[row + 1]].decode('utf-8') for row in rows.tolist()]
+            ranges = _write_document(self._document_path(doc_id), texts)
+            records['doc'][rows] = doc_id
+            records['start'][rows] = ranges[:, 0]
+            records['end'][rows] = ranges[:, 1]
+        print(f"Moved {len(ids)} chunks of {self.directory} into per-document text files.")
+        return records
+
+    def save(self):
+        with self.lock:
+            if self.index is None:
+                # Nothing left to keep; drop the saved files so a restart starts empty too.
+                self._unmap_documents()
+                shutil.rmtree(self.directory, ignore_errors=True)
+                return
+            os.makedirs(self.directory, exist_ok=True)
+
+            def write_array(array):
+                def write(path):
+                    with open(path, 'wb') as f:
+                        np.save(f, array)
+                return write
+
+            for space in self.spaces.values():
+                # The vectors file is written as rows are added; only its row IDs are saved here.
+                os.makedirs(space.directory, exist_ok=True)
+                _atomic_write(os.path.join(space.directory, "index.faiss"), lambda path: faiss.write_index(space.index, path))
+                _atomic_write(space.row_ids_path, write_array(space.row_ids))
+            _atomic_write(self._path("chunks.ids.npy"), write_array(self.chunk_ids))
+            _atomic_write(self._path("chunks.records.npy"), write_array(self.chunk_records))
+            _atomic_write(self._path("keywords.npz"), self.keywords.save)
+            self._write_manifest()
+
+            # Clean up spaces and documents that are no longer referenced, and the files of older versions.
+            kept_dirs = {os.path.basename(space.directory) for space in self.spaces.values()}
+            for name in os.listdir(self._path("spaces")):
+                if name not in kept_dirs:
+                    shutil.rmtree(self._path(os.path.join("spaces", name)), ignore_errors=True)
+            for space in self.spaces.values():
+                for name in os.listdir(space.directory):
+                    if name.startswith("vectors") and name.split('.')[0] != space.vectors_name:
+                        try:
+                            os.remove(os.path.join(space.directory, name))
+                        except OSError as e:
+                            print(f"Could not remove unused vectors {name}: {e}")
+            kept_docs = {f"{source['doc_id']}.txt" for source in self.sources}
+            for name in os.listdir(self._path("docs")) if os.path.isdir(self._path("docs")) else []:
+                if name not in kept_docs:
+                    stem = name.split('.')[0]
+                    if stem.isdigit():
+                        self._unmap_documents([int(stem)])
+                    try:
+                        os.remove(self._path(os.path.join("docs", name)))
+                    except OSError as e:
+                        print(f"Could not remove unused document {name}: {e}")
+            for name in ("index.faiss", "vectors.npy", "chunks.bin", "chunks.offsets.npy", "chunks.spans.npy"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+
+    def _write_manifest(self):
+        def write_manifest(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "version": self.MANIFEST_VERSION,
+                    "model": self.model,
+                    "embed_model": self.embed_model,
+                    "spaces": {name: {"path": os.path.join("spaces", os.path.basename(space.directory)),
+                                      "dimension": space.dimension, "index_mode": space.index_mode,
+                                      "trained_on": space.trained_on, "encoding": space.encoding, "metric": space.metric,
+                                      "vectors": space.vectors_name, "rows": len(space.row_ids)}
+                               for name, space in self.spaces.items()},
+                    "chunk_count": len(self.chunk_ids),
+                    "next_id": self.next_id,
+                    "next_doc_id": self.next_doc_id,
+                    "sources": self.sources,
+                    "saved_at": time.time(),
+                }, f, indent=2)
+
+        _atomic_write(self._path("manifest.json"), write_manifest)
+
+    def _save_quietly(self):
+        try:
+            self.save()
+        except Exception as e:
+            print(f"Error saving corpus to {self.directory}: {e}")
+
+    @staticmethod
+    def _source_ids(sources):
+        if not sources:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(s['first_id'], s['first_id'] + s['count'], dtype=np.int64) for s in sources])
+
+    def _drop_ids(self, keep):
+        """Removes the chunks not in the `keep` mask from the chunk store and keyword index."""
+        if keep.all():
+            return
+        self.keywords.remove(self.chunk_ids[~keep].tolist(), self.chunk_texts(self.chunk_ids[~keep]))
+        self.chunk_ids = self.chunk_ids[keep]
+        self.chunk_records = self.chunk_records[keep]
+
+    def _rebuild_spaces(self, keep, space_vectors, all_ids):
+        """
+        Builds replacements for the spaces that a change (keeping the chunks in the `keep` mask
+        and adding `space_vectors`, {embed model: vectors}) can't be applied to in place.
+        Runs under `write_lock` only, so searches carry on against the current spaces while
+        a full rebuild runs; _update_spaces then swaps the results in. Returns {embed model: space}.
+        """
+        if not len(all_ids):
+            return {}
+        rebuilt = {}
+        for name, space in self.spaces.items():
+            replacement = space.rebuilt(keep, space_vectors.get(name), all_ids)
+            if replacement is not None:
+                rebuilt[name] = replacement
+        return rebuilt
+
+    def _update_spaces(self, keep, removed_ids, space_vectors, new_ids, rebuilt):
+        """Applies a change to every space under `lock`: in place, or by swapping in its rebuilt replacement."""
+        if not len(self.chunk_ids):
+            self.spaces = {}
+            return
+        for name, space in self.spaces.items():
+            if name not in rebuilt:
+                space.apply(keep, removed_ids, space_vectors.get(name), new_ids)
+        self.spaces.update(rebuilt)
+
+    def _store_document(self, doc_id, chunks, text_path=None):
+        """
+        Stores a document's text under `doc_id` and returns the records of its chunks.
+        `text_path` is the document's extracted text, which the chunks' character spans
+        refer to; it is moved into the corpus, and the chunks may be given as just their
+        spans (a CHUNK_SPAN_DTYPE array). Without it the document is rebuilt from the chunk texts.
+        """
+        path = self._document_path(doc_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not isinstance(chunks, np.ndarray):
+            chunks = [chunk if isinstance(chunk, Chunk) else Chunk(chunk, None, -1, -1) for chunk in chunks]
+        records = np.zeros(len(chunks), dtype=CHUNK_RECORD_DTYPE)
+        records['doc'] = doc_id
+        if text_path is not None:
+            spans = chunks if isinstance(chunks, np.ndarray) else np.array(
+                [(chunk.page or 0, chunk.start, chunk.end) for chunk in chunks], dtype=CHUNK_SPAN_DTYPE)
+            records['page'] = spans['page']
+            os.replace(text_path, path)
+            ranges = _utf8_offsets(path, np.column_stack([spans['start'], spans['end']]).ravel()).reshape(-1, 2)
+        else:
+            records['page'] = [chunk.page or 0 for chunk in chunks]
+            ranges = _write_document(path, [chunk.text for chunk in chunks])
+        records['start'] = ranges[:, 0]
+        records['end'] = ranges[:, 1]
+        return records
+
+    def add_documents(self, documents, model, embed_model, vectors=None):
+        """
+        Embeds and indexes `documents`, a list of (name, chunks), (name, chunks, text_path) or
+        (name, chunks, text_path, sha256), next to the existing sources. Chunks are Chunk
+        records whose spans index into the text file at `text_path` (or just those spans, as
+        a CHUNK_SPAN_DTYPE array), or plain strings when there is no provenance to keep.
+        A document whose name is already indexed replaces the old copy. The new chunks are
+        embedded into every existing space, so each stays complete, and `embed_model`
+        becomes the active space (built from the kept sources too if it is new). `vectors`
+        may carry embeddings of all the new chunks, in order, already made with `embed_model`.
+        The documents are stored first and chunk texts are read back from them as needed, so
+        an upload's texts are never all held in memory at once.
+        """
+        with self.write_lock:
+            # Loaded under write_lock, which unload() needs, so the corpus can't be evicted mid-write.
+            self.ensure_loaded()
+            names = {document[0] for document in documents}
+            kept = [s for s in self.sources if s['name'] not in names]
+            replaced = [s for s in self.sources if s['name'] in names]
+            replaced_ids = self._source_ids(replaced)
+            new_count = sum(len(document[1]) for document in documents)
+            new_ids = np.arange(self.next_id, self.next_id + new_count, dtype=np.int64)
+
+            new_sources = []
+            new_records = [np.zeros(0, dtype=CHUNK_RECORD_DTYPE)]
+            next_id = self.next_id
+            next_doc_id = self.next_doc_id
+            for document in documents:
+                text_path = document[2] if len(document) > 2 else None
+                if len(document[1]):
+                    new_records.append(self._store_document(next_doc_id, document[1], text_path))
+                elif text_path is not None and os.path.exists(text_path):
+                    os.remove(text_path)
+                source = {"name": document[0], "first_id": next_id, "count": len(document[1]), "doc_id": next_doc_id}
+                if len(document) > 3:
+                    source["sha256"] = document[3]
+                new_sources.append(source)
+                next_id += len(document[1])
+                next_doc_id += 1
+            new_records = np.concatenate(new_records)
+
+            space_vectors = {}
+            if new_count:
+                space_vectors[embed_model] = (np.asarray(vectors, dtype=np.float32) if vectors is not None
+                                              else embed_chunks(self._stored_texts(new_records), embed_model, new_count))
+                for other in self.spaces:
+                    if other != embed_model:
+                        space_vectors[other] = embed_chunks(self._stored_texts(new_records), other, new_count)
+            keep = ~np.isin(self.chunk_ids, replaced_ids)
+            all_ids = np.concatenate([self.chunk_ids[keep], new_ids])
+            rebuilt = self._rebuild_spaces(keep, space_vectors, all_ids)
+            if embed_model not in self.spaces and len(all_ids):
+                if keep.any():
+                    print(f"No {embed_model} index yet; embedding the kept sources with it.")
+                    kept_vectors = embed_chunks(self._stored_texts(self.chunk_records[keep]), embed_model, int(keep.sum()))
+                    if new_count:
+                        kept_vectors = np.concatenate([kept_vectors, space_vectors[embed_model]])
+                else:
+                    kept_vectors = space_vectors[embed_model]
+                rebuilt[embed_model] = EmbeddingSpace.build(embed_model, kept_vectors, all_ids, self._space_directory(embed_model))
+
+            with self.lock:
+                self._drop_ids(keep)
+                if new_count:
+                    self.keywords.add(new_ids.tolist(), self._stored_texts(new_records))
+                    self.chunk_ids = all_ids
+                    self.chunk_records = np.concatenate([self.chunk_records, new_records])
+                self._update_spaces(keep, replaced_ids, space_vectors, new_ids, rebuilt)
+                self.sources = kept + new_sources
+                self.next_id = next_id
+                self.next_doc_id = next_doc_id
+                self.model = model
+                self.embed_model = embed_model
+                self.version += 1
+                self._save_quietly()
+            return new_count
+
+    def select_model(self, model):
+        """
+        Makes `model` the notebook's chat model. Returns "ready" when its embed model's space
+        is active, or "building" while that space is embedded in the background; retrieval
+        keeps using the previous space, which is still consistent, until it is done.
+        """
+        embed_model = MODEL_OPTIONS[model]['embed']
+        with self.ensure_loaded().lock:
+            self.model = model
+            if embed_model in self.spaces or self.index is None:
+                if self.embed_model != embed_model:
+                    self.embed_model = embed_model
+                    self.version += 1
+                if self.index is not None:
+                    self._write_manifest()
+                return "ready"
+            if embed_model not in self.building:
+                self.building[embed_model] = ingest_executor.submit(self._build_space, embed_model)
+            return "building"
+
+    def _build_space(self, embed_model):
+        try:
+            with self.write_lock:
+                self.ensure_loaded()
+                ids = self.chunk_ids
+                started = time.perf_counter()
+                vectors = embed_chunks(self._stored_texts(self.chunk_records), embed_model, len(ids))
+                space = EmbeddingSpace.build(embed_model, vectors, ids, self._space_directory(embed_model))
+                with self.lock:
+                    self.spaces[embed_model] = space
+                    # Activate it unless the user has moved on to another model meanwhile.
+                    if MODEL_OPTIONS.get(self.model, {}).get('embed') == embed_model:
+                        self.embed_model = embed_model
+                    self.version += 1
+                    self._save_quietly()
+                print(f"Built {embed_model} space for {self.directory} in {time.perf_counter() - started:.2f}s.")
+        except Exception as e:
+            print(f"Error building {embed_model} space for {self.directory}: {e}")
+        finally:
+            with self.lock:
+                self.building.pop(embed_model, None)
+
+    def remove_source(self, name):
+        """Drops a source and its chunks from the index. Returns False if no such source exists."""
+        with self.write_lock:
+            self.ensure_loaded()
+            removed = [s for s in self.sources if s['name'] == name]
+            if not removed:
+                return False
+            removed_ids = self._source_ids(removed)
+            keep = ~np.isin(self.chunk_ids, removed_ids)
+            rebuilt = self._rebuild_spaces(keep, {}, self.chunk_ids[keep])
+            with self.lock:
+                self._drop_ids(keep)
+                self._update_spaces(keep, removed_ids, {}, None, rebuilt)
+                self.sources = [s for s in self.sources if s['name'] != name]
+                self.version += 1
+                self._save_quietly()
+            return True
+
+    def search(self, query_vectors, k, embed_model=None):
+        """
+        Returns, for each query vector, a list of (chunk id, distance, text) for its k nearest
+        chunks in the `embed_model` space (the active one by default); under the cosine metric
+        the "distance" is a similarity, higher for closer chunks. Raises ValueError if there is
+        no such space or the query vectors don't match its dimension.
+        """
+        with self.ensure_loaded().lock:
+            if self.index is None:
+                return [[] for _ in range(len(query_vectors))]
+            space = self.spaces.get(embed_model or self.embed_model)
+            if space is None:
+                raise ValueError(f"This notebook has no {embed_model} index.")
+            if query_vectors.shape[1] != space.dimension:
+                raise ValueError(f"Query has dimension {query_vectors.shape[1]}, but the "
+                                 f"{space.embed_model} index has dimension {space.dimension}.")
+            with metrics.span("faiss_search"):
+                distances, ids = space.index.search(prepare_vectors(query_vectors, space.metric), k)
+            results = []
+            for row_d, row_i in zip(distances, ids):
+                found = row_i >= 0
+                results.append(list(zip(row_i[found].tolist(), row_d[found].tolist(), self.chunk_texts(row_i[found]))))
+            return results
+
+    def chunk_details(self, ids, embed_model=None):
+        """
+        Returns (found, records, vectors) for chunks `ids`: a mask of the ones still in the
+        corpus and, for those, their records and stored vectors in the `embed_model` space
+        (the active one by default; None if there is no such space).
+        """
+        with self.ensure_loaded().lock:
+            if not len(self.chunk_ids):
+                return np.zeros(len(ids), dtype=bool), self.chunk_records, None
+            rows = np.minimum(np.searchsorted(self.chunk_ids, ids), len(self.chunk_ids) - 1)
+            found = self.chunk_ids[rows] == ids
+            rows = rows[found]
+            space = self.spaces.get(embed_model or self.embed_model)
+            vectors = space.vectors_for(self.chunk_ids[rows]) if space is not None else None
+            return found, self.chunk_records[rows], vectors
+
+    def document_text(self, doc_id, start, end):
+        """Returns bytes start:end of a stored document as text."""
+        with self.lock:
+            return self._document(doc_id)[start:end].decode('utf-8')
+
+    def keyword_search(self, query, k):
+        """Returns a list of (chunk id, BM25 score, text) for the k best keyword matches."""
+        with self.ensure_loaded().lock:
+            with metrics.span("keyword_search"):
+                hits = self.keywords.search(query, k)
+            texts = self.chunk_texts(np.array([chunk_id for chunk_id, _ in hits], dtype=np.int64))
+            return [(chunk_id, score, text) for (chunk_id, score), text in zip(hits, texts)]
+
+class NotebookRegistry:
+    """
+    Named notebooks, each an independent Corpus (index, chunks and model choice) in its own
+    directory under `directory`. Corpora load lazily on first use; once more than `max_loaded`
+    are in memory the least recently used one is unloaded and reloads the next time it is
+    asked for. Eviction counts notebooks rather than bytes, so one large corpus can't push
+    every other notebook out of memory.
+    """
+    def __init__(self, directory, max_loaded):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self.corpora = {}
+        self.recent = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def valid_name(name):
+        return bool(name) and NOTEBOOK_NAME_RE.fullmatch(name) is not None
+
+    def names(self):
+        on_disk = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        with self.lock:
+            names = {name for name in on_disk if self.valid_name(name)} | set(self.recent)
+        return sorted(names | {DEFAULT_NOTEBOOK})
+
+    def get(self, name):
+        """Returns the notebook's Corpus, creating it if it's new. Raises ValueError for a bad name."""
+        if not self.valid_name(name):
+            raise ValueError(f"Invalid notebook name '{name}'. Use up to 64 letters, digits, '-' or '_'.")
+        with self.lock:
+            corpus = self.corpora.get(name)
+            if corpus is None:
+                corpus = self.corpora[name] = Corpus(os.path.join(self.directory, name))
+            self.recent[name] = corpus
+            self.recent.move_to_end(name)
+            self._evict()
+        return corpus
+
+    def _evict(self):
+        # Oldest first; a notebook in the middle of a write stays loaded and is retried next time.
+        for name in list(self.recent)[:-1]:
+            if len(self.recent) <= self.max_loaded:
+                break
+            corpus = self.recent[name]
+            if not corpus.loaded or corpus.unload():
+                del self.recent[name]
+                print(f"Unloaded notebook '{name}' from memory.")
+
+    def delete(self, name):
+        """Removes a notebook and its saved files. Returns False if it doesn't exist."""
+        if not self.valid_name(name) or name not in self.names():
+            return False
+        corpus = self.get(name)
+        with corpus.write_lock, corpus.lock:
+            # The Corpus object itself is kept, so its version keeps counting up and
+            # cached results for the deleted notebook can't be served under the same name.
+            corpus._reset()
+            corpus.version += 1
+            shutil.rmtree(corpus.directory, ignore_errors=True)
+            with self.lock:
+                self.recent.pop(name, None)
+        return True
+
+if os.path.isdir(LEGACY_CORPUS_DIR) and not os.path.exists(os.path.join(NOTEBOOKS_DIR, DEFAULT_NOTEBOOK)):
+    os.makedirs(NOTEBOOKS_DIR, exist_ok=True)
+    os.replace(LEGACY_CORPUS_DIR, os.path.join(NOTEBOOKS_DIR, DEFAULT_NOTEBOOK))
+    print("Moved the saved corpus into the default notebook.")
+
+notebooks = NotebookRegistry(NOTEBOOKS_DIR, MAX_LOADED_NOTEBOOKS)
+
+class QueryCache:
+    """A thread-safe in-memory LRU cache whose entries expire after `ttl` seconds. Tracks its hit rate."""
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else None}
+
+query_embedding_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+retrieval_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+def embed_query(query, embed_model):
+    """Embeds a (normalized) query as a 1 x d float32 matrix, reusing cached embeddings."""
+    key = (embed_model, query.casefold())
+    vector = query_embedding_cache.get(key)
+    if vector is None:
+        vector = np.asarray(embed_backend(embed_model, [query]), dtype=np.float32)
+        query_embedding_cache.put(key, vector)
+    return vector
+
+query_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="query-embed")
+
+def reciprocal_rank_fusion(rankings, k):
+    """Merges ranked lists of (chunk id, score, text) by summing 1 / (RRF_K + rank) per chunk."""
+    fused = {}
+    texts = {}
+    for ranking in rankings:
+        for rank, (chunk_id, _, text) in enumerate(ranking, start=1):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank)
+            texts[chunk_id] = text
+    best = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [(chunk_id, fused[chunk_id], texts[chunk_id]) for chunk_id in best]
+
+def retrieve(corpus, query, k):
+    """
+    Returns the top-k (chunk id, score, text) hits for `query` in `corpus`: dense and BM25
+    results fused by reciprocal rank, or dense only when HYBRID_SEARCH is off. Results are
+    cached under the corpus version, so after any add or remove old entries simply stop
+    matching and age out of the LRU.
+    """
+    query = normalize_query(query)
+    # Read once: the query must be embedded and searched in the same space even if the active one changes.
+    with corpus.ensure_loaded().lock:
+        embed_model, version = corpus.embed_model, corpus.version
+    key = (corpus.directory, version, embed_model, query.casefold(), k)
+    hits = retrieval_cache.get(key)
+    if hits is not None:
+        return hits
+    if not HYBRID_SEARCH:
+        hits = corpus.search(embed_query(query, embed_model), k, embed_model)[0]
+        retrieval_cache.put(key, hits)
+        return hits
+
+    # Start the embedding first and score keywords while it runs.
+    embedding = query_executor.submit(embed_query, query, embed_model)
+    keyword_hits = corpus.keyword_search(query, HYBRID_CANDIDATES)
+    try:
+        query_vector = embedding.result(timeout=QUERY_EMBED_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # Don't cache this: once the embedder catches up the full hybrid result should be used.
+        print(f"Query embedding took over {QUERY_EMBED_TIMEOUT}s; answering from keyword matches only.")
+        return keyword_hits[:k]
+    dense_hits = corpus.search(query_vector, HYBRID_CANDIDATES, embed_model)[0]
+    hits = reciprocal_rank_fusion([dense_hits, keyword_hits], k)
+    retrieval_cache.put(key, hits)
+    return hits
+
+def dedupe_candidates(hits, records, vectors):
+    """
+    Returns the indexes of `hits` worth keeping, in rank order. A hit is dropped when it lies
+    mostly inside a better-ranked chunk of the same document, or is a near-identical vector
+    of one (identical text, when there are no vectors to compare).
+    """
+    kept = []
+    seen_texts = set()
+    for i, (_, _, text) in enumerate(hits):
+        doc, start, end = records['doc'][i], records['start'][i], records['end'][i]
+        duplicate = False
+        for j in kept:
+            if records['doc'][j] == doc:
+                overlap = min(end, records['end'][j]) - max(start, records['start'][j])
+                if overlap > DEDUPE_CONTAINMENT * (end - start):
+                    duplicate = True
+                    break
+            if vectors is not None and float(vectors[i] @ vectors[j]) >= DEDUPE_SIMILARITY:
+                duplicate = True
+                break
+        if vectors is None:
+            normalized = " ".join(text.split()).casefold()
+            duplicate = duplicate or normalized in seen_texts
+            seen_texts.add(normalized)
+        if not duplicate:
+            kept.append(i)
+    return kept
+
+def mmr_order(candidates, vectors, weight):
+    """
+    Orders `candidates` (hit indexes in rank order) by maximal marginal relevance. Relevance
+    is the retrieval rank scaled to (0, 1], so it works the same for fused, dense and keyword
+    scores; redundancy is the highest cosine similarity to an already chosen candidate.
+    """
+    n = len(candidates)
+    relevance = 1.0 - np.arange(n) / n
+    unit = vectors[candidates]
+    similarity = unit @ unit.T
+    redundancy = np.zeros(n, dtype=np.float32)
+    remaining = list(range(n))
+    order = []
+    while remaining:
+        best = max(remaining, key=lambda p: weight * relevance[p] - (1 - weight) * redundancy[p])
+        remaining.remove(best)
+        order.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return [candidates[p] for p in order]
+
+def term_overlap_scores(query, texts):
+    """A local reranker: the share of the query's distinct search terms (three letters or more) each text contains."""
+    terms = {term for term in keyword_tokens(query) if len(term) > 2}
+    if not terms:
+        return [0.0] * len(texts)
+    return [len(terms & set(keyword_tokens(text))) / len(terms) for text in texts]
+
+# Reranker name -> function(query, texts) returning one score per text, higher is better.
+RERANKERS = {"term-overlap": term_overlap_scores}
+
+def pack_context(corpus, hits, order, records, budget):
+    """
+    Takes hits in `order` until `budget` tokens are used, skipping any that don't fit (the
+    first always does). Chosen chunks of the same document that overlap or touch are merged
+    into a single passage sliced from the document, so shared text is only sent once.
+    Returns the passage texts in order of their best-ranked chunk.
+    """
+    used = 0
+    passages = []
+    for i in order:
+        tokens = approx_tokens(hits[i][2])
+        if passages and used + tokens > budget:
+            continue
+        used += tokens
+        doc, start, end = int(records['doc'][i]), int(records['start'][i]), int(records['end'][i])
+        for passage in passages:
+            if passage['doc'] == doc and start <= passage['end'] and end >= passage['start']:
+                passage['start'] = min(start, passage['start'])
+                passage['end'] = max(end, passage['end'])
+                passage['texts'].append(hits[i][2])
+                break
+        else:
+            passages.append({"doc": doc, "start": start, "end": end, "texts": [hits[i][2]]})
+
+    texts = []
+    for passage in passages:
+        if len(passage['texts']) == 1:
+            texts.append(passage['texts'][0])
+            continue
+        try:
+            texts.append(corpus.document_text(passage['doc'], passage['start'], passage['end']))
+        except (OSError, ValueError):
+            # The document was removed meanwhile; fall back to the chunks themselves.
+            texts.append("\n\n".join(passage['texts']))
+    return texts
+
+def build_context(corpus, query, hits):
+    """
+    Runs retrieved `hits` through the context pipeline: dedupe, MMR, the optional reranker
+    and token-budget packing. Returns (passages, timings), timings in milliseconds by stage.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage):
+        nonlocal started
+        now = time.perf_counter()
+        metrics.record_span(f"context_{stage}", now - started, timings)
+        started = now
+
+    found, records, vectors = corpus.chunk_details(np.array([hit[0] for hit in hits], dtype=np.int64))
+    hits = [hit for hit, ok in zip(hits, found.tolist()) if ok]
+    if vectors is not None:
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    lap("lookup")
+    order = dedupe_candidates(hits, records, vectors)
+    lap("dedupe")
+    if MMR_LAMBDA is not None and vectors is not None and len(order) > 1:
+        order = mmr_order(order, vectors, MMR_LAMBDA)
+        lap("mmr")
+    if RERANKER:
+        head = order[:RERANK_CANDIDATES]
+        scores = RERANKERS[RERANKER](query, [hits[i][2] for i in head])
+        order = [i for _, i in sorted(zip(scores, head), key=lambda pair: -pair[0])] + order[RERANK_CANDIDATES:]
+        lap("rerank")
+    passages = pack_context(corpus, hits, order, records, CONTEXT_TOKEN_BUDGET)
+    lap("pack")
+    print(f"Context: {len(hits)} candidates, {len(order)} after dedupe, {len(passages)} passage(s); "
+          + ", ".join(f"{stage[8:]} {ms:.1f}ms" for stage, ms in timings.items()))
+    return passages, timings
+
+class GenerationScheduler:
+    """
+    Bounds how many chat generations run against the local model at once.
+
+    Requests take a ticket and are admitted strictly in arrival order as slots free up, so a
+    burst of users shares the model fairly instead of thrashing it. finish() releases a
+    slot, or drops a ticket that never got one (e.g. its client went away while waiting).
+    Background calls to the chat model take a slot too, through slot().
+    """
+    def __init__(self, max_active):
+        self.max_active = max_active
+        self.waiting = collections.deque()
+        self.active = set()
+        self.changed = threading.Condition()
+
+    def enqueue(self):
+        ticket = object()
+        with self.changed:
+            self.waiting.append(ticket)
+        return ticket
+
+    def position(self, ticket):
+        """Number of requests queued ahead of this ticket."""
+        with self.changed:
+            return self.waiting.index(ticket) if ticket in self.waiting else 0
+
+    def wait_turn(self, ticket, timeout):
+        """Waits up to `timeout` seconds for the ticket to be admitted. Returns whether it was."""
+        with self.changed:
+            admitted = self.changed.wait_for(
+                lambda: self.waiting[0] is ticket and len(self.active) < self.max_active, timeout=timeout)
+            if admitted:
+                self.waiting.popleft()
+                self.active.add(ticket)
+                self.changed.notify_all()
+            return admitted
+
+    def finish(self, ticket):
+        with self.changed:
+            if ticket in self.active:
+                self.active.discard(ticket)
+            elif ticket in self.waiting:
+                self.waiting.remove(ticket)
+            self.changed.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Waits in line for a slot and holds it for the block."""
+        ticket = self.enqueue()
+        try:
+            self.wait_turn(ticket, timeout=None)
+            yield
+        finally:
+            self.finish(ticket)
+
+    def stats(self):
+        with self.changed:
+            return {"active": len(self.active), "waiting": len(self.waiting), "max_active": self.max_active}
+
+generation_scheduler = GenerationScheduler(MAX_ACTIVE_GENERATIONS)
+
+class ChatSession:
+    """One conversation in a notebook: a rolling summary of older turns plus the recent ones verbatim."""
+    def __init__(self, notebook):
+        self.id = uuid.uuid4().hex
+        self.notebook = notebook
+        self.summary = ""
+        # (question, answer) pairs not yet folded into the summary, oldest first.
+        self.turns = []
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def history(self, budget):
+        """The summary and as many of the newest turns as fit in `budget` tokens, as chat messages."""
+        with self.lock:
+            summary, turns = self.summary, list(self.turns[-HISTORY_RECENT_TURNS:])
+        messages = []
+        if summary:
+            summary = summary[:budget * CHARS_PER_TOKEN]
+            budget -= approx_tokens(summary)
+            messages.append({'role': 'system', 'content': f"Summary of the conversation so far: {summary}"})
+        recent = []
+        for question, answer in reversed(turns):
+            cost = approx_tokens(question) + approx_tokens(answer)
+            if cost > budget:
+                break
+            budget -= cost
+            recent[:0] = [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': answer}]
+        return messages + recent
+
+    def add_turn(self, question, answer, model):
+        with self.lock:
+            self.turns.append((question, answer))
+            if self.summarizing:
+                return
+            # If summarizing keeps failing, forget the oldest turns rather than grow without bound.
+            del self.turns[:-4 * HISTORY_RECENT_TURNS]
+            if len(self.turns) <= HISTORY_RECENT_TURNS:
+                return
+            self.summarizing = True
+        summary_executor.submit(self._summarize, model)
+
+    def _summarize(self, model):
+        with self.lock:
+            summary = self.summary
+            folded = self.turns[:-HISTORY_RECENT_TURNS]
+        transcript = "\n\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in folded)
+        try:
+            # Summaries share the chat model with answers, so they queue for a slot like them.
+            with generation_scheduler.slot():
+                started = time.perf_counter()
+                response = ollama.chat(model=model, keep_alive=OLLAMA_KEEP_ALIVE, messages=[{'role': 'user', 'content': (
+                    f"Update the running summary of a conversation about the user's documents with the new exchanges below. "
+                    f"Keep the facts, names and open questions a follow-up might refer to. "
+                    f"Reply with the summary only, in at most {SUMMARY_MAX_WORDS} words.\n\n"
+                    f"CURRENT SUMMARY:\n{summary or '(none)'}\n\nNEW EXCHANGES:\n{transcript}")}])
+            summary = response['message']['content'].strip()
+        except Exception as e:
+            print(f"Could not summarize session {self.id}: {e}")
+            with self.lock:
+                self.summarizing = False
+            return
+        metrics.record_span("summarize", time.perf_counter() - started)
+        with self.lock:
+            self.summary = summary
+            # Only this thread removes turns, so the folded ones are still the oldest.
+            del self.turns[:len(folded)]
+            self.summarizing = len(self.turns) > HISTORY_RECENT_TURNS
+        if self.summarizing:
+            summary_executor.submit(self._summarize, model)
+
+class ChatSessionStore(QueryCache):
+    """Chat sessions by id, least recently used first out, expiring after `ttl` idle seconds."""
+    def session(self, session_id, notebook):
+        """The live session `session_id` in `notebook`, or a new one when there is none."""
+        session = self.get(session_id) if session_id else None
+        if session is None or session.notebook != notebook:
+            session = ChatSession(notebook)
+        self.put(session.id, session)
+        return session
+
+    def drop_notebook(self, notebook):
+        with self.lock:
+            for session_id in [i for i, (_, s) in self.entries.items() if s.notebook == notebook]:
+                del self.entries[session_id]
+
+chat_sessions = ChatSessionStore(MAX_SESSIONS, SESSION_TTL)
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarize")
+
+SYSTEM_PROMPT = """You are a helpful and precise AI assistant called LocalNote.
+Your task is to answer questions based *only* on the provided document context.
+- Format your answers clearly using Markdown.
+- Be concise and directly answer the user's question.
+- If the answer is not found within the provided context, you MUST state: 'I could not find an answer in the provided document(s).'
+- Do not use any external knowledge or make up information."""
+
+def prompt_prefix(source_names, history):
+    """
+    The messages every prompt in a conversation starts with, most stable first: the fixed
+    instructions, the notebook's sources, then the summary and recent turns from `history`.
+    """
+    source_str = ', '.join(source_names) if source_names else "your sources"
+    return [{'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'system', 'content': f"The context is from the following document(s): {source_str}."}] + history
+
+def rewrite_query(query, prefix, model):
+    """
+    Rewrites a follow-up question into a standalone search query. The request continues the
+    conversation's prompt `prefix`, so it reuses Ollama's prompt cache and leaves it warm for
+    the answer. Falls back to the previous question plus this one if the model can't be asked.
+    The caller must hold a generation slot.
+    """
+    try:
+        response = ollama.chat(model=model, keep_alive=OLLAMA_KEEP_ALIVE, options={'temperature': 0, 'num_predict': 64},
+                               messages=prefix + [{'role': 'user', 'content': (
+            "Rewrite my next question as a standalone search query that can be understood without this "
+            "conversation, resolving pronouns and references. Reply with the query only.\n\n"
+            f"NEXT QUESTION: {query}")}])
+        rewritten = response['message']['content'].strip().strip('"')
+        if rewritten:
+            return rewritten
+    except Exception as e:
+        print(f"Could not rewrite the query: {e}")
+    previous = [message['content'] for message in prefix if message['role'] == 'user']
+    return f"{previous[-1]} {query}" if previous else query
+
+def warm_models(model, embed_model):
+    """Loads a chat model and its embedding model ahead of the first request that needs them."""
+    started = time.perf_counter()
+    try:
+        if model_manager.unavailable_reason(model) is None:
+            # A request without a prompt only loads the model.
+            ollama.generate(model=model, prompt="", keep_alive=OLLAMA_KEEP_ALIVE)
+        if model_manager.unavailable_reason(embed_model) is None:
+            embed_backend(embed_model, ["warm-up"])
+    except Exception as e:
+        print(f"Could not pre-load {model}: {e}")
+        return
+    print(f"Pre-loaded {model} and {embed_model} in {time.perf_counter() - started:.2f}s.")
+
+class _HashingReader(io.RawIOBase):
+    """Reads through a binary stream, feeding every byte read to `digest`."""
+    def __init__(self, stream, digest):
+        self.stream = stream
+        self.digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.digest.update(data)
+        return len(data)
+
+def stage_upload(stream, upload_dir, filename):
+    """
+    Writes a file to `upload_dir` from a binary `stream`, hashing it on the way, and
+    returns (path, sha256). A .txt file is decoded straight from the stream, so what lands
+    on disk is already the text document its chunks will point into; a PDF is saved as is
+    for extraction. Files are named by content hash, so concurrent uploads never clobber.
+    """
+    digest = hashlib.sha256()
+    reader = io.BufferedReader(_HashingReader(stream, digest), TEXT_READ_BLOCK)
+    part_path = os.path.join(upload_dir, f".{uuid.uuid4().hex}.part")
+    try:
+        if filename.endswith('.txt'):
+            # The same decoding as reading a saved .txt: UTF-8, bad bytes dropped, universal newlines.
+            text = io.TextIOWrapper(reader, encoding='utf-8', errors='ignore')
+            with open(part_path, 'w', encoding='utf-8', newline='') as out:
+                while True:
+                    block = text.read(TEXT_READ_BLOCK)
+                    if not block:
+                        break
+                    out.write(block)
+        else:
+            with open(part_path, 'wb') as out:
+                shutil.copyfileobj(reader, out, TEXT_READ_BLOCK)
+        sha256 = digest.hexdigest()
+        path = os.path.join(upload_dir, f"{sha256[:16]}-{filename}")
+        os.replace(part_path, path)
+        return path, sha256
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+def unique_name(name, taken):
+    """`name`, or name-2, name-3... before the extension, whichever isn't in `taken`."""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 2
+    while candidate in taken:
+        candidate = f"{stem}-{n}{ext}"
+        n += 1
+    return candidate
+
+def count_pages(file_path):
+    """Units of extraction work in a file, for progress reporting: PDF pages or .txt read blocks."""
+    if file_path.endswith('.pdf'):
+        try:
+            with open(file_path, 'rb') as f:
+                return len(PyPDF2.PdfReader(f).pages)
+        except Exception:
+            return 1
+    return max(1, -(-os.path.getsize(file_path) // TEXT_READ_BLOCK))
+
+class IngestJob:
+    """
+    One background ingestion of uploaded files, with the progress counters the status endpoints
+    report. Files in `staging_dir` were staged for the job and are removed once it is done with
+    them; files elsewhere (the command line ingests PDFs in place) are only read. Work files
+    go in `staging_dir` either way.
+    """
+    def __init__(self, corpus, notebook, files, model, embed_model, staging_dir):
+        self.id = uuid.uuid4().hex
+        self.corpus = corpus
+        self.notebook = notebook
+        self.files = files
+        self.model = model
+        self.embed_model = embed_model
+        self.staging_dir = staging_dir
+        self.status = "queued"
+        self.error = None
+        self.filenames = []
+        self.results = []
+        self.current_file = None
+        self.pages_total = 0
+        self.pages_extracted = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.changed = threading.Condition()
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.changed.notify_all()
+
+    def advance(self, field, amount):
+        with self.changed:
+            setattr(self, field, getattr(self, field) + amount)
+            self.changed.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error")
+
+    def staged(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.staging_dir)
+
+    def eta_seconds(self):
+        # Embedding trails extraction, so progress is whichever stage is further behind.
+        if self.status != "running" or not self.pages_extracted:
+            return None
+        fraction = self.pages_extracted / max(self.pages_total, 1)
+        if self.chunks_total:
+            fraction = min(fraction, self.chunks_embedded / self.chunks_total)
+        if fraction <= 0:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed * (1 - fraction) / fraction, 1)
+
+    def to_dict(self):
+        with self.changed:
+            return {
+                "job_id": self.id,
+                "notebook": self.notebook,
+                "status": self.status,
+                "error": self.error,
+                "files": [name for name, _, _ in self.files],
+                "current_file": self.current_file,
+                "pages_total": self.pages_total,
+                "pages_extracted": self.pages_extracted,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "eta_seconds": self.eta_seconds(),
+                "filenames": self.filenames,
+                "results": self.results,
+            }
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+ingest_jobs = collections.OrderedDict()
+ingest_jobs_lock = threading.Lock()
+
+def submit_ingest_job(notebook, files, model, embed_model, staging_dir):
+    """Queues staged files, a list of (name, path, sha256), for ingestion into a notebook on the background pool."""
+    job = IngestJob(notebooks.get(notebook), notebook, files, model, embed_model, staging_dir)
+    with ingest_jobs_lock:
+        ingest_jobs[job.id] = job
+        # Forget the oldest finished jobs so the table doesn't grow forever.
+        for old_id in [i for i, j in ingest_jobs.items() if j.finished][:max(0, len(ingest_jobs) - MAX_TRACKED_JOBS)]:
+            del ingest_jobs[old_id]
+    ingest_executor.submit(run_ingest_job, job)
+    return job
+
+def run_ingest_job(job):
+    job.update(status="running", started_at=time.time(),
+               pages_total=sum(count_pages(path) for _, path, _ in job.files))
+
+    def counted_pages(pages, text_file):
+        # A PDF's extracted text is kept as the document the chunks' spans point into.
+        for page in pages:
+            job.advance('pages_extracted', 1)
+            if text_file is not None:
+                text_file.write(page)
+            yield page
+
+    def counted_chunks(chunks):
+        for chunk in chunks:
+            job.advance('chunks_total', 1)
+            yield chunk
+
+    def ingest_file(staged):
+        """Extracts, chunks and embeds one file; returns (document, (vectors path, dimension), result)."""
+        filename, filepath, sha256 = staged
+        # Another upload may have indexed the same content since this one was staged.
+        duplicate_of = job.corpus.source_for_hash(sha256)
+        if duplicate_of is not None:
+            if job.staged(filepath):
+                os.remove(filepath)
+            return None, None, {"name": filename, "status": "duplicate", "duplicate_of": duplicate_of}
+        job.update(current_file=filename)
+        print(f"Processing file: {filename}")
+        is_pdf = filepath.endswith('.pdf')
+        # Named like a staged upload (for which this is its own path), so nothing is written next to a PDF read in place.
+        work_path = os.path.join(job.staging_dir, f"{sha256[:16]}-{os.path.basename(filepath)}")
+        # A staged .txt already is its text document, so it's chunked in place rather than copied.
+        text_path = work_path + ".extracted" if is_pdf else filepath
+        vectors_path = work_path + ".vectors"
+        try:
+            # Extraction runs inside chunking, which runs inside embedding, so time each
+            # iterator and subtract to get the stages' own shares.
+            totals = {"extract": 0.0, "chunk": 0.0}
+            started = time.perf_counter()
+            # newline='' keeps the text byte-for-byte as chunked, so the spans stay valid on Windows.
+            with (open(text_path, 'w', encoding='utf-8', newline='') if is_pdf else contextlib.nullcontext()) as text_file:
+                pages = timed_iter(iter_pages_from_file(filepath), totals, "extract")
+                spans, dimension = embed_chunk_stream(
+                    counted_chunks(timed_iter(iter_chunks(counted_pages(pages, text_file), page_numbers=is_pdf),
+                                              totals, "chunk")),
+                    job.embed_model, vectors_path,
+                    progress=lambda n: job.advance('chunks_embedded', n))
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            for path in (text_path, vectors_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None, None, {"name": filename, "status": "error", "error": str(e)}
+        finally:
+            # The extracted text is the document from here on; the PDF itself isn't kept.
+            if is_pdf and job.staged(filepath) and os.path.exists(filepath):
+                os.remove(filepath)
+        metrics.record_span("extract", totals["extract"])
+        metrics.record_span("chunk", totals["chunk"] - totals["extract"])
+        metrics.record_span("ingest_file", time.perf_counter() - started)
+        metrics.increment("localnote_chunks_ingested_total", len(spans))
+        if not len(spans):
+            print(f"Warning: No text could be extracted from {filename}.")
+            os.remove(text_path)
+            os.remove(vectors_path)
+            return None, None, {"name": filename, "status": "error", "error": "No text could be extracted."}
+        return (filename, spans, text_path, sha256), (vectors_path, dimension), {"name": filename, "status": "indexed", "chunks": len(spans)}
+
+    outcomes = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(INGEST_FILE_WORKERS, len(job.files))),
+                                thread_name_prefix="ingest-file") as pool:
+            outcomes = list(pool.map(ingest_file, job.files))
+        job.update(results=[result for _, _, result in outcomes])
+        documents = [document for document, _, _ in outcomes if document is not None]
+        if not documents:
+            if all(result["status"] == "duplicate" for _, _, result in outcomes):
+                job.update(status="done", current_file=None, filenames=job.corpus.source_names, finished_at=time.time())
+                return
+            raise ValueError("Could not extract any text content from the processed files. They may be empty or corrupted.")
+        # Read the spilled vectors straight into one matrix for the whole job.
+        spills = [spill for _, spill, _ in outcomes if spill is not None]
+        vectors = np.empty((sum(len(document[1]) for document in documents), spills[0][1]), dtype=np.float32)
+        row = 0
+        for document, (vectors_path, _) in zip(documents, spills):
+            with open(vectors_path, 'rb') as f:
+                f.readinto(vectors[row:row + len(document[1])].reshape(-1).view(np.uint8))
+            row += len(document[1])
+        job.corpus.add_documents(documents, job.model, job.embed_model, vectors=vectors)
+        job.update(status="done", current_file=None, filenames=job.corpus.source_names, finished_at=time.time())
+        print(f"Ingestion job {job.id} finished in {job.finished_at - job.started_at:.2f}s.")
+    except Exception as e:
+        print(f"Error in ingestion job {job.id}: {e}")
+        job.update(status="error", error=str(e), current_file=None, filenames=job.corpus.source_names, finished_at=time.time())
+    finally:
+        for _, spill, _ in outcomes:
+            if spill is not None and os.path.exists(spill[0]):
+                os.remove(spill[0])
+        # Indexed text files have been moved into the corpus; anything still staged was not indexed.
+        for _, path, _ in job.files:
+            if job.staged(path) and os.path.exists(path):
+                os.remove(path)
+
+def find_documents(paths):
+    """
+    Yields (source name, path) for each .pdf and .txt file in `paths`, which may be files or
+    directory trees. Files found in a tree are named by their path relative to its root.
+    """
+    for root in paths:
+        if os.path.isfile(root):
+            yield os.path.basename(root), root
+            continue
+        for directory, subdirs, files in os.walk(root):
+            subdirs.sort()
+            for name in sorted(files):
+                if name.endswith('.pdf') or name.endswith('.txt'):
+                    path = os.path.join(directory, name)
+                    yield os.path.relpath(path, root).replace(os.sep, '/'), path
+
+def file_sha256(path):
+    """The SHA-256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(TEXT_READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ingest_paths(notebook, paths, model, embed_model, batch_size):
+    """
+    Ingests the documents under `paths` into a notebook through the same jobs as uploads,
+    `batch_size` files at a time; each batch is saved before the next is staged, so an
+    interrupted run keeps what it finished. Files already indexed (by content) are skipped.
+    PDFs are hashed and extracted where they are; a .txt is staged like an upload, since its
+    decoded copy becomes the notebook's stored document. Returns the per-file results.
+    """
+    corpus = notebooks.get(notebook).ensure_loaded()
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], "files", notebook)
+    os.makedirs(upload_dir, exist_ok=True)
+    documents = list(find_documents(paths))
+    print(f"Found {len(documents)} document(s) to ingest into notebook '{notebook}' with {embed_model}.")
+    results = []
+    started = time.perf_counter()
+    for first in range(0, len(documents), batch_size):
+        staged = []
+        staged_hashes = {}
+        for name, path in documents[first:first + batch_size]:
+            extension = os.path.splitext(path)[1]
+            if extension not in ('.pdf', '.txt'):
+                results.append({"name": name, "status": "unsupported", "error": "Only .pdf and .txt files are supported."})
+                continue
+            # Only the staged copy's file name has to be safe; the source keeps its relative path.
+            disk_name = secure_filename(os.path.basename(name))
+            if not disk_name.endswith(extension):
+                disk_name = f"document{extension}"
+            try:
+                if extension == '.pdf':
+                    filepath, sha256 = path, file_sha256(path)
+                else:
+                    with open(path, 'rb') as f:
+                        filepath, sha256 = stage_upload(f, upload_dir, disk_name)
+            except OSError as e:
+                results.append({"name": name, "status": "error", "error": f"Could not read the file: {e}"})
+                continue
+            duplicate_of = staged_hashes.get(sha256) or corpus.source_for_hash(sha256)
+            if duplicate_of is not None:
+                if filepath != path:
+                    os.remove(filepath)
+                results.append({"name": name, "status": "duplicate", "duplicate_of": duplicate_of})
+                continue
+            staged_hashes[sha256] = name
+            staged.append((name, filepath, sha256))
+        if staged:
+            job = IngestJob(corpus, notebook, staged, model, embed_model, upload_dir)
+            run_ingest_job(job)
+            results.extend(job.results)
+        done = min(first + batch_size, len(documents))
+        print(f"[{done}/{len(documents)} files] {len(corpus.chunk_ids)} chunks indexed, "
+              f"{time.perf_counter() - started:.1f}s elapsed.")
+    return results
+
+def retrieve_batch(corpus, queries, k):
+    """
+    retrieve() for many queries at once: one batched embedding call and one FAISS search over
+    all the query vectors, then keyword search and fusion per query when HYBRID_SEARCH is on.
+    Returns (hits, timings), one list of (chunk id, score, text) and one dict of stage
+    milliseconds per query; the shared embedding and search times are split evenly.
+    """
+    if not queries:
+        return [], []
+    with corpus.ensure_loaded().lock:
+        embed_model = corpus.embed_model
+    queries = [normalize_query(query) for query in queries]
+    batch = {}
+    with metrics.span("batch_embed", batch):
+        vectors = embed_texts(queries, embed_model)
+    with metrics.span("batch_search", batch):
+        dense = corpus.search(vectors, HYBRID_CANDIDATES if HYBRID_SEARCH else k, embed_model)
+    all_hits = []
+    all_timings = []
+    for query, dense_hits in zip(queries, dense):
+        timings = {"embed": round(batch["batch_embed"] / len(queries), 3),
+                   "search": round(batch["batch_search"] / len(queries), 3)}
+        hits = dense_hits[:k]
+        if HYBRID_SEARCH:
+            started = time.perf_counter()
+            keyword_hits = corpus.keyword_search(query, HYBRID_CANDIDATES)
+            timings["keyword"] = round(1000 * (time.perf_counter() - started), 3)
+            started = time.perf_counter()
+            hits = reciprocal_rank_fusion([dense_hits, keyword_hits], k)
+            timings["fuse"] = round(1000 * (time.perf_counter() - started), 3)
+        all_hits.append(hits)
+        all_timings.append(timings)
+    return all_hits, all_timings
+
+def read_questions(path):
+    """Reads questions: one per line, or JSON lines with a "query" field whose other fields are kept."""
+    with (contextlib.nullcontext(sys.stdin) if path == '-' else open(path, 'r', encoding='utf-8')) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('{'):
+                yield {"query": line}
+                continue
+            try:
+                question = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} of {path} is not valid JSON: {e}") from None
+            if not isinstance(question, dict) or not isinstance(question.get("query"), str):
+                raise ValueError(f'Line {number} of {path} has no "query" field.')
+            yield question
+
+class StaticAsset:
+    """A generated page or file, rendered once, with a content-hash ETag and precompressed copies."""
+    def __init__(self, body, mimetype, cache_control):
+        self.body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        self.encoded = {"gzip": gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+
+    def response(self):
+        accepted = request.accept_encodings
+        encoding = next((name for name in ("br", "gzip") if name in self.encoded and accepted[name]), None)
+        response = Response(self.encoded[encoding] if encoding else self.body, mimetype=self.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = self.cache_control
+        # Each encoding is a different representation, so it gets its own tag.
+        response.set_etag(f"{self.etag}-{encoding}" if encoding else self.etag)
+        return response.make_conditional(request)
+
+def render_static_assets():
+    """
+    Renders the web interface once. Scripts and styles are linked by content-hashed URLs, so
+    browsers can cache them indefinitely; the page itself is revalidated by its ETag.
+    """
+    assets = {
+        "style.css": StaticAsset(build_css(), 'text/css', 'public, max-age=31536000, immutable'),
+        "markdown.js": StaticAsset(build_markdown_js(), 'application/javascript', 'public, max-age=31536000, immutable'),
+        "script.js": StaticAsset(build_js(), 'application/javascript', 'public, max-age=31536000, immutable'),
+    }
+    urls = {name: f"/static/{name}?v={asset.etag}" for name, asset in assets.items()}
+    return StaticAsset(build_html(urls), 'text/html', 'no-cache'), assets
+
+index_page, static_assets = render_static_assets()
+
+@app.route('/')
+def index():
+    return index_page.response()
+
+@app.route('/static/<name>')
+def static_asset(name):
+    asset = static_assets.get(name)
+    if asset is None:
+        return jsonify({"error": "Not found"}), 404
+    return asset.response()
+
+def request_notebook():
+    """The notebook a request targets: `notebook` from the query string, form or JSON body."""
+    data = request.get_json(silent=True) if request.is_json else None
+    return (request.args.get('notebook') or request.form.get('notebook')
+            or (data or {}).get('notebook') or DEFAULT_NOTEBOOK)
+
+@app.route('/notebooks', methods=['GET'])
+def list_notebooks():
+    return jsonify({"notebooks": notebooks.names(), "default": DEFAULT_NOTEBOOK})
+
+@app.route('/notebooks/<name>', methods=['DELETE'])
+def delete_notebook(name):
+    if not notebooks.delete(name):
+        return jsonify({"error": f"No notebook named '{name}'."}), 404
+    shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], "files", name), ignore_errors=True)
+    chat_sessions.drop_notebook(name)
+    return jsonify({"message": f"Deleted notebook {name}", "notebooks": notebooks.names()})
+
+@app.route('/sources', methods=['GET'])
+def list_sources():
+    try:
+        corpus = notebooks.get(request_notebook()).ensure_loaded()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"filenames": corpus.source_names, "model": corpus.model, "embed_model": corpus.embed_model,
+                    "embed_models": sorted(corpus.spaces), "building": sorted(corpus.building)})
+
+@app.route('/notebooks/<name>/model', methods=['POST'])
+def select_notebook_model(name):
+    model = (request.get_json(silent=True) or {}).get('model')
+    if model not in MODEL_OPTIONS:
+        return jsonify({"error": f"Unknown model '{model}'."}), 400
+    try:
+        corpus = notebooks.get(name)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Switching to a model with a different embedder builds its index in the background.
+    status = corpus.select_model(model)
+    threading.Thread(target=warm_models, args=(model, MODEL_OPTIONS[model]['embed']), daemon=True).start()
+    return jsonify({"model": model, "embed_model": MODEL_OPTIONS[model]['embed'], "status": status})
+
+@app.route('/sources/<path:name>', methods=['DELETE'])
+def delete_source(name):
+    try:
+        corpus = notebooks.get(request_notebook())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not corpus.remove_source(name):
+        return jsonify({"error": f"No source named '{name}'."}), 404
+    return jsonify({"message": f"Removed {name}", "filenames": corpus.source_names})
+
+@app.route('/upload', methods=['POST'])
+@app.route('/sources', methods=['POST'])
+def upload_file():
+    if 'files' not in request.files:
+        return jsonify({"error": "No file part in the request"}), 400
+    
+    files = request.files.getlist('files')
+    model = request.form.get('model', DEFAULT_MODEL)
+    embed_model = MODEL_OPTIONS.get(model, MODEL_OPTIONS[DEFAULT_MODEL])['embed']
+    notebook = request_notebook()
+    if not notebooks.valid_name(notebook):
+        return jsonify({"error": f"Invalid notebook name '{notebook}'."}), 400
+    unavailable = model_manager.unavailable_reason(embed_model)
+    if unavailable:
+        return jsonify({"error": unavailable}), 503
+    try:
+        corpus = notebooks.get(notebook).ensure_loaded()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Each notebook saves uploads in its own folder, so same-named files in different notebooks don't collide.
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], "files", notebook)
+    os.makedirs(upload_dir, exist_ok=True)
+
+    # One result per file; files that fail here never reach the ingestion job.
+    results = []
+    staged = []
+    staged_hashes = {}
+    for file in files:
+        if not file or not file.filename:
+            continue
+        if not (file.filename.endswith('.pdf') or file.filename.endswith('.txt')):
+            print(f"Skipping unsupported file type: {file.filename}")
+            results.append({"name": file.filename, "status": "unsupported", "error": "Only .pdf and .txt files are supported."})
+            continue
+
+        filename = secure_filename(file.filename)
+        if not filename:
+            print(f"Skipping file with an invalid or insecure name: {file.filename}")
+            results.append({"name": file.filename, "status": "error", "error": "Invalid file name."})
+            continue
+
+        try:
+            filepath, sha256 = stage_upload(file.stream, upload_dir, filename)
+        except Exception as e:
+            print(f"Error saving file {file.filename}: {e}")
+            results.append({"name": filename, "status": "error", "error": f"Could not save the file: {e}"})
+            continue
+
+        duplicate_of = staged_hashes.get(sha256) or corpus.source_for_hash(sha256)
+        if duplicate_of is not None:
+            print(f"Skipping {filename}: same content as {duplicate_of}.")
+            os.remove(filepath)
+            results.append({"name": filename, "status": "duplicate", "duplicate_of": duplicate_of})
+            continue
+        # Two different files with one name in the same upload would otherwise replace each other.
+        filename = unique_name(filename, {name for name, _, _ in staged})
+        staged_hashes[sha256] = filename
+        staged.append((filename, filepath, sha256))
+        results.append({"name": filename, "status": "queued"})
+
+    if not staged:
+        if results and all(result["status"] == "duplicate" for result in results):
+            return jsonify({"message": "All files are already indexed.", "notebook": notebook, "results": results,
+                            "filenames": corpus.source_names})
+        return jsonify({"error": "No valid files were processed. Please upload supported file types (.pdf, .txt).",
+                        "results": results}), 400
+
+    # Extraction and embedding run in the background; chat keeps using the current index meanwhile.
+    job = submit_ingest_job(notebook, staged, model, embed_model, upload_dir)
+    return jsonify({"message": "Ingestion started", "job_id": job.id, "notebook": notebook, "files": [name for name, _, _ in staged],
+                    "results": results, "status_url": f"/jobs/{job.id}", "events_url": f"/jobs/{job.id}/events"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def generate_events():
+        while True:
+            state = job.to_dict()
+            yield f"data: {json.dumps(state)}\n\n"
+            if job.finished:
+                return
+            # Wake on progress, but at least once a second so the ETA keeps moving.
+            with job.changed:
+                job.changed.wait(timeout=1.0)
+            time.sleep(JOB_EVENT_INTERVAL)
+
+    return Response(generate_events(), mimetype='text/event-stream')
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.get_json()
+    query = data.get('query')
+    notebook = request_notebook()
+    try:
+        corpus = notebooks.get(notebook).ensure_loaded()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    model = data.get('model', corpus.model)
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+    if corpus.index is None:
+        return jsonify({"error": "No document has been loaded. Please upload a file first."}), 400
+    for required in (model, corpus.embed_model):
+        unavailable = model_manager.unavailable_reason(required)
+        if unavailable:
+            return jsonify({"error": unavailable}), 503
+
+    source_filenames = corpus.source_names
+    session = chat_sessions.session(data.get('session_id'), notebook)
+    
+    def generate_response():
+        print("\n--- Entering chat generator ---")
+        ticket = None
+        stream = None
+        # Per-request stage timings in milliseconds, sent to the client as a final SSE event.
+        timings = {}
+        request_started = time.perf_counter()
+        profiler = None
+        if SLOW_REQUEST_PROFILE_SECONDS is not None:
+            profiler = SlowRequestProfiler("/chat", SLOW_REQUEST_PROFILE_SECONDS, PROFILE_SAMPLE_INTERVAL)
+        metrics.increment("localnote_chat_requests_total")
+        try:
+            yield f"data: {json.dumps({'session_id': session.id})}\n\n"
+            history = session.history(HISTORY_TOKEN_BUDGET)
+            prefix = prompt_prefix(source_filenames, history)
+
+            def wait_for_slot():
+                # The periodic events keep the client informed and make a disconnect surface
+                # here (as GeneratorExit) rather than after we've started generating.
+                nonlocal ticket
+                ticket = generation_scheduler.enqueue()
+                reported_position = None
+                queue_started = time.perf_counter()
+                while not generation_scheduler.wait_turn(ticket, timeout=QUEUE_EVENT_INTERVAL):
+                    position = generation_scheduler.position(ticket)
+                    if position != reported_position:
+                        reported_position = position
+                        yield f"data: {json.dumps({'queue_position': position})}\n\n"
+                    else:
+                        yield ": waiting\n\n"
+                metrics.record_span("queue_wait", time.perf_counter() - queue_started, timings)
+
+            search_query = query
+            if history and QUERY_REWRITE:
+                # The rewrite runs on the chat model too, so the request takes its slot first
+                # and keeps it for the answer.
+                yield from wait_for_slot()
+                with metrics.span("rewrite", timings):
+                    search_query = rewrite_query(query, prefix, model)
+                print(f"Follow-up rewritten for retrieval: {search_query!r}")
+            # Keep the notebook loaded until its passages are in hand, even if requests for
+            # other notebooks would otherwise evict it meanwhile.
+            with corpus.in_use():
+                with metrics.span("retrieve", timings):
+                    hits = retrieve(corpus, search_query, RETRIEVAL_CANDIDATES if CONTEXT_PIPELINE else CONTEXT_TOP_K)
+                if CONTEXT_PIPELINE:
+                    passages, context_timings = build_context(corpus, search_query, hits)
+                    timings.update(context_timings)
+                else:
+                    passages = [text for _, _, text in hits]
+            context = "\n\n---\n\n".join(passages)
+            
+            print(f"Context length: {len(context)} (retrieval took {timings['retrieve']:.1f}ms)")
+            prompt_started = time.perf_counter()
+            # Context changes with every question, so it goes last, after the stable prefix. Earlier
+            # turns in the prefix are kept without their retrieved context, which keeps them cheap.
+            full_prompt = f"CONTEXT FROM DOCUMENTS:\n\n{context}\n\nUSER QUESTION: {query}"
+            messages = prefix + [{'role': 'user', 'content': full_prompt}]
+            metrics.record_span("prompt", time.perf_counter() - prompt_started, timings)
+
+            if ticket is None:
+                yield from wait_for_slot()
+
+            stream = ollama.chat(model=model, messages=messages, stream=True, keep_alive=OLLAMA_KEEP_ALIVE)
+
+            print("Ollama stream started. Waiting for chunks...")
+            generation_started = time.perf_counter()
+            first_token_at = None
+            token_count = 0
+            final = {}
+            answer = []
+            pending = []
+            pending_chars = 0
+            last_flush = generation_started
+            for i, chunk in enumerate(stream):
+                if i == 0:
+                    print("First chunk received from Ollama.")
+                if chunk.get('done'):
+                    final = chunk
+                if 'content' in chunk['message']:
+                    token = chunk['message']['content']
+                    if token and first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        # Time to first token counts from the request, queueing and retrieval included.
+                        metrics.record_span("first_token", first_token_at - request_started, timings)
+                    if not token:
+                        continue
+                    token_count += 1
+                    answer.append(token)
+                    pending.append(token)
+                    pending_chars += len(token)
+                    now = time.perf_counter()
+                    if token_count == 1 or pending_chars >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                        yield f"data: {json.dumps({'token': ''.join(pending)})}\n\n"
+                        pending.clear()
+                        pending_chars = 0
+                        last_flush = now
+            if pending:
+                yield f"data: {json.dumps({'token': ''.join(pending)})}\n\n"
+
+            metrics.record_span("generate", time.perf_counter() - generation_started, timings)
+            # Prefer Ollama's own count and timing; fall back to streamed chunks over wall time.
+            if final.get('eval_count') and final.get('eval_duration'):
+                tokens_per_second = final['eval_count'] / (final['eval_duration'] / 1e9)
+            elif token_count > 1:
+                tokens_per_second = (token_count - 1) / max(time.perf_counter() - first_token_at, 1e-9)
+            else:
+                tokens_per_second = None
+            # Ollama reports where the time went: loading the model, processing the prompt (fast
+            # when its prefix was cached) and generating.
+            for key, span in (("load_duration", "model_load"), ("prompt_eval_duration", "prompt_eval"), ("eval_duration", "eval")):
+                if final.get(key):
+                    metrics.record_span(span, final[key] / 1e9, timings)
+            if final.get('prompt_eval_count') is not None:
+                timings["prompt_tokens"] = final['prompt_eval_count']
+                metrics.increment("localnote_prompt_tokens_total", final['prompt_eval_count'])
+                print(f"Prompt: {final['prompt_eval_count']} tokens in {timings.get('prompt_eval', 0):.0f}ms; "
+                      f"generation: {final.get('eval_count', token_count)} tokens in {timings.get('eval', 0):.0f}ms")
+            metrics.increment("localnote_tokens_generated_total", final.get('eval_count') or token_count)
+            if tokens_per_second is not None:
+                metrics.observe("localnote_tokens_per_second", tokens_per_second, buckets=TOKEN_RATE_BUCKETS)
+                timings["tokens_per_second"] = round(tokens_per_second, 1)
+            metrics.record_span("chat", time.perf_counter() - request_started, timings)
+            session.add_turn(query, "".join(answer), model)
+            yield f"data: {json.dumps({'timings': timings})}\n\n"
+
+        except GeneratorExit:
+            print("Client disconnected; cancelling generation.")
+            raise
+        except Exception as e:
+            print(f"Error during chat generation: {e}")
+            error_message = json.dumps({'error': 'An error occurred on the server while generating the response.'})
+            # FIX: Use single newline for proper SSE formatting.
+            yield f"data: {error_message}\n\n"
+        finally:
+            # Closing the stream drops the HTTP connection to Ollama, which stops generating.
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            if ticket is not None:
+                generation_scheduler.finish(ticket)
+            if profiler is not None:
+                profiler.stop()
+
+    return Response(generate_response(), mimetype='text/event-stream')
+
+@app.route('/models/status', methods=['GET'])
+def models_status():
+    return jsonify(model_manager.snapshot())
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "query_embeddings": query_embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "chunk_embeddings": {"hits": embedding_cache.hits, "misses": embedding_cache.misses,
+                             "entries": embedding_cache.rows, "bytes": embedding_cache.bytes},
+    })
+
+metrics.gauge("localnote_generations_active", lambda: generation_scheduler.stats()["active"])
+metrics.gauge("localnote_generations_waiting", lambda: generation_scheduler.stats()["waiting"])
+metrics.gauge("localnote_notebooks_loaded", lambda: sum(corpus.loaded for corpus in list(notebooks.corpora.values())))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/shutdown', methods=['POST'])
+def shutdown():
+    print("Shutdown request received. Terminating server.")
+    os._exit(0) 
+
+def run_server(args):
+    print("--- LocalNote Startup Check ---")
+    # Model checks, heavy imports and loading the default notebook all run in the
+    # background so the server can bind straight away.
+    model_manager.start()
+    threading.Thread(target=lambda: (faiss.Index, PyPDF2.PdfReader), daemon=True, name="warm-imports").start()
+    threading.Thread(target=notebooks.get(DEFAULT_NOTEBOOK).ensure_loaded, daemon=True).start()
     
     url = "http://127.0.0.1:5000"
     threading.Timer(1.25, lambda: webbrowser.open(url)).start()
     
     print("\nStarting LocalNote server...")
     print(f"Access at {url}")
-    app.run(host='127.0.0.1', port=5000, threaded=True)
\ No newline at end of file
+    app.run(host='127.0.0.1', port=5000, threaded=True)
+
+def run_ingest(args):
+    global INGEST_FILE_WORKERS
+    INGEST_FILE_WORKERS = args.workers
+    corpus = notebooks.get(args.notebook).ensure_loaded()
+    model = args.model or corpus.model or DEFAULT_MODEL
+    results = ingest_paths(args.notebook, args.paths, model, MODEL_OPTIONS[model]['embed'], args.batch)
+    counts = collections.Counter(result["status"] for result in results)
+    print("Done: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    for result in results:
+        if result["status"] in ("error", "unsupported"):
+            print(f"  {result['name']}: {result['error']}")
+    return 1 if counts.get("error") else 0
+
+def run_query(args):
+    try:
+        questions = list(read_questions(args.questions))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not questions:
+        return 0
+    # Keep the app's log lines out of JSONL written to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        corpus = notebooks.get(args.notebook).ensure_loaded()
+        if corpus.index is None:
+            print(f"Notebook '{args.notebook}' has no indexed documents.")
+            return 1
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            started = time.perf_counter()
+            all_hits, all_timings = retrieve_batch(corpus, [question["query"] for question in questions], args.k)
+            sources = {source['doc_id']: source['name'] for source in corpus.sources}
+            for question, hits, timings in zip(questions, all_hits, all_timings):
+                ids = np.array([chunk_id for chunk_id, _, _ in hits], dtype=np.int64)
+                found, records, _ = corpus.chunk_details(ids)
+                results = [{"rank": rank, "chunk_id": chunk_id, "source": sources.get(int(record['doc'])),
+                            "page": int(record['page']) or None, "score": round(score, 6), "text": text}
+                           for rank, ((chunk_id, score, text), record) in enumerate(zip(itertools.compress(hits, found), records), start=1)]
+                out.write(json.dumps({**question, "results": results, "timings": timings}) + "\n")
+            elapsed = time.perf_counter() - started
+            print(f"Answered {len(questions)} queries in {elapsed:.2f}s ({len(questions) / max(elapsed, 1e-9):.1f} queries/s).")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="LocalNote: chat with your documents using local models.")
+    commands = parser.add_subparsers(dest="command")
+
+    serve = commands.add_parser("serve", help="run the web app (the default)")
+    serve.set_defaults(run=run_server)
+
+    ingest = commands.add_parser("ingest", help="index the .pdf and .txt files in directory trees into a notebook")
+    ingest.add_argument("paths", nargs="+", type=os.path.abspath, help="files or directories to ingest")
+    ingest.add_argument("--notebook", default=DEFAULT_NOTEBOOK)
+    ingest.add_argument("--model", choices=list(MODEL_OPTIONS), help="chat model whose embedder to use (default: the notebook's)")
+    ingest.add_argument("--workers", type=int, default=INGEST_FILE_WORKERS, help="files processed at once")
+    ingest.add_argument("--batch", type=int, default=64, help="files ingested and saved per batch")
+    ingest.set_defaults(run=run_ingest)
+
+    query = commands.add_parser("query", help="retrieve for a file of questions and write JSON lines with timings")
+    query.add_argument("questions", type=lambda path: path if path == '-' else os.path.abspath(path),
+                       help="one question per line, or JSON lines with a \"query\" field ('-' for stdin)")
+    query.add_argument("--notebook", default=DEFAULT_NOTEBOOK)
+    query.add_argument("--k", type=int, default=CONTEXT_TOP_K)
+    query.add_argument("--output", type=lambda path: path if path == '-' else os.path.abspath(path), default='-',
+                       help="JSONL output file (default: stdout)")
+    query.set_defaults(run=run_query)
+
+    # Paths are made absolute while parsing, before the frozen app changes directory.
+    args = parser.parse_args()
+    if getattr(sys, 'frozen', False):
+        os.chdir(sys._MEIPASS)
+    if args.command is None:
+        args.run = run_server
+    if args.command in ("ingest", "query") and not notebooks.valid_name(args.notebook):
+        parser.error(f"invalid notebook name '{args.notebook}'")
+    return args.run(args)
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
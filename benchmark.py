@@ -0,0 +1,372 @@
+"""
+Benchmarks for LocalNote's retrieval pipeline. Nothing here needs a running Ollama server.
+
+    python benchmark.py ann [--sizes 20000 100000] [--dim 768] [--k 4]
+    python benchmark.py encodings [--sizes 20000 100000] [--mode flat] [--notebook NAME]
+    python benchmark.py chunking [--paragraphs 2000] [--questions 300]
+    python benchmark.py pipeline [--sizes 200 1000 5000] [--embed-latency 0.05] [--first-token-ms 300]
+
+`ann` compares each vector index mode against exact flat search on the same synthetic,
+clustered corpus and reports build time, index size, recall@k and per-query latency.
+
+`encodings` builds the same index with each vector encoding (float32, float16, sq8) and
+metric (l2, cosine) and reports the index's memory, the disk used by the stored vectors it
+is rebuilt from, the memory saved against float32 L2, and recall@k against exact float32 L2 search. It uses
+synthetic vectors, or a saved notebook's real embeddings with --notebook.
+
+`chunking` runs the sentence-aware chunker and the original fixed character window over
+the same synthetic document. It reports chunk counts, duplicated text, chunking speed and
+retrieval quality: the share of questions whose answer sentence comes back intact in the
+top-k chunks, using the deterministic stub embedder.
+
+`pipeline` runs the app end to end against stand-ins for the Ollama embedder and chat model
+with configurable latency, over synthetic corpora of increasing size: text extraction,
+chunking, create_vector_store, the /upload job and /chat through Flask's test client. It
+reports chunks/s for each ingestion stage, p50/p95 search and retrieval latency,
+time-to-first-token and the process's peak RSS so far.
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+import app
+
+
+def synthetic_vectors(n, dimension, clusters=64, seed=0):
+    """Gaussian blobs around random centres, which is closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    return centres[labels] + 0.35 * rng.normal(size=(n, dimension)).astype(np.float32)
+
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "tor", "va", "shi", "dal", "pe", "quor", "na", "zel", "bu", "fi", "gra", "ost"]
+
+
+def synthetic_document(paragraphs, seed=0):
+    """Paragraphs of random sentences over a fixed invented vocabulary, so runs are reproducible."""
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(3000)]
+    out = []
+    for _ in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = [rng.choice(vocabulary) for _ in range(rng.randint(6, 30))]
+            sentences.append(" ".join(words).capitalize() + rng.choice(".!?."))
+        out.append(" ".join(sentences))
+    return "\n\n".join(out)
+
+
+def percentile_ms(samples, q):
+    return 1000 * float(np.percentile(samples, q))
+
+
+def search_latencies(index, queries, k):
+    """Searches one query at a time, as /chat does, and returns (result ids, per-query seconds)."""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = []
+    for row, query in enumerate(queries):
+        started = time.perf_counter()
+        _, ids[row:row + 1] = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - started)
+    return ids, latencies
+
+
+def recall_at_k(found, truth):
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found.tolist(), truth.tolist())]))
+
+
+def run_ann(args):
+    print(f"{'chunks':>8} {'mode':>6} {'build s':>8} {'size MB':>8} {'recall@' + str(args.k):>9} {'p50 ms':>7} {'p95 ms':>7}")
+    for n in args.sizes:
+        vectors = synthetic_vectors(n + args.queries, args.dim, seed=n)
+        corpus, queries = vectors[:n], vectors[n:]
+        ids = np.arange(n, dtype=np.int64)
+
+        truth = None
+        for mode in args.modes:
+            started = time.perf_counter()
+            index, used = app.build_index(corpus, ids, mode)
+            build_seconds = time.perf_counter() - started
+            app.apply_search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+
+            found, latencies = search_latencies(index, queries, args.k)
+            if truth is None:
+                # The first mode is the baseline; keep it "flat" for a meaningful recall column.
+                truth = found
+            size_mb = faiss.serialize_index(index).nbytes / 1e6
+            label = used if used == mode else f"{mode}>{used}"
+            print(f"{n:>8} {label:>6} {build_seconds:>8.2f} {size_mb:>8.1f} {recall_at_k(found, truth):>9.3f} "
+                  f"{percentile_ms(latencies, 50):>7.3f} {percentile_ms(latencies, 95):>7.3f}")
+
+
+def notebook_vectors(name, seed=0):
+    """A saved notebook's vectors for its active embed model, and queries halfway between random pairs of them."""
+    corpus = app.notebooks.get(name).ensure_loaded()
+    if corpus.index is None:
+        raise SystemExit(f"Notebook '{name}' has no indexed chunks.")
+    vectors = corpus.spaces[corpus.embed_model].vectors_for(corpus.chunk_ids)
+    rng = np.random.default_rng(seed)
+    pairs = rng.integers(0, len(vectors), size=(200, 2))
+    return vectors, (vectors[pairs[:, 0]] + vectors[pairs[:, 1]]) / 2
+
+
+def run_encodings(args):
+    if args.notebook:
+        datasets = [notebook_vectors(args.notebook)]
+    else:
+        datasets = []
+        for n in args.sizes:
+            vectors = synthetic_vectors(n + args.queries, args.dim, seed=n)
+            datasets.append((vectors[:n], vectors[n:]))
+
+    print(f"{'chunks':>8} {'encoding':>8} {'metric':>6} {'mode':>6} {'index MB':>9} {'disk MB':>8} "
+          f"{'saved':>6} {'recall@' + str(args.k):>9} {'p50 ms':>7}")
+    for corpus, queries in datasets:
+        n = len(corpus)
+        ids = np.arange(n, dtype=np.int64)
+        # Ground truth is what LocalNote searched before encodings were configurable: exact float32 L2.
+        truth = faiss.IndexFlatL2(corpus.shape[1])
+        truth.add(np.ascontiguousarray(corpus, dtype=np.float32))
+        _, truth_ids = truth.search(np.ascontiguousarray(queries, dtype=np.float32), args.k)
+
+        baseline_mb = None
+        for encoding in args.encodings:
+            for metric in args.metrics:
+                index, used = app.build_index(corpus, ids, args.mode, encoding=encoding, metric=metric)
+                app.apply_search_params(index, nprobe=args.nprobe, ef_search=args.ef_search)
+                found, latencies = search_latencies(index, app.prepare_vectors(queries, metric), args.k)
+                index_mb = faiss.serialize_index(index).nbytes / 1e6
+                vectors_mb = n * corpus.shape[1] * (4 if encoding == "float32" else 2) / 1e6
+                if baseline_mb is None:
+                    baseline_mb = index_mb
+                saved = 1 - index_mb / baseline_mb
+                print(f"{n:>8} {encoding:>8} {metric:>6} {used:>6} {index_mb:>9.1f} {vectors_mb:>8.1f} "
+                      f"{100 * saved:>5.0f}% {recall_at_k(found, truth_ids):>9.3f} {percentile_ms(latencies, 50):>7.3f}")
+
+
+def run_chunking(args):
+    document = synthetic_document(args.paragraphs, seed=args.seed)
+    sentences = [s for s in app._BOUNDARY_RE.split(document) if len(s.split()) >= 8]
+    questions = random.Random(args.seed).sample(sentences, min(args.questions, len(sentences)))
+    embed = app.make_stub_embedder(args.dim)
+
+    chunkers = {
+        "window 1500/250": lambda text: app.get_window_chunks(text),
+        f"sentences {app.CHUNK_MAX_TOKENS}/{app.CHUNK_OVERLAP_TOKENS} tok": lambda text: app.get_text_chunks(text),
+    }
+    print(f"Document: {len(document) / 1e6:.2f} MB, {len(questions)} questions, top-{args.k} retrieval\n")
+    print(f"{'chunker':<26} {'chunks':>7} {'avg tok':>8} {'dup %':>6} {'MB/s':>7} {'hit@' + str(args.k):>7}")
+    for name, chunker in chunkers.items():
+        started = time.perf_counter()
+        chunks = chunker(document)
+        seconds = time.perf_counter() - started
+
+        index = faiss.IndexFlatL2(args.dim)
+        index.add(np.asarray(embed(None, chunks), dtype=np.float32))
+        # A question is a shuffled half of its sentence's words, so it isn't a verbatim substring.
+        rng = random.Random(args.seed)
+        queries = []
+        for sentence in questions:
+            words = sentence.split()
+            queries.append(" ".join(rng.sample(words, len(words) // 2)))
+        _, found = index.search(np.asarray(embed(None, queries), dtype=np.float32), args.k)
+        hits = sum(any(sentence in chunks[i] for i in row if i >= 0) for sentence, row in zip(questions, found))
+
+        duplicated = sum(len(chunk) for chunk in chunks) / len(document) - 1
+        avg_tokens = sum(app.approx_tokens(chunk) for chunk in chunks) / len(chunks)
+        print(f"{name:<26} {len(chunks):>7} {avg_tokens:>8.0f} {100 * duplicated:>6.1f} "
+              f"{len(document) / 1e6 / seconds:>7.1f} {hits / len(questions):>7.3f}")
+
+
+def stub_chat(first_token_latency, token_latency, tokens):
+    """A stand-in for ollama.chat that streams `tokens` deterministic words after a prompt-processing delay."""
+    def chat(model=None, messages=None, stream=False, **kwargs):
+        words = [SYLLABLES[i % len(SYLLABLES)] + " " for i in range(tokens)]
+
+        def generate():
+            time.sleep(first_token_latency)
+            for word in words:
+                yield {'message': {'role': 'assistant', 'content': word}, 'done': False}
+                time.sleep(token_latency)
+            yield {'message': {'role': 'assistant', 'content': ''}, 'done': True, 'eval_count': tokens}
+
+        if stream:
+            return generate()
+        time.sleep(first_token_latency + tokens * token_latency)
+        return {'message': {'role': 'assistant', 'content': "".join(words)}, 'done': True}
+    return chat
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or NaN where the resource module is missing (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def fresh_embedding_cache(workdir, name):
+    # Each stage embeds with an empty cache, so one stage's work doesn't make the next look free.
+    app.embedding_cache = app.EmbeddingCache(os.path.join(workdir, f"{name}.sqlite3"), app.EMBED_CACHE_MAX_BYTES)
+
+
+def time_chat(client, query, notebook):
+    """Posts to /chat and returns (seconds to the first token, seconds to the end of the stream)."""
+    started = time.perf_counter()
+    first_token = None
+    response = client.post('/chat', json={"query": query, "notebook": notebook}, buffered=False)
+    try:
+        for chunk in response.iter_encoded():
+            if first_token is None and b'"token"' in chunk:
+                first_token = time.perf_counter() - started
+    finally:
+        response.close()
+    total = time.perf_counter() - started
+    return (total if first_token is None else first_token), total
+
+
+def run_pipeline(args):
+    workdir = tempfile.mkdtemp(prefix="localnote-bench-")
+    embed_model = app.MODEL_OPTIONS[app.DEFAULT_MODEL]['embed']
+    app.set_embed_backend(app.make_stub_embedder(args.dim, latency=args.embed_latency))
+    app.ollama.chat = stub_chat(args.first_token_ms / 1000, args.token_ms / 1000, args.tokens)
+    app.notebooks = app.NotebookRegistry(os.path.join(workdir, "notebooks"), app.MAX_LOADED_NOTEBOOKS)
+    app.app.config['UPLOAD_FOLDER'] = workdir
+    client = app.app.test_client()
+    quiet = (lambda: contextlib.nullcontext()) if args.verbose else (lambda: contextlib.redirect_stdout(io.StringIO()))
+
+    print(f"Stub embedder: {args.dim}-d, {1000 * args.embed_latency:.0f} ms per batch of {app.EMBED_BATCH_SIZE}; "
+          f"stub chat: {args.first_token_ms:.0f} ms to first token, {args.token_ms:.0f} ms per token\n")
+    print(f"{'chunks':>7} {'MB':>6} {'extract':>8} {'chunk/s':>8} {'store/s':>8} {'upload/s':>8} "
+          f"{'search p50/p95 ms':>18} {'retrieve p50/p95':>17} {'TTFT p50/p95 ms':>16} {'RSS MB':>7}")
+    try:
+        for paragraphs in args.sizes:
+            document = synthetic_document(paragraphs, seed=paragraphs)
+            path = os.path.join(workdir, f"corpus-{paragraphs}.txt")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(document)
+            size_mb = os.path.getsize(path) / 1e6
+            notebook = f"bench-{paragraphs}"
+            rng = random.Random(paragraphs)
+            sentences = [s for s in app._BOUNDARY_RE.split(document) if len(s.split()) >= 8]
+            questions = [" ".join(rng.sample(s.split(), len(s.split()) // 2)) for s in rng.sample(sentences, args.queries + args.chats)]
+
+            with quiet():
+                started = time.perf_counter()
+                text = app.get_text_from_file(path)
+                extract_seconds = time.perf_counter() - started
+
+                started = time.perf_counter()
+                chunks = app.get_text_chunks(text)
+                chunk_seconds = time.perf_counter() - started
+
+                fresh_embedding_cache(workdir, f"store-{paragraphs}")
+                started = time.perf_counter()
+                app.create_vector_store(chunks, embed_model)
+                store_seconds = time.perf_counter() - started
+
+                fresh_embedding_cache(workdir, f"upload-{paragraphs}")
+                started = time.perf_counter()
+                with open(path, 'rb') as f:
+                    job = client.post('/upload', data={"files": (f, f"corpus-{paragraphs}.txt"), "notebook": notebook},
+                                      content_type='multipart/form-data').get_json()
+                while True:
+                    state = client.get(job['status_url']).get_json()
+                    if state['status'] in ("done", "error"):
+                        break
+                    time.sleep(0.01)
+                upload_seconds = time.perf_counter() - started
+                if state['status'] == "error":
+                    raise RuntimeError(f"Upload failed: {state['error']}")
+
+                corpus = app.notebooks.get(notebook)
+                searches, retrievals = [], []
+                for question in questions[:args.queries]:
+                    vector = app.embed_query(question, corpus.embed_model)
+                    started = time.perf_counter()
+                    corpus.search(vector, args.k)
+                    searches.append(time.perf_counter() - started)
+                    # The query embedding is cached now, so this times fusion and the keyword search.
+                    started = time.perf_counter()
+                    app.retrieve(corpus, question, app.RETRIEVAL_CANDIDATES)
+                    retrievals.append(time.perf_counter() - started)
+
+                first_tokens = [time_chat(client, question, notebook)[0] for question in questions[args.queries:]]
+
+            stored = len(corpus.chunk_ids)
+            print(f"{stored:>7} {size_mb:>6.1f} {size_mb / extract_seconds:>6.0f}/s {len(chunks) / chunk_seconds:>8.0f} "
+                  f"{len(chunks) / store_seconds:>8.0f} {stored / upload_seconds:>8.0f} "
+                  f"{percentile_ms(searches, 50):>8.2f} / {percentile_ms(searches, 95):>7.2f} "
+                  f"{percentile_ms(retrievals, 50):>7.2f} / {percentile_ms(retrievals, 95):>7.2f} "
+                  f"{percentile_ms(first_tokens, 50):>7.0f} / {percentile_ms(first_tokens, 95):>6.0f} {peak_rss_mb():>7.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ann = commands.add_parser("ann", help="recall vs latency of the vector index modes against flat search")
+    ann.add_argument("--sizes", type=int, nargs="+", default=[20_000, 100_000])
+    ann.add_argument("--dim", type=int, default=768)
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("--k", type=int, default=4)
+    ann.add_argument("--modes", nargs="+", default=["flat", "hnsw", "ivf", "ivfpq"])
+    ann.add_argument("--nprobe", type=int, default=app.INDEX_NPROBE)
+    ann.add_argument("--ef-search", type=int, default=app.INDEX_EF_SEARCH)
+    ann.set_defaults(run=run_ann)
+
+    encodings = commands.add_parser("encodings", help="memory and recall of float16/sq8 and cosine vector encodings")
+    encodings.add_argument("--sizes", type=int, nargs="+", default=[20_000, 100_000])
+    encodings.add_argument("--dim", type=int, default=768)
+    encodings.add_argument("--queries", type=int, default=200)
+    encodings.add_argument("--k", type=int, default=4)
+    encodings.add_argument("--mode", default="flat", help="index mode to build with every encoding")
+    encodings.add_argument("--encodings", nargs="+", default=["float32", "float16", "sq8"])
+    encodings.add_argument("--metrics", nargs="+", default=["l2", "cosine"])
+    encodings.add_argument("--nprobe", type=int, default=app.INDEX_NPROBE)
+    encodings.add_argument("--ef-search", type=int, default=app.INDEX_EF_SEARCH)
+    encodings.add_argument("--notebook", help="measure a saved notebook's embeddings instead of synthetic vectors")
+    encodings.set_defaults(run=run_encodings)
+
+    chunking = commands.add_parser("chunking", help="sentence-aware chunker vs the fixed character window")
+    chunking.add_argument("--paragraphs", type=int, default=2000)
+    chunking.add_argument("--questions", type=int, default=300)
+    chunking.add_argument("--k", type=int, default=4)
+    chunking.add_argument("--dim", type=int, default=768)
+    chunking.add_argument("--seed", type=int, default=0)
+    chunking.set_defaults(run=run_chunking)
+
+    pipeline = commands.add_parser("pipeline", help="ingestion throughput, search latency and TTFT against stub Ollama")
+    pipeline.add_argument("--sizes", type=int, nargs="+", default=[200, 1000, 5000], help="corpus sizes in paragraphs")
+    pipeline.add_argument("--dim", type=int, default=768)
+    pipeline.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding batch")
+    pipeline.add_argument("--first-token-ms", type=float, default=300)
+    pipeline.add_argument("--token-ms", type=float, default=20)
+    pipeline.add_argument("--tokens", type=int, default=50)
+    pipeline.add_argument("--queries", type=int, default=200)
+    pipeline.add_argument("--chats", type=int, default=10)
+    pipeline.add_argument("--k", type=int, default=4)
+    pipeline.add_argument("--verbose", action="store_true", help="show the app's own log output")
+    pipeline.set_defaults(run=run_pipeline)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+EMBED_MODEL = "stub-embed"
+
+
+def make_pdf(pages):
+    """A minimal PDF with one line of Helvetica text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>",
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, text in enumerate(pages):
+        stream = f"BT /F1 12 Tf 40 800 Td ({text}) Tj ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+@pytest.fixture(autouse=True)
+def offline(tmp_path, monkeypatch):
+    """Runs every test against the stub embedder and a throwaway embedding cache."""
+    monkeypatch.setattr(app, "embed_backend", app.make_stub_embedder(32))
+    monkeypatch.setattr(app, "embedding_cache", app.EmbeddingCache(str(tmp_path / "embed_cache.sqlite3"), 1 << 30))
+    monkeypatch.setattr(app, "retrieval_cache", app.QueryCache(app.QUERY_CACHE_SIZE, app.QUERY_CACHE_TTL))
+    monkeypatch.setattr(app, "query_embedding_cache", app.QueryCache(app.QUERY_CACHE_SIZE, app.QUERY_CACHE_TTL))
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    return app.Corpus(str(tmp_path / "notebook"))
@@ -0,0 +1,62 @@
+import re
+
+import numpy as np
+
+import app
+
+SENTENCES = [f"Sentence number {i} talks about topic {i % 5} in some detail." for i in range(60)]
+PAGES = [" ".join(SENTENCES[i:i + 10]) + "\n\n" for i in range(0, 60, 10)]
+
+
+def chunks(pieces, **kwargs):
+    return list(app.iter_chunks(pieces, **kwargs))
+
+
+def test_spans_point_at_the_chunk_text():
+    text = "".join(PAGES)
+    for chunk in chunks(PAGES, max_tokens=40):
+        assert text[chunk.start:chunk.end] == chunk.text
+
+
+def test_chunks_cover_every_non_blank_character():
+    text = "".join(PAGES)
+    covered = np.zeros(len(text), dtype=bool)
+    for chunk in chunks(PAGES, max_tokens=40):
+        covered[chunk.start:chunk.end] = True
+    blank = np.array([c.isspace() for c in text])
+    assert (covered | blank).all()
+
+
+def test_chunks_respect_the_budget_and_keep_sentences_whole():
+    max_chars = 40 * app.CHARS_PER_TOKEN
+    for chunk in chunks(["".join(PAGES)], max_tokens=40):
+        assert len(chunk.text) <= max_chars
+        assert all(sentence in SENTENCES for sentence in re.split(r"(?<=\.)\s+", chunk.text))
+
+
+def test_overlap_repeats_trailing_sentences():
+    result = chunks([" ".join(SENTENCES)], max_tokens=40, overlap_tokens=20)
+    for previous, current in zip(result, result[1:]):
+        assert current.start < previous.end
+
+
+def test_page_numbers():
+    result = chunks(PAGES, max_tokens=40, page_numbers=True)
+    starts = np.cumsum([0] + [len(page) for page in PAGES])
+    for chunk in result:
+        assert starts[chunk.page - 1] <= chunk.start < starts[chunk.page]
+    assert result[-1].page == len(PAGES)
+
+
+def test_oversized_runs_are_split_with_exact_offsets():
+    text = "x" * 1000 + " " + "y" * 50 + ". Tail."
+    result = chunks([text], max_tokens=50, overlap_tokens=0)
+    assert all(len(chunk.text) <= 200 for chunk in result)
+    assert "".join(chunk.text for chunk in result).replace(" ", "") == text.replace(" ", "")
+    for chunk in result:
+        assert text[chunk.start:chunk.end] == chunk.text
+
+
+def test_split_oversized_prefers_word_boundaries():
+    pieces = list(app._split_oversized("aaa bbb ccc ddd", 10, 8))
+    assert pieces == [(10, "aaa bbb ", False), (18, "ccc ddd", None)]
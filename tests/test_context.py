@@ -0,0 +1,81 @@
+import numpy as np
+
+import app
+from conftest import EMBED_MODEL
+
+
+def records(*spans):
+    """Chunk records from (doc, start, end) spans."""
+    result = np.zeros(len(spans), dtype=app.CHUNK_RECORD_DTYPE)
+    for row, (doc, start, end) in enumerate(spans):
+        result[row] = (doc, 0, start, end)
+    return result
+
+
+def hits(*texts):
+    return [(chunk_id, 1.0, text) for chunk_id, text in enumerate(texts)]
+
+
+def unit(*rows):
+    vectors = np.array(rows, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_dedupe_drops_chunks_mostly_inside_a_better_ranked_one():
+    found = hits("a long chunk", "mostly the same span", "same span, other document")
+    spans = records((0, 0, 100), (0, 40, 120), (1, 40, 120))
+    assert app.dedupe_candidates(found, spans, None) == [0, 2]
+
+
+def test_dedupe_keeps_chunks_that_only_touch():
+    spans = records((0, 0, 100), (0, 80, 200))
+    assert app.dedupe_candidates(hits("first", "second"), spans, None) == [0, 1]
+
+
+def test_dedupe_drops_near_identical_vectors_across_documents():
+    vectors = unit([1, 0, 0], [0.999, 0.01, 0], [0, 1, 0])
+    spans = records((0, 0, 10), (1, 0, 10), (2, 0, 10))
+    assert app.dedupe_candidates(hits("a", "b", "c"), spans, vectors) == [0, 2]
+
+
+def test_dedupe_without_vectors_compares_normalized_text():
+    spans = records((0, 0, 10), (1, 0, 10), (2, 0, 10))
+    assert app.dedupe_candidates(hits("Apples  are red", "apples are RED", "pears"), spans, None) == [0, 2]
+
+
+def test_mmr_moves_redundant_candidates_behind_diverse_ones():
+    vectors = unit([1, 0, 0], [0.9, 0.1, 0], [0, 1, 0])
+    assert app.mmr_order([0, 1, 2], vectors, 0.5) == [0, 2, 1]
+
+
+def test_mmr_with_full_weight_keeps_rank_order():
+    vectors = unit([1, 0, 0], [0.9, 0.1, 0], [0, 1, 0])
+    assert app.mmr_order([0, 1, 2], vectors, 1.0) == [0, 1, 2]
+
+
+def test_pack_skips_chunks_over_the_budget_but_always_takes_the_first(corpus):
+    texts = ["x" * 40 * app.CHARS_PER_TOKEN, "y" * 30 * app.CHARS_PER_TOKEN, "z" * 10 * app.CHARS_PER_TOKEN]
+    spans = records((0, 0, 1), (1, 0, 1), (2, 0, 1))
+    assert app.pack_context(corpus, hits(*texts), [0, 1, 2], spans, 20) == [texts[0]]
+    assert app.pack_context(corpus, hits(*texts), [2, 1, 0], spans, 45) == [texts[2], texts[1]]
+
+
+def test_pack_merges_overlapping_chunks_into_one_passage(corpus, tmp_path):
+    document = "First sentence here. Second sentence here. Third sentence here."
+    path = tmp_path / "doc.txt"
+    path.write_text(document, encoding='utf-8')
+    chunks = [app.Chunk(document[0:42], None, 0, 42), app.Chunk(document[21:], None, 21, len(document))]
+    corpus.add_documents([("doc.txt", chunks, str(path))], app.DEFAULT_MODEL, EMBED_MODEL)
+    found, chunk_records, _ = corpus.chunk_details(np.array([1, 0]))
+    assert found.all()
+    passages = app.pack_context(corpus, hits(chunks[1].text, chunks[0].text), [0, 1], chunk_records, 1000)
+    assert passages == [document]
+
+
+def test_build_context_sends_repeated_text_once(corpus):
+    corpus.add_documents([("a.txt", ["mars is the red planet"]), ("b.txt", ["mars is the red planet"]),
+                          ("c.txt", ["venus is very hot"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    found = corpus.search(app.embed_texts(["mars is the red planet"], EMBED_MODEL), 3)[0]
+    passages, timings = app.build_context(corpus, "mars", found)
+    assert sorted(passages) == ["mars is the red planet", "venus is very hot"]
+    assert {"context_lookup", "context_dedupe", "context_pack"} <= set(timings)
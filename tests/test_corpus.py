@@ -0,0 +1,64 @@
+import numpy as np
+
+import app
+from conftest import EMBED_MODEL
+
+
+def add(corpus, *documents):
+    return corpus.add_documents(list(documents), app.DEFAULT_MODEL, EMBED_MODEL)
+
+
+def search(corpus, query, k=3):
+    return corpus.search(app.embed_texts([query], EMBED_MODEL), k)[0]
+
+
+def test_search_maps_ids_back_to_chunk_texts(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]), ("space.txt", ["mars is a planet"]))
+    assert corpus.chunk_ids.tolist() == [0, 1, 2]
+    assert corpus.chunk_texts(np.array([2, 0])) == ["mars is a planet", "apples are red"]
+    chunk_id, _, text = search(corpus, "mars is a planet")[0]
+    assert (chunk_id, text) == (2, "mars is a planet")
+
+
+def test_adding_embeds_only_the_new_document(corpus, monkeypatch):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]))
+    embedded = []
+    backend = app.embed_backend
+    monkeypatch.setattr(app, "embed_backend", lambda model, texts: embedded.extend(texts) or backend(model, texts))
+    add(corpus, ("space.txt", ["mars is a planet"]))
+    assert embedded == ["mars is a planet"]
+    assert corpus.index.ntotal == 3
+
+
+def test_replacing_a_source_drops_its_old_chunks(corpus):
+    add(corpus, ("notes.txt", ["old draft text"]), ("other.txt", ["unrelated words"]))
+    add(corpus, ("notes.txt", ["final version text", "second paragraph"]))
+    assert corpus.source_names == ["other.txt", "notes.txt"]
+    assert corpus.chunk_ids.tolist() == [1, 2, 3]
+    assert corpus.index.ntotal == 3
+    assert "old draft text" not in [text for _, _, text in search(corpus, "old draft text", k=5)]
+
+
+def test_remove_source(corpus):
+    add(corpus, ("fruit.txt", ["apples are red"]), ("space.txt", ["mars is a planet"]))
+    assert corpus.remove_source("fruit.txt")
+    assert not corpus.remove_source("fruit.txt")
+    assert corpus.source_names == ["space.txt"]
+    assert [chunk_id for chunk_id, _, _ in search(corpus, "apples")] == [1]
+    assert corpus.keyword_search("apples", 5) == []
+
+
+def test_removing_the_last_source_empties_the_corpus(corpus):
+    add(corpus, ("fruit.txt", ["apples are red"]))
+    corpus.remove_source("fruit.txt")
+    assert corpus.index is None
+    assert search(corpus, "apples") == []
+
+
+def test_saved_corpus_reloads(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]), ("space.txt", ["mars is a planet"]))
+    corpus.remove_source("fruit.txt")
+    reloaded = app.Corpus(corpus.directory).ensure_loaded()
+    assert reloaded.source_names == ["space.txt"]
+    assert reloaded.chunk_texts(reloaded.chunk_ids) == ["mars is a planet"]
+    assert search(reloaded, "mars")[0][2] == "mars is a planet"
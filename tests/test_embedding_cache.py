@@ -0,0 +1,40 @@
+import numpy as np
+
+import app
+
+
+def vectors(n, dimension=8):
+    return np.arange(n * dimension, dtype=np.float32).reshape(n, dimension)
+
+
+def test_put_and_get_round_trip(tmp_path):
+    cache = app.EmbeddingCache(str(tmp_path / "cache.sqlite3"), 1 << 20)
+    cache.put_many("m", ["a", "b"], vectors(2))
+    hits = cache.get_many("m", ["b", "c", "a"])
+    assert sorted(hits) == [0, 2]
+    np.testing.assert_array_equal(hits[0], vectors(2)[1])
+    assert cache.get_many("other-model", ["a"]) == {}
+
+
+def test_totals_track_inserts_without_double_counting(tmp_path):
+    cache = app.EmbeddingCache(str(tmp_path / "cache.sqlite3"), 1 << 20)
+    cache.put_many("m", ["a", "b"], vectors(2))
+    cache.put_many("m", ["b", "c"], vectors(2))
+    assert (cache.rows, cache.bytes) == (3, 3 * 8 * 4)
+
+
+def test_totals_are_loaded_on_open(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    app.EmbeddingCache(path, 1 << 20).put_many("m", ["a", "b", "c"], vectors(3))
+    reopened = app.EmbeddingCache(path, 1 << 20)
+    reopened.get_many("m", ["a"])
+    assert (reopened.rows, reopened.bytes) == (3, 3 * 8 * 4)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = app.EmbeddingCache(str(tmp_path / "cache.sqlite3"), 3 * 8 * 4)
+    cache.put_many("m", ["a", "b", "c"], vectors(3))
+    cache.get_many("m", ["a"])
+    cache.put_many("m", ["d"], vectors(1))
+    assert sorted(cache.get_many("m", ["a", "b", "c", "d"])) == [0, 2, 3]
+    assert (cache.rows, cache.bytes) == (3, 3 * 8 * 4)
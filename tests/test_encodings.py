@@ -0,0 +1,83 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import app
+from conftest import EMBED_MODEL
+
+ENCODINGS = ["float32", "float16", "sq8"]
+
+
+def random_vectors(n=200, dimension=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dimension)).astype(np.float32)
+
+
+def test_prepare_vectors_normalizes_a_copy_for_cosine():
+    vectors = np.array([[3, 4], [0, 2]], dtype=np.float64)
+    prepared = app.prepare_vectors(vectors, "cosine")
+    assert prepared.dtype == np.float32
+    assert np.allclose(np.linalg.norm(prepared, axis=1), 1)
+    assert vectors[0].tolist() == [3, 4]
+    assert app.prepare_vectors(vectors, "l2").tolist() == [[3, 4], [0, 2]]
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("metric", ["l2", "cosine"])
+def test_every_encoding_finds_each_vector_itself(encoding, metric):
+    vectors = random_vectors()
+    ids = np.arange(100, 100 + len(vectors), dtype=np.int64)
+    index, mode = app.build_index(vectors, ids, mode="flat", encoding=encoding, metric=metric)
+    assert mode == "flat"
+    distances, found = index.search(app.prepare_vectors(vectors, metric), 1)
+    assert (found[:, 0] == ids).mean() > 0.95
+    if metric == "cosine":
+        # Inner products of unit vectors: close to 1 for a match, higher is closer.
+        assert np.all(distances[:, 0] > 0.95)
+
+
+def test_unknown_encoding_and_metric_are_rejected():
+    with pytest.raises(ValueError):
+        app.build_index(random_vectors(), np.arange(200), encoding="int4")
+    with pytest.raises(ValueError):
+        app.build_index(random_vectors(), np.arange(200), metric="dot")
+
+
+def reload(corpus):
+    return app.Corpus(corpus.directory).ensure_loaded()
+
+
+@pytest.mark.parametrize("encoding,metric", [("float16", "l2"), ("sq8", "cosine"), ("float32", "cosine")])
+def test_saved_space_is_reencoded_on_load_and_back(corpus, monkeypatch, encoding, metric):
+    texts = [f"document about topic {i}" for i in range(50)]
+    corpus.add_documents([("topics.txt", texts)], app.DEFAULT_MODEL, EMBED_MODEL)
+
+    monkeypatch.setattr(app, "VECTOR_ENCODING", encoding)
+    monkeypatch.setattr(app, "VECTOR_METRIC", metric)
+    reencoded = reload(corpus)
+    space = reencoded.spaces[EMBED_MODEL]
+    assert (space.encoding, space.metric) == (encoding, metric)
+    assert space.vectors.dtype == (np.float32 if encoding == "float32" else np.float16)
+    with open(os.path.join(corpus.directory, "manifest.json"), encoding='utf-8') as f:
+        saved = json.load(f)["spaces"][EMBED_MODEL]
+    assert (saved["encoding"], saved["metric"]) == (encoding, metric)
+    chunk_id, _, text = reencoded.search(app.embed_texts([texts[7]], EMBED_MODEL), 1)[0][0]
+    assert (chunk_id, text) == (7, texts[7])
+
+    monkeypatch.setattr(app, "VECTOR_ENCODING", "float32")
+    monkeypatch.setattr(app, "VECTOR_METRIC", "l2")
+    restored = reload(corpus)
+    space = restored.spaces[EMBED_MODEL]
+    assert (space.encoding, space.metric, space.vectors.dtype) == ("float32", "l2", np.float32)
+    assert restored.search(app.embed_texts([texts[7]], EMBED_MODEL), 1)[0][0][0] == 7
+    expected = app.embed_texts(texts, EMBED_MODEL)
+    assert np.allclose(space.vectors_for(restored.chunk_ids), expected, atol=1e-2)
+
+
+def test_reloading_with_unchanged_settings_does_not_rebuild(corpus, monkeypatch):
+    corpus.add_documents([("a.txt", ["alpha", "beta"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    rebuilds = []
+    monkeypatch.setattr(app.EmbeddingSpace, "rebuild", lambda space, ids: rebuilds.append(ids))
+    reload(corpus)
+    assert rebuilds == []
@@ -0,0 +1,75 @@
+import json
+import threading
+
+import pytest
+
+import app
+from conftest import EMBED_MODEL
+
+
+class FakeChat:
+    """Stands in for ollama.chat, recording what each call was for."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, model=None, messages=None, stream=False, **kwargs):
+        prompt = messages[-1]['content']
+        self.calls.append("rewrite" if "standalone search query" in prompt
+                          else "summary" if "running summary" in prompt else "answer")
+        if stream:
+            return iter([{'message': {'content': "An answer."}, 'done': True}])
+        return {'message': {'content': "rewritten query"}}
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = app.GenerationScheduler(1)
+    monkeypatch.setattr(app, "generation_scheduler", scheduler)
+    monkeypatch.setattr(app, "QUEUE_EVENT_INTERVAL", 0.01)
+    return scheduler
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    chat = FakeChat()
+    monkeypatch.setattr(app.ollama, "chat", chat)
+    return chat
+
+
+def hold_slot(scheduler):
+    ticket = scheduler.enqueue()
+    assert scheduler.wait_turn(ticket, timeout=0)
+    return ticket
+
+
+def test_summary_waits_for_a_generation_slot(scheduler, fake_chat):
+    session = app.ChatSession("default")
+    session.turns = [(f"question {i}", f"answer {i}") for i in range(app.HISTORY_RECENT_TURNS + 1)]
+    held = hold_slot(scheduler)
+    summarizing = threading.Thread(target=session._summarize, args=(app.DEFAULT_MODEL,))
+    summarizing.start()
+    summarizing.join(0.2)
+    assert fake_chat.calls == [] and scheduler.stats()["waiting"] == 1
+    scheduler.finish(held)
+    summarizing.join(5)
+    assert fake_chat.calls == ["summary"]
+    assert session.summary == "rewritten query"
+    assert scheduler.stats() == {"active": 0, "waiting": 0, "max_active": 1}
+
+
+def test_follow_up_rewrite_waits_for_the_request_slot(scheduler, fake_chat, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "notebooks", app.NotebookRegistry(str(tmp_path / "notebooks"), 2))
+    app.notebooks.get("default").add_documents([("fruit.txt", ["apples are red"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    session = app.chat_sessions.session(None, "default")
+    session.turns.append(("what colour are apples?", "Red."))
+
+    held = hold_slot(scheduler)
+    response = app.app.test_client().post('/chat', json={"query": "and bananas?", "session_id": session.id}, buffered=False)
+    events = iter(response.response)
+    assert json.loads(next(events)[len("data: "):])["session_id"] == session.id
+    assert json.loads(next(events)[len("data: "):]) == {"queue_position": 0}
+    assert fake_chat.calls == []
+    scheduler.finish(held)
+    list(events)
+    assert fake_chat.calls == ["rewrite", "answer"]
+    assert scheduler.stats()["active"] == 0
@@ -0,0 +1,81 @@
+import threading
+
+import app
+from conftest import EMBED_MODEL
+
+
+def add(corpus, name, count):
+    texts = [f"{name} chunk number {i} about topic {i % 7}" for i in range(count)]
+    corpus.add_documents([(name, texts)], app.DEFAULT_MODEL, EMBED_MODEL)
+
+
+def count_rebuilds(monkeypatch):
+    rebuilds = []
+    original = app.EmbeddingSpace.rebuild
+    monkeypatch.setattr(app.EmbeddingSpace, "rebuild", lambda space, ids: rebuilds.append(len(ids)) or original(space, ids))
+    return rebuilds
+
+
+def test_effective_index_mode_falls_back_for_small_corpora():
+    assert app.effective_index_mode(100, "ivf") == "flat"
+    assert app.effective_index_mode(1000, "ivfpq") == "ivf"
+    assert app.effective_index_mode(20_000, "ivfpq") == "ivfpq"
+
+
+def test_forced_mode_that_fell_back_is_not_rebuilt_on_every_add(corpus, monkeypatch):
+    monkeypatch.setattr(app, "INDEX_MODE", "ivf")
+    rebuilds = count_rebuilds(monkeypatch)
+    add(corpus, "a.txt", 10)
+    add(corpus, "b.txt", 10)
+    add(corpus, "c.txt", 10)
+    assert rebuilds == [10]
+    assert corpus.spaces[EMBED_MODEL].index_mode == "flat"
+    add(corpus, "d.txt", 200)
+    assert rebuilds == [10, 230]
+    assert corpus.spaces[EMBED_MODEL].index_mode == "ivf"
+
+
+def test_auto_mode_switches_when_the_corpus_crosses_a_threshold(corpus, monkeypatch):
+    monkeypatch.setattr(app, "INDEX_AUTO_LIMITS", (("flat", 20), ("hnsw", 1000)))
+    add(corpus, "a.txt", 15)
+    assert corpus.spaces[EMBED_MODEL].index_mode == "flat"
+    add(corpus, "b.txt", 10)
+    assert corpus.spaces[EMBED_MODEL].index_mode == "hnsw"
+    assert corpus.index.ntotal == 25
+
+
+def test_removing_from_hnsw_rebuilds_the_graph(corpus, monkeypatch):
+    monkeypatch.setattr(app, "INDEX_MODE", "hnsw")
+    add(corpus, "a.txt", 5)
+    add(corpus, "b.txt", 5)
+    corpus.remove_source("a.txt")
+    assert corpus.index.ntotal == 5
+    hits = corpus.search(app.embed_texts(["a.txt chunk number 1"], EMBED_MODEL), 10)[0]
+    assert all(text.startswith("b.txt") for _, _, text in hits)
+
+
+def test_searches_continue_while_a_space_is_rebuilt(corpus, monkeypatch):
+    monkeypatch.setattr(app, "INDEX_AUTO_LIMITS", (("flat", 20), ("hnsw", 1000)))
+    add(corpus, "a.txt", 15)
+    started, release = threading.Event(), threading.Event()
+    original = app.build_index
+
+    def slow_build_index(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(app, "build_index", slow_build_index)
+    writer = threading.Thread(target=add, args=(corpus, "b.txt", 10))
+    writer.start()
+    try:
+        assert started.wait(5)
+        searched = []
+        reader = threading.Thread(target=lambda: searched.append(corpus.search(app.embed_texts(["topic"], EMBED_MODEL), 3)))
+        reader.start()
+        reader.join(2)
+        assert searched and len(searched[0][0]) == 3
+    finally:
+        release.set()
+        writer.join()
+    assert corpus.index.ntotal == 25
@@ -0,0 +1,57 @@
+import threading
+
+import numpy as np
+
+import app
+from conftest import EMBED_MODEL
+
+
+def chunk_stream(count, produced):
+    for i in range(count):
+        produced.append(i)
+        text = f"chunk {i} text"
+        yield app.Chunk(text, 1, 10 * i, 10 * i + len(text))
+
+
+def test_stream_writes_vectors_and_keeps_only_spans(tmp_path):
+    path = str(tmp_path / "doc.vectors")
+    spans, dimension = app.embed_chunk_stream(chunk_stream(10, []), EMBED_MODEL, path, batch_size=4)
+    assert spans.dtype == app.CHUNK_SPAN_DTYPE
+    assert spans['start'].tolist() == [10 * i for i in range(10)]
+    vectors = np.fromfile(path, dtype=np.float32).reshape(-1, dimension)
+    expected = app.embed_texts([f"chunk {i} text" for i in range(10)], EMBED_MODEL)
+    np.testing.assert_array_equal(vectors, expected)
+
+
+def test_stream_limits_batches_in_flight(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EMBED_PENDING_BATCHES", 2)
+    release = threading.Event()
+    backend = app.embed_backend
+    monkeypatch.setattr(app, "embed_backend", lambda model, texts: release.wait(5) and backend(model, texts))
+    produced = []
+    result = []
+    worker = threading.Thread(target=lambda: result.append(
+        app.embed_chunk_stream(chunk_stream(100, produced), EMBED_MODEL, str(tmp_path / "doc.vectors"), batch_size=4)))
+    worker.start()
+    worker.join(0.3)
+    # Two batches may wait in flight, and a third is submitted before the chunker blocks.
+    assert len(produced) == 3 * 4
+    release.set()
+    worker.join(5)
+    assert len(result[0][0]) == 100
+
+
+def test_empty_stream(tmp_path):
+    spans, dimension = app.embed_chunk_stream(iter([]), EMBED_MODEL, str(tmp_path / "doc.vectors"))
+    assert len(spans) == 0 and dimension is None
+
+
+def test_add_documents_from_spans(corpus, tmp_path):
+    text = "Alpha beta gamma.\n\nDelta epsilon zeta."
+    text_path = tmp_path / "doc.txt"
+    text_path.write_text(text, encoding="utf-8")
+    chunks = list(app.iter_chunks([text], max_tokens=5, overlap_tokens=0))
+    spans, _ = app.embed_chunk_stream(iter(chunks), EMBED_MODEL, str(tmp_path / "doc.vectors"))
+    corpus.add_documents([("doc.txt", spans, str(text_path))], app.DEFAULT_MODEL, EMBED_MODEL)
+    assert corpus.chunk_texts(corpus.chunk_ids) == [chunk.text for chunk in chunks]
+    assert corpus.keyword_search("epsilon", 1)[0][2] == "Delta epsilon zeta."
@@ -0,0 +1,67 @@
+import math
+
+import app
+
+
+def index_of(*texts):
+    index = app.KeywordIndex()
+    index.add(list(range(len(texts))), texts)
+    return index
+
+
+def test_keyword_tokens_keep_compound_identifiers():
+    assert app.keyword_tokens("Order XJ-9000 with v1.5") == ["order", "xj-9000", "xj", "9000", "with", "v1.5", "v1", "5"]
+
+
+def test_bm25_ranks_rarer_and_more_frequent_terms_higher():
+    index = index_of("the cat sat", "the dog sat", "the cat chased the cat", "a bird sang")
+    ranked = [chunk_id for chunk_id, _ in index.search("cat", 10)]
+    assert ranked == [2, 0]
+    assert index.search("sang", 1)[0][0] == 3
+    assert index.search("unknown words", 5) == []
+
+
+def test_bm25_score_matches_the_formula():
+    index = index_of("apple banana", "banana cherry cherry")
+    (chunk_id, score), = index.search("apple", 5)
+    idf = math.log(1 + (2 - 1 + 0.5) / (1 + 0.5))
+    norm = app.BM25_K1 * (1 - app.BM25_B + app.BM25_B * 2 / 2.5)
+    assert chunk_id == 0
+    assert math.isclose(score, idf * (app.BM25_K1 + 1) / (1 + norm), rel_tol=1e-5)
+
+
+def test_exact_identifier_matches():
+    index = index_of("replace part XJ-9000 today", "the xj series", "9000 units shipped")
+    assert index.search("XJ-9000", 1)[0][0] == 0
+
+
+def test_removed_chunks_are_not_returned_and_get_compacted():
+    texts = ["alpha beta", "alpha gamma", "delta"]
+    index = index_of(*texts)
+    index.remove([0, 1], texts[:2])
+    assert index.search("alpha", 5) == []
+    assert "alpha" not in index.postings
+    assert index.live_docs == 1 and index.dead_postings == 0
+
+
+def test_save_and_load(tmp_path):
+    index = index_of("alpha beta", "beta gamma")
+    path = str(tmp_path / "keywords.npz")
+    index.save(path)
+    assert app.KeywordIndex.load(path).search("beta gamma", 5) == index.search("beta gamma", 5)
+
+
+def test_reciprocal_rank_fusion():
+    dense = [(1, 0.1, "one"), (2, 0.2, "two"), (3, 0.3, "three")]
+    keyword = [(3, 9.0, "three"), (4, 5.0, "four")]
+    fused = app.reciprocal_rank_fusion([dense, keyword], 3)
+    assert [chunk_id for chunk_id, _, _ in fused] == [3, 1, 2]
+    assert math.isclose(fused[0][1], 1 / (app.RRF_K + 3) + 1 / (app.RRF_K + 1))
+    assert fused[0][2] == "three"
+
+
+def test_hybrid_retrieval_finds_exact_identifiers(corpus):
+    texts = [f"general notes on maintenance schedule {i}" for i in range(30)] + ["replace the XJ-9000 gasket"]
+    corpus.add_documents([("manual.txt", texts)], app.DEFAULT_MODEL, "stub-embed")
+    hits = app.retrieve(corpus, "XJ-9000", 3)
+    assert hits[0][2] == "replace the XJ-9000 gasket"
@@ -0,0 +1,66 @@
+import threading
+
+import app
+
+
+class FlakyOllama:
+    """Fails to list models `failures` times, then lists `installed`."""
+    def __init__(self, failures, installed):
+        self.failures = failures
+        self.installed = installed
+        self.calls = 0
+        self.listed = threading.Event()
+
+    def list(self):
+        self.calls += 1
+        self.listed.set()
+        if self.calls <= self.failures:
+            raise ConnectionError("connection refused")
+        return {"models": [{"name": name} for name in self.installed]}
+
+
+def wait_until_ready(manager, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if manager.snapshot()["ready"]:
+            return True
+        threading.Event().wait(0.01)
+    return False
+
+
+def test_failed_check_is_retried_until_ollama_answers(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "ollama", FlakyOllama(2, ["chat", "embed"]))
+    monkeypatch.setattr(app, "MODEL_RETRY_DELAY", 0.01)
+    manager = app.ModelManager(["chat", "embed"], str(tmp_path / "models.json"), 60)
+    manager.start()
+    assert wait_until_ready(manager)
+    assert app.ollama.calls == 3
+    assert (tmp_path / "models.json").exists()
+
+
+def test_request_for_a_failed_model_rechecks_straight_away(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "ollama", FlakyOllama(1, ["chat"]))
+    monkeypatch.setattr(app, "MODEL_RETRY_DELAY", 3600)
+    manager = app.ModelManager(["chat"], str(tmp_path / "models.json"), 60)
+    manager.start()
+    assert app.ollama.listed.wait(5)
+    for _ in range(500):
+        if manager.snapshot()["models"]["chat"]["status"] == "error":
+            break
+        threading.Event().wait(0.01)
+    assert "Could not reach Ollama" in manager.unavailable_reason("chat")
+    assert wait_until_ready(manager)
+    assert manager.unavailable_reason("chat") is None
+
+
+def test_recent_ready_check_is_trusted_but_an_old_one_is_not(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "ollama", FlakyOllama(0, ["chat"]))
+    status_path = str(tmp_path / "models.json")
+    manager = app.ModelManager(["chat"], status_path, 60)
+    manager._write_status(status_path)
+    manager.start()
+    assert manager.snapshot()["ready"] and app.ollama.calls == 0
+
+    stale = app.ModelManager(["chat"], status_path, 0)
+    stale.start()
+    assert wait_until_ready(stale)
+    assert app.ollama.calls == 1
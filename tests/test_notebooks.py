@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+import app
+from conftest import EMBED_MODEL
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return app.NotebookRegistry(str(tmp_path / "notebooks"), 2)
+
+
+def fill(registry, name):
+    corpus = registry.get(name)
+    corpus.add_documents([(f"{name}.txt", [f"{name} notebook text about {name}"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    return corpus
+
+
+def test_notebooks_are_isolated(registry):
+    fill(registry, "a")
+    fill(registry, "b")
+    assert registry.get("a").source_names == ["a.txt"]
+    assert registry.get("b").source_names == ["b.txt"]
+    assert registry.names() == ["a", "b", "default"]
+
+
+def test_invalid_names_are_rejected(registry):
+    with pytest.raises(ValueError):
+        registry.get("../escape")
+
+
+def test_least_recently_used_notebook_is_unloaded_and_reloads(registry):
+    a = fill(registry, "a")
+    b = fill(registry, "b")
+    registry.get("a")
+    fill(registry, "c")
+    assert a.loaded and not b.loaded
+    assert list(registry.recent) == ["a", "c"]
+    assert registry.get("b").ensure_loaded().source_names == ["b.txt"]
+    assert not a.loaded
+
+
+def test_a_notebook_in_use_is_not_unloaded(registry):
+    a = fill(registry, "a")
+    with a.in_use():
+        fill(registry, "b")
+        fill(registry, "c")
+        assert a.loaded
+        assert "a" in registry.recent
+    registry.get("d")
+    assert not a.loaded
+
+
+def test_retrieve_reloads_an_unloaded_notebook(registry):
+    a = fill(registry, "a")
+    a.unload()
+    hits = app.retrieve(a, "a notebook text", 1)
+    assert hits[0][2] == "a notebook text about a"
+    found, records, vectors = a.chunk_details(app.np.array([hits[0][0]]))
+    assert found.all() and vectors.shape[0] == 1
+
+
+def test_delete(registry):
+    fill(registry, "a")
+    assert registry.delete("a")
+    assert not registry.delete("a")
+    assert registry.names() == ["default"]
+
+
+class EvictingLock:
+    """A corpus write lock that unloads the corpus just before it is next taken, as an eviction would."""
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.lock = threading.Lock()
+        self.armed = False
+
+    def acquire(self, blocking=True):
+        return self.lock.acquire(blocking)
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        if self.armed:
+            self.armed = False
+            assert self.corpus.unload()
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def test_writes_reload_a_corpus_evicted_before_they_start(registry):
+    corpus = fill(registry, "a")
+    corpus.write_lock = EvictingLock(corpus)
+    corpus.write_lock.armed = True
+    corpus.add_documents([("b.txt", ["second document"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    assert corpus.source_names == ["a.txt", "b.txt"]
+    corpus.write_lock.armed = True
+    assert corpus.remove_source("b.txt")
+
+    reloaded = app.Corpus(corpus.directory).ensure_loaded()
+    assert reloaded.source_names == ["a.txt"]
+    assert reloaded.chunk_texts(reloaded.chunk_ids) == ["a notebook text about a"]
@@ -0,0 +1,51 @@
+import argparse
+import json
+
+import app
+from conftest import EMBED_MODEL
+
+
+def query_args(questions, output, notebook="default", k=2):
+    return argparse.Namespace(questions=str(questions), output=str(output), notebook=notebook, k=k)
+
+
+def use_notebooks(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "notebooks", app.NotebookRegistry(str(tmp_path / "notebooks"), 2))
+    return app.notebooks.get("default")
+
+
+def test_queries_are_answered_as_json_lines(tmp_path, monkeypatch):
+    use_notebooks(tmp_path, monkeypatch).add_documents([("fruit.txt", ["apples are red", "bananas are yellow"])],
+                                                       app.DEFAULT_MODEL, EMBED_MODEL)
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text('{"query": "bananas are yellow", "id": 7}\n\napples are red\n', encoding='utf-8')
+    assert app.run_query(query_args(questions, tmp_path / "out.jsonl")) == 0
+    lines = [json.loads(line) for line in (tmp_path / "out.jsonl").read_text(encoding='utf-8').splitlines()]
+    assert [(line["query"], line.get("id")) for line in lines] == [("bananas are yellow", 7), ("apples are red", None)]
+    assert lines[0]["results"][0]["text"] == "bananas are yellow"
+
+
+def test_empty_questions_file_writes_nothing(tmp_path, monkeypatch):
+    use_notebooks(tmp_path, monkeypatch).add_documents([("fruit.txt", ["apples are red"])], app.DEFAULT_MODEL, EMBED_MODEL)
+    questions = tmp_path / "questions.txt"
+    questions.write_text("\n\n", encoding='utf-8')
+    assert app.run_query(query_args(questions, tmp_path / "out.jsonl")) == 0
+    assert not (tmp_path / "out.jsonl").exists()
+    assert app.retrieve_batch(app.notebooks.get("default"), [], 2) == ([], [])
+
+
+def test_json_line_without_a_query_is_rejected(tmp_path, monkeypatch, capsys):
+    use_notebooks(tmp_path, monkeypatch)
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text('{"query": "fine"}\n{"question": "wrong field"}\n', encoding='utf-8')
+    assert app.run_query(query_args(questions, tmp_path / "out.jsonl")) == 1
+    assert f'Line 2 of {questions} has no "query" field.' in capsys.readouterr().err
+    assert not (tmp_path / "out.jsonl").exists()
+
+
+def test_empty_notebook_does_not_create_the_output_file(tmp_path, monkeypatch):
+    use_notebooks(tmp_path, monkeypatch)
+    questions = tmp_path / "questions.txt"
+    questions.write_text("anything\n", encoding='utf-8')
+    assert app.run_query(query_args(questions, tmp_path / "out.jsonl")) == 1
+    assert not (tmp_path / "out.jsonl").exists()
@@ -0,0 +1,64 @@
+import io
+import os
+
+import app
+from conftest import EMBED_MODEL, make_pdf
+
+
+def ingest(corpus, upload_dir, *files):
+    staged = []
+    for name, data in files:
+        path, sha256 = app.stage_upload(io.BytesIO(data), str(upload_dir), name)
+        staged.append((name, path, sha256))
+    job = app.IngestJob(corpus, "notebook", staged, app.DEFAULT_MODEL, EMBED_MODEL, str(upload_dir))
+    app.run_ingest_job(job)
+    return job
+
+
+def test_indexed_pdf_is_not_kept_in_the_upload_folder(corpus, tmp_path):
+    job = ingest(corpus, tmp_path, ("report.pdf", make_pdf(["Quarterly revenue grew strongly", "Costs fell"])))
+    assert job.status == "done"
+    assert job.results == [{"name": "report.pdf", "status": "indexed", "chunks": 1}]
+    assert "Quarterly revenue" in corpus.keyword_search("revenue", 1)[0][2]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".pdf") or ".pdf." in name] == []
+
+
+def test_pdf_that_fails_to_extract_is_removed(corpus, tmp_path):
+    job = ingest(corpus, tmp_path, ("broken.pdf", b"%PDF-1.4 not really a pdf"), ("notes.txt", b"some notes"))
+    assert [result["status"] for result in job.results] == ["error", "indexed"]
+    assert [name for name in os.listdir(tmp_path) if "broken" in name] == []
+
+
+def test_txt_upload_becomes_the_stored_document(corpus, tmp_path):
+    ingest(corpus, tmp_path, ("notes.txt", b"line one\r\nline two"))
+    assert [name for name in os.listdir(tmp_path) if "notes" in name] == []
+    assert corpus.chunk_texts(corpus.chunk_ids) == ["line one\nline two"]
+
+
+def test_duplicate_upload_is_skipped_and_removed(corpus, tmp_path):
+    ingest(corpus, tmp_path, ("a.pdf", make_pdf(["Same content in both files"])))
+    job = ingest(corpus, tmp_path, ("b.pdf", make_pdf(["Same content in both files"])))
+    assert job.results == [{"name": "b.pdf", "status": "duplicate", "duplicate_of": "a.pdf"}]
+    assert corpus.source_names == ["a.pdf"]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".pdf")] == []
+
+
+def test_command_line_ingest_reads_pdfs_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "notebooks", app.NotebookRegistry(str(tmp_path / "notebooks"), 2))
+    monkeypatch.setitem(app.app.config, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    documents = tmp_path / "documents"
+    (documents / "copies").mkdir(parents=True)
+    pdf = make_pdf(["Quarterly revenue grew strongly"])
+    (documents / "report.pdf").write_bytes(pdf)
+    (documents / "copies" / "report.pdf").write_bytes(pdf)
+    (documents / "notes.txt").write_bytes(b"meeting notes")
+
+    results = app.ingest_paths("default", [str(documents)], app.DEFAULT_MODEL, EMBED_MODEL, batch_size=10)
+    assert results == [{"name": "copies/report.pdf", "status": "duplicate", "duplicate_of": "report.pdf"},
+                       {"name": "notes.txt", "status": "indexed", "chunks": 1},
+                       {"name": "report.pdf", "status": "indexed", "chunks": 1}]
+    assert (documents / "report.pdf").read_bytes() == pdf
+    assert (documents / "notes.txt").read_bytes() == b"meeting notes"
+    assert sorted(os.listdir(documents)) == ["copies", "notes.txt", "report.pdf"]
+    assert os.listdir(tmp_path / "uploads" / "files" / "default") == []
+    assert app.notebooks.get("default").source_for_hash(app.file_sha256(str(documents / "report.pdf"))) is not None
@@ -0,0 +1,95 @@
+import json
+import os
+
+import numpy as np
+
+import app
+from conftest import EMBED_MODEL
+
+
+def add(corpus, *documents):
+    return corpus.add_documents(list(documents), app.DEFAULT_MODEL, EMBED_MODEL)
+
+
+def space(corpus):
+    return corpus.spaces[EMBED_MODEL]
+
+
+def stored_vectors_match(corpus):
+    texts = corpus.chunk_texts(corpus.chunk_ids)
+    expected = app.embed_texts(texts, EMBED_MODEL)
+    return np.allclose(space(corpus).vectors_for(corpus.chunk_ids), expected, atol=1e-3)
+
+
+def test_adding_appends_to_the_vectors_file(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]))
+    name, size = space(corpus).vectors_name, os.path.getsize(space(corpus).vectors_path)
+    add(corpus, ("space.txt", ["mars is a planet"]))
+    assert space(corpus).vectors_name == name
+    assert os.path.getsize(space(corpus).vectors_path) == size + space(corpus).row_bytes
+    assert isinstance(space(corpus).vectors, np.memmap)
+    assert space(corpus).row_ids.tolist() == [0, 1, 2]
+    assert stored_vectors_match(corpus)
+
+
+def test_removed_rows_stay_until_they_outnumber_the_live_ones(corpus):
+    add(corpus, ("a.txt", ["alpha one", "alpha two"]), ("b.txt", ["beta one"]), ("c.txt", ["gamma one", "gamma two"]))
+    name = space(corpus).vectors_name
+    corpus.remove_source("b.txt")
+    assert space(corpus).vectors_name == name
+    assert space(corpus).row_ids.tolist() == [0, 1, 2, 3, 4]
+    assert stored_vectors_match(corpus)
+
+    corpus.remove_source("a.txt")
+    assert space(corpus).vectors_name != name
+    assert space(corpus).row_ids.tolist() == [3, 4]
+    assert stored_vectors_match(corpus)
+    assert not os.path.exists(os.path.join(space(corpus).directory, name + ".bin"))
+
+
+def test_saving_leaves_the_vectors_file_alone(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]))
+    path = space(corpus).vectors_path
+    os.utime(path, (0, 0))
+    corpus.save()
+    assert os.path.getmtime(path) == 0
+
+
+def test_reloaded_space_maps_its_saved_rows(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]), ("space.txt", ["mars is a planet"]))
+    corpus.remove_source("space.txt")
+    reloaded = app.Corpus(corpus.directory).ensure_loaded()
+    assert isinstance(space(reloaded).vectors, np.memmap)
+    assert space(reloaded).row_ids.tolist() == [0, 1, 2]
+    assert stored_vectors_match(reloaded)
+    found, _, vectors = reloaded.chunk_details(np.array([1, 2]))
+    assert found.tolist() == [True, False]
+    assert vectors.shape == (1, 32)
+
+
+def test_version_7_vectors_are_moved_into_a_vectors_file(corpus):
+    add(corpus, ("fruit.txt", ["apples are red", "bananas are yellow"]))
+    old = space(corpus)
+    np.save(os.path.join(old.directory, "vectors.npy"), old.vectors_for(corpus.chunk_ids))
+    os.remove(old.vectors_path)
+    os.remove(old.row_ids_path)
+    manifest_path = os.path.join(corpus.directory, "manifest.json")
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['version'] = 7
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    reloaded = app.Corpus(corpus.directory).ensure_loaded()
+    assert stored_vectors_match(reloaded)
+    assert not os.path.exists(os.path.join(old.directory, "vectors.npy"))
+    with open(manifest_path, encoding='utf-8') as f:
+        assert json.load(f)['version'] == app.Corpus.MANIFEST_VERSION
+
+
+def test_build_index_reads_only_the_given_rows():
+    vectors = np.random.default_rng(0).standard_normal((50, 8)).astype(np.float32)
+    rows = np.array([3, 10, 20, 41])
+    index, _ = app.build_index(vectors, np.array([7, 8, 9, 10]), mode="flat", rows=rows)
+    _, found = index.search(vectors[[20]], 1)
+    assert found[0, 0] == 9